@@ -18,6 +18,14 @@ import time
 import traceback
 import stomp
 
+try:
+    # python 3
+    from queue import Empty
+except ImportError:
+    # Python 2
+    from Queue import Empty
+
+from idds.common import metrics
 from idds.common.plugin.plugin_base import PluginBase
 from idds.common.utils import setup_logging
 
@@ -42,7 +50,270 @@ class MessagingListener(stomp.ConnectionListener):
         self.logger.error('[broker] [%s]: %s', self.__broker, body)
 
 
+class BrokerConnection(object):
+    """
+    A connection to one broker address, with its send latency and error rate.
+    The latency and the error rate are exponentially weighted moving averages.
+    """
+
+    # weight of the last sample in the moving averages
+    SMOOTHING = 0.1
+    # latency of a connection which didn't send anything yet
+    DEFAULT_LATENCY = 0.01
+
+    def __init__(self, broker, address, port, vhost=None, username=None, password=None,
+                 timeout=10, heartbeat=0, retry_period=30):
+        self.broker = broker
+        self.address = address
+        self.port = port
+        self.username = username
+        self.password = password
+        self.retry_period = retry_period
+        self.name = '%s:%s' % (address, port)
+
+        self.conn = stomp.Connection12(host_and_ports=[(address, port)],
+                                       vhost=vhost,
+                                       keepalive=True,
+                                       timeout=timeout,
+                                       heartbeats=(heartbeat, heartbeat))
+        self.conn.set_listener('message-sender', MessagingListener(self.name))
+        self.lock = threading.Lock()
+
+        self.latency = None
+        self.error_rate = 0.0
+        self.num_sent = 0
+        self.num_errors = 0
+        self.last_error_at = None
+
+    def is_connected(self):
+        return self.conn.is_connected()
+
+    def is_healthy(self):
+        """
+        Connected and no error in the last retry_period seconds.
+        """
+        if self.last_error_at is not None and self.last_error_at + self.retry_period > time.time():
+            return False
+        return self.is_connected()
+
+    def connect(self):
+        with self.lock:
+            if not self.conn.is_connected():
+                self.conn.connect(self.username, self.password, wait=True)
+
+    def disconnect(self):
+        try:
+            if self.conn.is_connected():
+                self.conn.disconnect()
+        except Exception:
+            pass
+
+    def record_success(self, latency):
+        self.num_sent += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.SMOOTHING * (latency - self.latency)
+        self.error_rate -= self.SMOOTHING * self.error_rate
+        metrics.observe('idds_broker_send_duration_seconds', latency, {'broker': self.name},
+                        documentation='Duration of sending one frame to a message broker')
+
+    def record_error(self):
+        self.num_errors += 1
+        self.last_error_at = time.time()
+        self.error_rate += self.SMOOTHING * (1 - self.error_rate)
+        metrics.inc_counter('idds_broker_send_errors_total', labels={'broker': self.name},
+                            documentation='Number of failures to send to a message broker')
+
+    def get_weight(self, default_latency=None):
+        """
+        The connections with a lower latency and a lower error rate get more messages.
+
+        :param default_latency: The latency of a connection which didn't send anything yet.
+        """
+        latency = self.latency if self.latency else (default_latency or self.DEFAULT_LATENCY)
+        return 1.0 / (max(latency, 0.0001) * (1 + 10 * self.error_rate))
+
+    def send(self, body, destination, headers):
+        try:
+            # a broker refusing connections counts as failing, so it gets fewer messages
+            self.connect()
+            start = time.time()
+            self.conn.send(body=body, destination=destination, id='atlas-idds-messaging',
+                           ack='auto', headers=headers)
+        except Exception:
+            self.record_error()
+            raise
+        self.record_success(time.time() - start)
+
+    def get_stats(self):
+        return {'broker': self.broker,
+                'address': self.name,
+                'connected': self.is_connected(),
+                'healthy': self.is_healthy(),
+                'latency': self.latency,
+                'error_rate': self.error_rate,
+                'num_sent': self.num_sent,
+                'num_errors': self.num_errors}
+
+
+class ConnectionPool(threading.Thread):
+    """
+    Persistent connections to all addresses of the brokers.
+
+    A background thread reconnects the broken connections every health_check_period seconds,
+    so the senders normally find them connected, and re-resolves the broker hostnames every
+    dns_refresh_period seconds. The connections of the addresses which disappear from the DNS
+    are closed. The frames are routed to the healthy connections, weighted by their latency
+    and error rate.
+    """
+
+    def __init__(self, brokers, port, vhost=None, username=None, password=None, timeout=10, heartbeat=0,
+                 health_check_period=10, dns_refresh_period=600, retry_period=30, logger=None):
+        super(ConnectionPool, self).__init__(name='MessagingConnectionPool')
+        self.daemon = True
+        self.brokers = brokers
+        self.port = port
+        self.connection_args = {'vhost': vhost, 'username': username, 'password': password,
+                                'timeout': timeout, 'heartbeat': heartbeat, 'retry_period': retry_period}
+        self.health_check_period = health_check_period
+        self.dns_refresh_period = dns_refresh_period
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        self.graceful_stop = threading.Event()
+        self.lock = threading.Lock()
+        # address -> BrokerConnection
+        self.connections = {}
+        self.last_dns_refresh = None
+
+    def resolve(self):
+        """
+        :returns: dict of address -> broker hostname.
+        """
+        addresses = {}
+        for broker in self.brokers:
+            try:
+                addrinfos = socket.getaddrinfo(broker, 0, socket.AF_INET, 0, socket.IPPROTO_TCP)
+                for addrinfo in addrinfos:
+                    addresses[addrinfo[4][0]] = broker
+            except socket.gaierror as error:
+                self.logger.error('Cannot resolve hostname %s: %s' % (broker, str(error)))
+        return addresses
+
+    def refresh_connections(self):
+        self.last_dns_refresh = time.time()
+        addresses = self.resolve()
+        if not addresses:
+            # keep the current connections if the DNS is not available
+            self.logger.error("No broker address is resolved, keep the current connections")
+            return
+
+        with self.lock:
+            new_addresses = [address for address in addresses if address not in self.connections]
+            removed_addresses = [address for address in self.connections if address not in addresses]
+            connections = dict(self.connections)
+            for address in new_addresses:
+                connections[address] = BrokerConnection(addresses[address], address, self.port, **self.connection_args)
+            removed_connections = [connections.pop(address) for address in removed_addresses]
+            self.connections = connections
+
+        if new_addresses or removed_addresses:
+            self.logger.info("Resolved broker addresses: %s (new: %s, removed: %s)" %
+                             (list(addresses.keys()), new_addresses, removed_addresses))
+        for conn in removed_connections:
+            conn.disconnect()
+
+    def check_health(self):
+        for conn in list(self.connections.values()):
+            if not conn.is_connected():
+                try:
+                    conn.connect()
+                except Exception as error:
+                    conn.record_error()
+                    self.logger.warning("Failed to connect to broker %s: %s" % (conn.name, error))
+
+    def get_connection(self, excluded=None):
+        """
+        Choose a connection, randomly weighted by latency and error rate among the healthy ones.
+        If no connection is healthy, any one is chosen and it will be reconnected when sending.
+        """
+        connections = [conn for conn in self.connections.values() if not excluded or conn not in excluded]
+        if not connections:
+            return None
+        healthy_connections = [conn for conn in connections if conn.is_healthy()]
+        if healthy_connections:
+            # the new connections are assumed to be as fast as the fastest one, so that they get messages too
+            latencies = [conn.latency for conn in healthy_connections if conn.latency]
+            default_latency = min(latencies) if latencies else None
+            weights = [conn.get_weight(default_latency) for conn in healthy_connections]
+            point = random.uniform(0, sum(weights))
+            for conn, weight in zip(healthy_connections, weights):
+                point -= weight
+                if point <= 0:
+                    return conn
+            return healthy_connections[-1]
+        return random.choice(connections)
+
+    def send(self, body, destination, headers, retries=1):
+        """
+        Send a frame. If it fails, it's retried on other connections.
+        """
+        tried = []
+        last_error = None
+        while len(tried) <= retries:
+            conn = self.get_connection(excluded=tried)
+            if conn is None:
+                break
+            tried.append(conn)
+            try:
+                conn.send(body, destination, headers)
+                return
+            except Exception as error:
+                self.logger.warning("Failed to send to broker %s: %s" % (conn.name, error))
+                last_error = error
+        if last_error is not None:
+            raise last_error
+        raise Exception("No connection to the brokers %s is available" % self.brokers)
+
+    def start(self):
+        self.refresh_connections()
+        self.check_health()
+        super(ConnectionPool, self).start()
+
+    def stop(self):
+        self.graceful_stop.set()
+
+    def close(self):
+        self.stop()
+        for conn in list(self.connections.values()):
+            conn.disconnect()
+
+    def get_stats(self):
+        return [conn.get_stats() for conn in self.connections.values()]
+
+    def run(self):
+        while not self.graceful_stop.wait(self.health_check_period):
+            try:
+                if self.last_dns_refresh is None or self.last_dns_refresh + self.dns_refresh_period < time.time():
+                    self.refresh_connections()
+                self.check_health()
+            except Exception as error:
+                self.logger.error("Messaging connection pool throws an exception: %s, %s" % (error, traceback.format_exc()))
+
+
 class MessagingSender(PluginBase, threading.Thread):
+    """
+    Send the messages of the request queue to the message brokers.
+
+    num_threads sender threads share a pool of persistent connections and get the messages
+    from the request queue. If a response queue is set, every message is acknowledged on it
+    with {'msg_id': <msg_id>, 'sent': True|False}.
+
+    If batch_size is larger than 1, up to batch_size queued messages with the same msg_type
+    are sent in one frame, with a json list of the msg_contents as body and a 'batch_size'
+    header. It should only be enabled if the consumers of the destination support it.
+    """
+
     def __init__(self, **kwargs):
         threading.Thread.__init__(self)
         super(MessagingSender, self).__init__(**kwargs)
@@ -50,6 +321,7 @@ class MessagingSender(PluginBase, threading.Thread):
         self.setup_logger()
         self.graceful_stop = threading.Event()
         self.request_queue = None
+        self.response_queue = None
 
         if not hasattr(self, 'brokers'):
             raise Exception('brokers is required but not defined.')
@@ -61,12 +333,37 @@ class MessagingSender(PluginBase, threading.Thread):
             self.vhost = None
         if not hasattr(self, 'destination'):
             raise Exception('destination is required but not defined.')
+        if not hasattr(self, 'username'):
+            self.username = None
+        if not hasattr(self, 'password'):
+            self.password = None
         if not hasattr(self, 'broker_timeout'):
             self.broker_timeout = 10
         else:
             self.broker_timeout = int(self.broker_timeout)
+        if not hasattr(self, 'num_threads'):
+            self.num_threads = 1
+        else:
+            self.num_threads = int(self.num_threads)
+        # heart beats in milliseconds, 0 to disable them
+        if not hasattr(self, 'heartbeat'):
+            self.heartbeat = 0
+        else:
+            self.heartbeat = int(self.heartbeat)
+        if not hasattr(self, 'health_check_period'):
+            self.health_check_period = 10
+        else:
+            self.health_check_period = int(self.health_check_period)
+        if not hasattr(self, 'dns_refresh_period'):
+            self.dns_refresh_period = 600
+        else:
+            self.dns_refresh_period = int(self.dns_refresh_period)
+        if not hasattr(self, 'batch_size'):
+            self.batch_size = 1
+        else:
+            self.batch_size = int(self.batch_size)
 
-        self.conns = []
+        self.pool = None
 
     def stop(self):
         self.graceful_stop.set()
@@ -74,55 +371,95 @@ class MessagingSender(PluginBase, threading.Thread):
     def set_request_queue(self, request_queue):
         self.request_queue = request_queue
 
-    def connect_to_messaging_brokers(self):
-        broker_addresses = []
-        for b in self.brokers:
-            try:
-                addrinfos = socket.getaddrinfo(b, 0, socket.AF_INET, 0, socket.IPPROTO_TCP)
-                for addrinfo in addrinfos:
-                    b_addr = addrinfo[4][0]
-                    broker_addresses.append(b_addr)
-            except socket.gaierror as error:
-                self.logger.error('Cannot resolve hostname %s: %s' % (b, str(error)))
+    def set_response_queue(self, response_queue):
+        self.response_queue = response_queue
 
-        self.logger.info("Resolved broker addresses: %s" % broker_addresses)
+    def connect_to_messaging_brokers(self):
+        self.pool = ConnectionPool(self.brokers, self.port, vhost=self.vhost,
+                                   username=self.username, password=self.password,
+                                   timeout=self.broker_timeout, heartbeat=self.heartbeat,
+                                   health_check_period=self.health_check_period,
+                                   dns_refresh_period=self.dns_refresh_period,
+                                   logger=self.logger)
+        self.pool.start()
 
-        for broker in broker_addresses:
-            conn = stomp.Connection12(host_and_ports=[(broker, self.port)],
-                                      vhost=self.vhost,
-                                      keepalive=True,
-                                      timeout=self.broker_timeout)
-            conn.set_listener('message-sender', MessagingListener(conn.transport._Transport__host_and_ports[0]))
-            self.conns.append(conn)
+    def get_headers(self, msg_type):
+        return {'persistent': 'true',
+                'vo': 'atlas',
+                'msg_type': str(msg_type).lower()}
 
     def send_message(self, msg):
-        conn = random.sample(self.conns, 1)[0]
-        if not conn.is_connected():
-            # conn.start()
-            conn.connect(self.username, self.password, wait=True)
-
-        self.logger.info("Sending message to message broker: %s" % msg['msg_id'])
-        conn.send(body=json.dumps(msg['msg_content']),
-                  destination=self.destination,
-                  id='atlas-idds-messaging',
-                  ack='auto',
-                  headers={'persistent': 'true',
-                           'vo': 'atlas',
-                           'msg_type': str(msg['msg_type']).lower()})
+        self.logger.debug("Sending message to message broker: %s" % msg['msg_id'])
+        self.pool.send(body=json.dumps(msg['msg_content']),
+                       destination=self.destination,
+                       headers=self.get_headers(msg['msg_type']))
+
+    def send_messages(self, msgs):
+        """
+        Send messages with the same msg_type in one frame.
+        """
+        if len(msgs) == 1:
+            return self.send_message(msgs[0])
+
+        self.logger.debug("Sending messages to message broker: %s" % [msg['msg_id'] for msg in msgs])
+        headers = self.get_headers(msgs[0]['msg_type'])
+        headers['batch_size'] = str(len(msgs))
+        self.pool.send(body=json.dumps([msg['msg_content'] for msg in msgs]),
+                       destination=self.destination,
+                       headers=headers)
+
+    def acknowledge(self, msg, sent):
+        if self.response_queue is not None:
+            self.response_queue.put({'msg_id': msg['msg_id'], 'sent': sent})
+
+    def get_batch(self):
+        """
+        Wait for one message, then get up to batch_size - 1 more without waiting.
+
+        :returns: list of batches, one per msg_type.
+        """
+        try:
+            msg = self.request_queue.get(timeout=1)
+        except Empty:
+            return []
+        msgs = [msg]
+        while len(msgs) < self.batch_size:
+            try:
+                msgs.append(self.request_queue.get(block=False))
+            except Empty:
+                break
+
+        batches = {}
+        for msg in msgs:
+            if msg:
+                batches.setdefault(str(msg['msg_type']), []).append(msg)
+        return list(batches.values())
+
+    def run_sender(self):
+        while not self.graceful_stop.is_set():
+            for msgs in self.get_batch():
+                try:
+                    self.send_messages(msgs)
+                    sent = True
+                except Exception as error:
+                    self.logger.error("Messaging sender throws an exception: %s, %s" % (error, traceback.format_exc()))
+                    sent = False
+                for msg in msgs:
+                    self.acknowledge(msg, sent)
 
     def run(self):
         self.connect_to_messaging_brokers()
 
-        while not self.graceful_stop.is_set():
-            try:
-                if not self.request_queue.empty():
-                    msg = self.request_queue.get(False)
-                    if msg:
-                        self.send_message(msg)
-                else:
-                    time.sleep(1)
-            except Exception as error:
-                self.logger.error("Messaging sender throws an exception: %s, %s" % (error, traceback.format_exc()))
+        senders = []
+        for i in range(self.num_threads):
+            sender = threading.Thread(target=self.run_sender, name='MessagingSender-%s' % i)
+            sender.daemon = True
+            sender.start()
+            senders.append(sender)
+
+        for sender in senders:
+            sender.join()
+        self.pool.close()
 
     def __call__(self):
         self.run()
@@ -118,6 +118,29 @@ class StageInPoller(ProcessingPluginBase):
                 return ContentStatus.Available
         return ContentStatus.New
 
+    def poll_rules(self, rule_ids):
+        """
+        Poll the rules of a processing together.
+
+        :returns: dict of rule_id -> (rule, replicases_status). The rule is None and the replicases_status
+                  is empty if the rule is not found.
+        """
+        if hasattr(self.plugins['rule_poller'], 'poll_rules'):
+            rule_statuses = self.plugins['rule_poller'].poll_rules(rule_ids)
+            for rule_id, (rule, replicases_status) in rule_statuses.items():
+                if rule is None:
+                    self.logger.warn("rule(%s) not found" % str(rule_id))
+            return rule_statuses
+
+        rule_statuses = {}
+        for rule_id in rule_ids:
+            try:
+                rule_statuses[rule_id] = self.plugins['rule_poller'](rule_id)
+            except exceptions.ProcessNotFound as ex:
+                self.logger.warn(ex)
+                rule_statuses[rule_id] = (None, {})
+        return rule_statuses
+
     def __call__(self, processing, transform, input_collection, output_collection, output_contents):
         try:
             processing_metadata = processing['processing_metadata']
@@ -126,27 +149,21 @@ class StageInPoller(ProcessingPluginBase):
             if 'rule_poller' not in self.plugins:
                 raise exceptions.AgentPluginError('Plugin rule_poller is required')
 
-            rule_id = processing_metadata['rule_id']
-            try:
-                basic_rule, basic_replicases_status = self.plugins['rule_poller'](rule_id)
-                all_rule_notfound = False
-            except exceptions.ProcessNotFound as ex:
-                self.logger.warn(ex)
-                basic_rule = None
-                basic_replicases_status = []
-
             if 'new_rule_ids' in processing_metadata:
                 new_rule_ids = processing_metadata['new_rule_ids']
             else:
                 new_rule_ids = []
+            rule_statuses = self.poll_rules([processing_metadata['rule_id']] + new_rule_ids)
+
+            basic_rule, basic_replicases_status = rule_statuses[processing_metadata['rule_id']]
+            if basic_rule is not None:
+                all_rule_notfound = False
+
             new_rules, new_replicases_statuses = [], []
             for rule_id in new_rule_ids:
-                try:
-                    new_rule, new_replicases_status = self.plugins['rule_poller'](rule_id)
+                new_rule, new_replicases_status = rule_statuses[rule_id]
+                if new_rule is not None:
                     all_rule_notfound = False
-                except exceptions.ProcessNotFound as ex:
-                    self.logger.warn(ex)
-                    new_rule, new_replicases_status = None, []
                 new_rules.append(new_rule)
                 new_replicases_statuses.append(new_replicases_status)
 
@@ -13,28 +13,366 @@
 Class of base plugin
 """
 
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
 import traceback
 
 from rucio.client.client import Client
 from rucio.common.exception import CannotAuthenticate
 
 from idds.common import exceptions
+from idds.common import metrics
+from idds.common.config import config_has_option, config_get
 from idds.common.plugin.plugin_base import PluginBase
 
 
+RUCIO_SECTION = 'rucio'
+
+# the attributes of the DIDs and the files which are cached
+METADATA_KEYS = ('bytes', 'length', 'availability', 'events', 'is_open', 'run_number', 'did_type')
+FILE_KEYS = ('scope', 'name', 'bytes', 'events', 'adler32', 'md5')
+
+
+class RucioCache(object):
+    """
+    LRU cache of the metadata and the file lists of Rucio DIDs.
+
+    The entries of closed DIDs never expire, because closed DIDs don't change. The metadata of
+    open DIDs expires after ttl seconds. File lists are only cached for closed DIDs, so a DID is
+    never seen as closed with an outdated file list.
+
+    The size of the cache is the number of cached items: one for the metadata and one per file
+    for the file lists. The least recently used entries are evicted when it's over max_size.
+    If cache_file is set, the entries of closed DIDs are persisted to it and loaded at start.
+    """
+
+    def __init__(self, ttl=60, max_size=1000000, max_entry_size=100000, cache_file=None, persist_period=300,
+                 logger=None):
+        self.ttl = int(ttl)
+        self.max_size = int(max_size)
+        self.max_entry_size = min(int(max_entry_size), self.max_size)
+        self.cache_file = cache_file
+        self.persist_period = int(persist_period)
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        # key -> (value, expired_at (None for closed DIDs), size)
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._persisted_at = time.time()
+
+        if self.cache_file:
+            self.load()
+
+    def get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.time():
+                self.delete(key)
+                return None
+            # most recently used
+            self._entries[key] = self._entries.pop(key)
+            return entry
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value, expired_at=None, size=1):
+        """
+        Cache a value.
+
+        :param expired_at: The time when the entry expires, None for entries which never expire.
+        :param size: The number of items in the value.
+        """
+        if size > self.max_entry_size:
+            return
+
+        with self._lock:
+            self.delete(key)
+            self._entries[key] = (value, expired_at, size)
+            self._size += size
+            while self._size > self.max_size:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._size -= old_entry[2]
+            if expired_at is None:
+                self._dirty = True
+        if self.cache_file and self._dirty and self._persisted_at + self.persist_period < time.time():
+            self.persist()
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self._size = 0
+
+    def get_size(self):
+        return self._size
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+            for key, value, size in entries:
+                self.set(tuple(key), value, size=size)
+            self._dirty = False
+        except Exception as error:
+            # the cache is rebuilt from Rucio
+            self.logger.warning("Failed to load the Rucio cache from %s: %s" % (self.cache_file, error))
+
+    def persist(self):
+        """
+        Write the entries of closed DIDs to the cache file.
+        The file is replaced atomically, so readers never see a partial file.
+        """
+        with self._lock:
+            entries = [[key, value, size] for key, (value, expired_at, size) in self._entries.items() if expired_at is None]
+            self._dirty = False
+            self._persisted_at = time.time()
+        try:
+            tmp_path = '%s.%s.tmp' % (self.cache_file, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.cache_file)
+        except Exception as error:
+            self.logger.warning("Failed to persist the Rucio cache to %s: %s" % (self.cache_file, error))
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """
+    The cache shared by all Rucio plugins and works in the process, configured in the [rucio] section:
+    cache_ttl, cache_max_size, cache_max_entry_size, cache_file and cache_persist_period.
+    """
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                params = {}
+                for option, param in [('cache_ttl', 'ttl'), ('cache_max_size', 'max_size'),
+                                      ('cache_max_entry_size', 'max_entry_size'), ('cache_file', 'cache_file'),
+                                      ('cache_persist_period', 'persist_period')]:
+                    try:
+                        if config_has_option(RUCIO_SECTION, option):
+                            params[param] = config_get(RUCIO_SECTION, option)
+                    except Exception:
+                        # no configuration file
+                        pass
+                cache = RucioCache(**params)
+                if cache.cache_file:
+                    atexit.register(cache.persist)
+                _CACHE = cache
+    return _CACHE
+
+
+def get_did_metadata(client, scope, name):
+    """
+    Get the metadata of a DID, from the cache if possible.
+
+    :returns: dict with the keys in METADATA_KEYS. It's shared with the cache and must not be modified.
+    """
+    cache = get_cache()
+    key = ('metadata', scope, name)
+    meta = cache.get(key)
+    if meta is not None:
+        metrics.inc_counter('idds_rucio_cache_total', labels={'kind': 'metadata', 'result': 'hit'})
+        return meta
+
+    metrics.inc_counter('idds_rucio_cache_total', labels={'kind': 'metadata', 'result': 'miss'})
+    did_meta = call_rucio(client, lambda c: c.get_metadata(scope=scope, name=name))
+    meta = dict([(k, did_meta.get(k, None)) for k in METADATA_KEYS])
+    if not meta['is_open']:
+        cache.set(key, meta)
+    elif cache.ttl > 0:
+        cache.set(key, meta, expired_at=time.time() + cache.ttl)
+    return meta
+
+
+def list_did_files(client, scope, name):
+    """
+    Iterate the files of a DID, from the cache if possible.
+    The file list is only cached when the DID was already known to be closed (from its cached
+    metadata) before the listing started. A DID which is closed during the listing can have
+    more files than listed.
+
+    :returns: generator of dicts with the keys in FILE_KEYS. They're shared with the cache and must not be modified.
+    """
+    cache = get_cache()
+    key = ('files', scope, name)
+    files = cache.get(key)
+    if files is not None:
+        metrics.inc_counter('idds_rucio_cache_total', labels={'kind': 'files', 'result': 'hit'})
+        for file in files:
+            yield file
+        return
+
+    metrics.inc_counter('idds_rucio_cache_total', labels={'kind': 'files', 'result': 'miss'})
+    meta_entry = cache.get_entry(('metadata', scope, name))
+    if meta_entry is None or meta_entry[1] is not None or meta_entry[0]['is_open']:
+        # not known to be closed
+        files = None
+    else:
+        files = []
+    for did_file in iter_rucio(client, lambda c: c.list_files(scope=scope, name=name)):
+        file = dict([(k, did_file.get(k, None)) for k in FILE_KEYS])
+        if files is not None:
+            files.append(file)
+            if len(files) > cache.max_entry_size:
+                # too big to be cached
+                files = None
+        yield file
+
+    if files is not None:
+        cache.set(key, files, size=max(len(files), 1))
+
+
+class RucioClientPool(object):
+    """
+    Authenticated Rucio clients shared by the plugins and the works in a process.
+
+    Every thread gets its own client, which it keeps using, so that the authentication is only
+    done once per thread and the connections are reused. A client shouldn't be used by several
+    threads at the same time. New clients reuse the token cached by Rucio in the token file of
+    the account. A client is replaced after max_age seconds, to refresh its token and connections.
+    """
+
+    def __init__(self, max_age=3600):
+        self.max_age = int(max_age)
+        self._local = threading.local()
+
+    def create_client(self):
+        start = time.time()
+        client = Client()
+        metrics.observe('idds_rucio_client_creation_duration_seconds', time.time() - start)
+        return client
+
+    def get_client(self):
+        """
+        Get the client of the current thread.
+
+        :raises CannotAuthenticate: If the client fails to authenticate.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None or self._local.created_at + self.max_age < time.time():
+            self._local.client = None
+            client = self.create_client()
+            self._local.client = client
+            self._local.created_at = time.time()
+        return client
+
+    def release_client(self):
+        """
+        Drop the client of the current thread, for example after an authentication error.
+        A new client is created by the next get_client.
+        """
+        self._local.client = None
+
+
+_CLIENT_POOL = None
+_CLIENT_POOL_LOCK = threading.Lock()
+
+
+def get_client_pool():
+    """
+    The client pool of the process, configured in the [rucio] section: client_max_age.
+    """
+    global _CLIENT_POOL
+    if _CLIENT_POOL is None:
+        with _CLIENT_POOL_LOCK:
+            if _CLIENT_POOL is None:
+                params = {}
+                try:
+                    if config_has_option(RUCIO_SECTION, 'client_max_age'):
+                        params['max_age'] = config_get(RUCIO_SECTION, 'client_max_age')
+                except Exception:
+                    # no configuration file
+                    pass
+                _CLIENT_POOL = RucioClientPool(**params)
+    return _CLIENT_POOL
+
+
+def get_rucio_client():
+    return get_client_pool().get_client()
+
+
+def release_rucio_client():
+    get_client_pool().release_client()
+
+
+def call_rucio(client, func):
+    """
+    Call func(client). If the client fails to authenticate, e.g. its token expired, the client of
+    the thread is released and func is called once more with a new client.
+    """
+    try:
+        return func(client)
+    except CannotAuthenticate as error:
+        logging.getLogger('RucioClientPool').warning("Rucio client failed to authenticate, retry with a new client: %s" % error)
+        release_rucio_client()
+        return func(get_rucio_client())
+
+
+def iter_rucio(client, func):
+    """
+    Iterate func(client), retried with a new client like call_rucio, if it fails to authenticate
+    before the first item.
+    """
+    num_items = 0
+    try:
+        for item in func(client):
+            num_items += 1
+            yield item
+    except CannotAuthenticate as error:
+        if num_items:
+            raise
+        logging.getLogger('RucioClientPool').warning("Rucio client failed to authenticate, retry with a new client: %s" % error)
+        release_rucio_client()
+        for item in func(get_rucio_client()):
+            yield item
+
+
 class RucioPluginBase(PluginBase):
     def __init__(self, **kwargs):
         super(RucioPluginBase, self).__init__(**kwargs)
-        self.client = self.get_rucio_client()
+        # check the authentication at start
+        self.get_rucio_client()
+
+    @property
+    def client(self):
+        return self.get_rucio_client()
 
     def get_rucio_client(self):
         try:
-            client = Client()
+            client = get_rucio_client()
         except CannotAuthenticate as error:
             self.logger.error(error)
             self.logger.error(traceback.format_exc())
             raise exceptions.AgentPluginError('%s: %s' % (str(error), traceback.format_exc()))
         return client
 
+    def get_did_metadata(self, scope, name):
+        return get_did_metadata(self.client, scope, name)
+
+    def list_did_files(self, scope, name):
+        return list_did_files(self.client, scope, name)
+
     def __call__(self, **kwargs):
         return exceptions.NotImplementedException(self.get_class_name())
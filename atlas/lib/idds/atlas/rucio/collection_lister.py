@@ -18,7 +18,7 @@ import traceback
 
 from idds.common import exceptions
 from idds.common.constants import CollectionType
-from idds.atlas.rucio.base_plugin import RucioPluginBase
+from idds.atlas.rucio.base_plugin import RucioPluginBase, iter_rucio
 
 
 class CollectionLister(RucioPluginBase):
@@ -27,7 +27,7 @@ class CollectionLister(RucioPluginBase):
 
     def __call__(self, scope, name):
         try:
-            did_infos = self.client.list_dids(scope, {'name': name}, type='collection', long=True, recursive=False)
+            did_infos = iter_rucio(self.client, lambda c: c.list_dids(scope, {'name': name}, type='collection', long=True, recursive=False))
             collections = []
             for did_info in did_infos:
                 if did_info['did_type'] == 'DATASET':
@@ -28,7 +28,7 @@ class CollectionMetadataReader(RucioPluginBase):
     def __call__(self, scope, name):
         try:
             meta = {}
-            did_meta = self.client.get_metadata(scope=scope, name=name)
+            did_meta = self.get_did_metadata(scope, name)
             meta = {'bytes': did_meta['bytes'],
                     'availability': did_meta['availability'],
                     'events': did_meta['events'],
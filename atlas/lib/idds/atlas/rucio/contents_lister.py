@@ -22,20 +22,38 @@ from idds.atlas.rucio.base_plugin import RucioPluginBase
 class ContentsLister(RucioPluginBase):
     def __init__(self, **kwargs):
         super(ContentsLister, self).__init__(**kwargs)
+        if hasattr(self, 'page_size'):
+            self.page_size = int(self.page_size)
+        else:
+            self.page_size = 10000
 
-    def __call__(self, scope, name):
+    def list_pages(self, scope, name):
+        """
+        List the files of a collection in pages of at most page_size files.
+        The files are streamed from rucio, so only one page is kept in memory.
+        """
         try:
-            ret_files = []
-            files = self.client.list_files(scope=scope, name=name)
+            page = []
+            files = self.list_did_files(scope, name)
             for file in files:
                 ret_file = {'scope': file['scope'],
                             'name': file['name'],
                             'bytes': file['bytes'],
                             'events': file['events'],
                             'adler32': file['adler32']}
-                ret_files.append(ret_file)
-            return ret_files
+                page.append(ret_file)
+                if len(page) >= self.page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
         except Exception as ex:
             self.logger.error(ex)
             self.logger.error(traceback.format_exc())
             raise exceptions.AgentPluginError('%s: %s' % (str(ex), traceback.format_exc()))
+
+    def __call__(self, scope, name):
+        ret_files = []
+        for page in self.list_pages(scope, name):
+            ret_files.extend(page)
+        return ret_files
@@ -13,13 +13,216 @@
 Class of collection lister plubin
 """
 
+import logging
+import threading
+import time
 import traceback
 
-from rucio.common.exception import RuleNotFound
+from rucio.common.exception import CannotAuthenticate, RuleNotFound
 
 from idds.common import exceptions
+from idds.common import metrics
+from idds.common.config import config_has_option, config_get
 from idds.common.constants import ContentStatus
-from idds.atlas.rucio.base_plugin import RucioPluginBase
+from idds.atlas.rucio.base_plugin import RucioPluginBase, RUCIO_SECTION, call_rucio
+
+
+class BulkRulePoller(object):
+    """
+    Poll the states of many replication rules together.
+
+    When at least bulk_min_size rules are polled, the active (replicating and stuck) rules of the
+    account are listed with one call and only the rules which are not in the list are fetched one
+    by one. The listing stops when all the rules are found, or when list_max_size rules are listed,
+    so a busy account falls back to fetching the remaining rules one by one. The replica locks of a rule are only listed when its locks_ok_cnt changed since the
+    last poll, or when they were listed more than locks_refresh_period seconds ago. Otherwise the
+    OK replicas of the last listing are reused. Rules which are not polled for expire_time seconds
+    are forgotten.
+    """
+
+    ACTIVE_STATES = ('REPLICATING', 'STUCK')
+
+    def __init__(self, bulk_min_size=10, list_max_size=10000, locks_refresh_period=3600, expire_time=86400,
+                 prefetch_max_age=300, logger=None):
+        self.bulk_min_size = int(bulk_min_size)
+        self.list_max_size = int(list_max_size)
+        self.locks_refresh_period = int(locks_refresh_period)
+        self.expire_time = int(expire_time)
+        self.prefetch_max_age = int(prefetch_max_age)
+
+        # rule_id -> {'locks_ok_cnt', 'ok_replicas', 'locks_listed_at', 'polled_at'}
+        self._rules = {}
+        # rule_id -> (polled_at, result), the results polled in bulk before being used
+        self._prefetched = {}
+        self._lock = threading.Lock()
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+    def list_active_rules(self, client, rule_ids):
+        """
+        List the active rules of the account and keep the ones in rule_ids.
+
+        :returns: dict of rule_id -> rule, for the rules which are found before
+                  list_max_size rules are listed.
+        """
+        rules = {}
+        num_listed = 0
+        for state in self.ACTIVE_STATES:
+            for rule in client.list_replication_rules(filters={'account': client.account, 'state': state}):
+                num_listed += 1
+                if rule['id'] in rule_ids:
+                    rules[rule['id']] = rule
+                if len(rules) == len(rule_ids):
+                    return rules
+                if num_listed >= self.list_max_size:
+                    metrics.inc_counter('idds_rucio_rule_listings_total', labels={'result': 'too_large'})
+                    return rules
+        return rules
+
+    def get_rules(self, client, rule_ids):
+        """
+        :returns: dict of rule_id -> rule, None for the rules which are not found.
+        """
+        rules = {}
+        if len(rule_ids) >= self.bulk_min_size:
+            try:
+                rules = self.list_active_rules(client, set(rule_ids))
+            except CannotAuthenticate:
+                raise
+            except Exception as error:
+                # fall back to get the rules one by one
+                rules = {}
+                self.logger.warning("Failed to list the rules of account %s: %s" % (client.account, error))
+        metrics.inc_counter('idds_rucio_rules_total', value=len(rules), labels={'call': 'bulk'})
+
+        for rule_id in rule_ids:
+            if rule_id not in rules:
+                metrics.inc_counter('idds_rucio_rules_total', labels={'call': 'single'})
+                try:
+                    rules[rule_id] = client.get_replication_rule(rule_id=rule_id)
+                except RuleNotFound:
+                    rules[rule_id] = None
+        return rules
+
+    def get_ok_replicas(self, client, rule):
+        ok_replicas = set()
+        for lock in client.list_replica_locks(rule_id=rule['id']):
+            if lock['state'] == 'OK':
+                ok_replicas.add('%s:%s' % (lock['scope'], lock['name']))
+        return ok_replicas
+
+    def poll_rules(self, client, rule_ids):
+        """
+        Poll rules.
+
+        :param client: The rucio client.
+        :param rule_ids: list of rule ids.
+
+        :returns: dict of rule_id -> {'rule': the rule (None if it's not found),
+                                      'ok_replicas': set of 'scope:name' of the replicas with OK locks,
+                                      'new_ok_replicas': the OK replicas which were not OK in the last poll,
+                                      'locks_listed': whether the replica locks are listed in this poll}.
+        """
+        rule_ids = list(set(rule_ids))
+        return call_rucio(client, lambda c: self.poll_rules_with_client(c, rule_ids))
+
+    def poll_rules_with_client(self, client, rule_ids):
+        rules = self.get_rules(client, rule_ids)
+
+        ret = {}
+        now = time.time()
+        for rule_id in rule_ids:
+            rule = rules[rule_id]
+            with self._lock:
+                known = self._rules.get(rule_id, None)
+            if rule is None:
+                with self._lock:
+                    self._rules.pop(rule_id, None)
+                ret[rule_id] = {'rule': None, 'ok_replicas': set(), 'new_ok_replicas': set(), 'locks_listed': False}
+                continue
+
+            old_ok_replicas = known['ok_replicas'] if known else set()
+            locks_listed = False
+            if rule['locks_ok_cnt'] <= 0:
+                ok_replicas = set()
+            elif (known is None or known['locks_ok_cnt'] != rule['locks_ok_cnt'] or known['locks_listed_at'] + self.locks_refresh_period < now):
+                ok_replicas = self.get_ok_replicas(client, rule)
+                locks_listed = True
+            else:
+                ok_replicas = old_ok_replicas
+            metrics.inc_counter('idds_rucio_rule_locks_total', labels={'listed': str(locks_listed)})
+
+            with self._lock:
+                self._rules[rule_id] = {'locks_ok_cnt': rule['locks_ok_cnt'],
+                                        'ok_replicas': ok_replicas,
+                                        'locks_listed_at': now if locks_listed or known is None else known['locks_listed_at'],
+                                        'polled_at': now}
+            ret[rule_id] = {'rule': rule,
+                            'ok_replicas': ok_replicas,
+                            'new_ok_replicas': ok_replicas - old_ok_replicas,
+                            'locks_listed': locks_listed}
+
+        self.expire_rules()
+        return ret
+
+    def expire_rules(self):
+        now = time.time()
+        with self._lock:
+            for rule_id in [rule_id for rule_id, known in self._rules.items() if known['polled_at'] + self.expire_time < now]:
+                del self._rules[rule_id]
+            for rule_id in [rule_id for rule_id, (polled_at, result) in self._prefetched.items() if polled_at + self.prefetch_max_age < now]:
+                del self._prefetched[rule_id]
+
+    def prefetch_rules(self, client, rule_ids):
+        """
+        Poll rules in bulk and keep the results for get_rule, for example before processing
+        many processings one by one.
+        """
+        results = self.poll_rules(client, rule_ids)
+        now = time.time()
+        with self._lock:
+            for rule_id, result in results.items():
+                self._prefetched[rule_id] = (now, result)
+
+    def get_rule(self, client, rule_id):
+        """
+        Get the result of a rule (see poll_rules), prefetched if it's prefetched less than
+        prefetch_max_age seconds ago, otherwise polled now.
+        """
+        with self._lock:
+            prefetched = self._prefetched.pop(rule_id, None)
+        if prefetched is not None and prefetched[0] + self.prefetch_max_age >= time.time():
+            return prefetched[1]
+        return self.poll_rules(client, [rule_id])[rule_id]
+
+
+_RULE_POLLER = None
+_RULE_POLLER_LOCK = threading.Lock()
+
+
+def get_rule_poller():
+    """
+    The bulk rule poller of the process, configured in the [rucio] section:
+    rule_bulk_min_size, rule_list_max_size, rule_locks_refresh_period, rule_expire_time and
+    rule_prefetch_max_age.
+    """
+    global _RULE_POLLER
+    if _RULE_POLLER is None:
+        with _RULE_POLLER_LOCK:
+            if _RULE_POLLER is None:
+                params = {}
+                for option, param in [('rule_bulk_min_size', 'bulk_min_size'),
+                                      ('rule_list_max_size', 'list_max_size'),
+                                      ('rule_locks_refresh_period', 'locks_refresh_period'),
+                                      ('rule_expire_time', 'expire_time'),
+                                      ('rule_prefetch_max_age', 'prefetch_max_age')]:
+                    try:
+                        if config_has_option(RUCIO_SECTION, option):
+                            params[param] = config_get(RUCIO_SECTION, option)
+                    except Exception:
+                        # no configuration file
+                        pass
+                _RULE_POLLER = BulkRulePoller(**params)
+    return _RULE_POLLER
 
 
 class RulePoller(RucioPluginBase):
@@ -31,22 +234,26 @@ class RulePoller(RucioPluginBase):
             return ContentStatus.Available
         return ContentStatus.New
 
-    def __call__(self, rule_id):
+    def get_replicas_status(self, result):
+        return dict([(scope_name, ContentStatus.Available) for scope_name in result['ok_replicas']])
+
+    def poll_rules(self, rule_ids):
+        """
+        Poll rules in bulk.
+
+        :returns: dict of rule_id -> (rule, replicases_status). The rule is None if it's not found.
+        """
         try:
-            rule = self.client.get_replication_rule(rule_id=rule_id)
-            # rule['state']
-
-            replicases_status = {}
-            if rule['locks_ok_cnt'] > 0:
-                locks = self.client.list_replica_locks(rule_id=rule_id)
-                for lock in locks:
-                    scope_name = '%s:%s' % (lock['scope'], lock['name'])
-                    replicases_status[scope_name] = self.get_state(lock['state'])
-            return rule, replicases_status
-        except RuleNotFound as ex:
-            msg = "rule(%s) not found: %s" % (str(rule_id), str(ex))
-            raise exceptions.ProcessNotFound(msg)
+            results = get_rule_poller().poll_rules(self.client, rule_ids)
+            return dict([(rule_id, (result['rule'], self.get_replicas_status(result))) for rule_id, result in results.items()])
         except Exception as ex:
             self.logger.error(ex)
             self.logger.error(traceback.format_exc())
             raise exceptions.AgentPluginError('%s: %s' % (str(ex), traceback.format_exc()))
+
+    def __call__(self, rule_id):
+        rule, replicases_status = self.poll_rules([rule_id])[rule_id]
+        if rule is None:
+            msg = "rule(%s) not found" % str(rule_id)
+            raise exceptions.ProcessNotFound(msg)
+        return rule, replicases_status
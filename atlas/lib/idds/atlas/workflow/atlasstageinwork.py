@@ -12,14 +12,14 @@ import copy
 import traceback
 import uuid
 
-from rucio.client.client import Client as RucioClient
 from rucio.common.exception import (CannotAuthenticate as RucioCannotAuthenticate,
-                                    DuplicateRule as RucioDuplicateRule,
-                                    RuleNotFound as RucioRuleNotFound)
+                                    DuplicateRule as RucioDuplicateRule)
 
 from idds.common import exceptions
 from idds.common.constants import (TransformType, CollectionStatus, ContentStatus, ContentType,
                                    ProcessingStatus, WorkStatus)
+from idds.atlas.rucio.base_plugin import get_did_metadata, get_rucio_client, list_did_files
+from idds.atlas.rucio.rule_poller import get_rule_poller
 from idds.workflow.work import Work
 
 
@@ -67,7 +67,7 @@ class ATLASStageinWork(Work):
 
     def get_rucio_client(self):
         try:
-            client = RucioClient()
+            client = get_rucio_client()
         except RucioCannotAuthenticate as error:
             self.logger.error(error)
             self.logger.error(traceback.format_exc())
@@ -80,7 +80,7 @@ class ATLASStageinWork(Work):
                 return coll
             else:
                 meta = {}
-                did_meta = self.client.get_metadata(scope=coll['scope'], name=coll['name'])
+                did_meta = get_did_metadata(self.get_rucio_client(), coll['scope'], coll['name'])
                 meta = {'scope': coll['scope'],
                         'name': coll['name'],
                         'coll_metadata': {
@@ -115,8 +115,8 @@ class ATLASStageinWork(Work):
         try:
             ret_files = []
             rucio_client = self.get_rucio_client()
-            files = rucio_client.list_files(scope=self.collections[self.primary_input_collection]['scope'],
-                                            name=self.collections[self.primary_input_collection]['name'])
+            files = list_did_files(rucio_client, self.collections[self.primary_input_collection]['scope'],
+                                   self.collections[self.primary_input_collection]['name'])
             for file in files:
                 ret_file = {'coll_id': self.collections[self.primary_input_collection]['coll_id'],
                             'scope': file['scope'],
@@ -196,6 +196,7 @@ class ATLASStageinWork(Work):
                                         'rule_id': self.rule_id}}
         self.add_processing_to_processings(proc)
         self.active_processings.append(proc['processing_metadata']['internal_id'])
+        return proc
 
     def create_rule(self):
         try:
@@ -234,27 +235,37 @@ class ATLASStageinWork(Work):
                 rule_id = self.create_rule()
                 p['processing_metadata']['rule_id'] = rule_id
 
-    def poll_rule(self):
-        try:
+    def get_rule_id(self):
+        if self.active_processings:
             p = self.processings[self.active_processings[0]]
-            rule_id = p['processing_metadata']['rule_id']
+            return p['processing_metadata'].get('rule_id', None)
+        return None
 
-            rucio_client = self.get_rucio_client()
-            rule = rucio_client.get_replication_rule(rule_id=rule_id)
-            # rule['state']
-
-            replicases_status = {}
-            if rule['locks_ok_cnt'] > 0:
-                locks = rucio_client.list_replica_locks(rule_id=rule_id)
-                for lock in locks:
-                    scope_name = '%s:%s' % (lock['scope'], lock['name'])
-                    if lock['state'] == 'OK':
-                        replicases_status[scope_name] = ContentStatus.Available   # 'OK'
-            return p, rule['state'], replicases_status
-        except RucioRuleNotFound as ex:
-            msg = "rule(%s) not found: %s" % (str(rule_id), str(ex))
+    @classmethod
+    def prefetch_processings(cls, works):
+        """
+        Poll the rules of many works in bulk, before their processings are polled one by one.
+        """
+        rule_ids = [work.get_rule_id() for work in works]
+        rule_ids = [rule_id for rule_id in rule_ids if rule_id]
+        if rule_ids:
+            get_rule_poller().prefetch_rules(get_rucio_client(), rule_ids)
+
+    def poll_rule(self):
+        p = self.processings[self.active_processings[0]]
+        rule_id = p['processing_metadata']['rule_id']
+
+        result = get_rule_poller().get_rule(self.get_rucio_client(), rule_id)
+        rule = result['rule']
+        if rule is None:
+            msg = "rule(%s) not found" % str(rule_id)
             raise exceptions.ProcessNotFound(msg)
 
+        replicases_status = {}
+        for scope_name in result['ok_replicas']:
+            replicases_status[scope_name] = ContentStatus.Available   # 'OK'
+        return p, rule['state'], replicases_status
+
     def poll_processing(self):
         return self.poll_rule()
 
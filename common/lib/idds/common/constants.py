@@ -28,6 +28,7 @@ class Sections:
     Transporter = 'transporter'
     Carrier = 'carrier'
     Conductor = 'conductor'
+    Metrics = 'metrics'
 
 
 class HTTP_STATUS_CODE:
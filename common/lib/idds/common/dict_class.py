@@ -15,6 +15,10 @@ Dict class.
 from enum import Enum
 
 
+# (module name, class name) -> class
+_class_cache = {}
+
+
 class DictClass(object):
     def to_dict_l(self, d):
         # print('to_dict_l')
@@ -56,10 +60,19 @@ class DictClass(object):
             return True
         return False
 
+    @staticmethod
+    def load_class(module_name, class_name):
+        key = (module_name, class_name)
+        cls = _class_cache.get(key, None)
+        if cls is None:
+            module = __import__(module_name, fromlist=[None])
+            cls = getattr(module, class_name)
+            _class_cache[key] = cls
+        return cls
+
     @staticmethod
     def load_instance(d):
-        module = __import__(d['module'], fromlist=[None])
-        cls = getattr(module, d['class'])
+        cls = DictClass.load_class(d['module'], d['class'])
         if issubclass(cls, Enum):
             impl = cls(d['attributes']['_value_'])
         else:
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+"""
+Metrics (counters, gauges and histograms) of the iDDS services.
+
+The metrics are disabled by default. When they are disabled, inc_counter, set_gauge
+and observe return immediately without touching the registry, so the instrumented
+code paths only pay one function call.
+
+When enabled, the metrics can be exported in the Prometheus text format with
+an http endpoint (start_http_server) or dumped periodically to a file
+(MetricsExporter), for example for the node_exporter textfile collector.
+"""
+
+import os
+import threading
+import time
+
+try:
+    # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for key, value in items)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    The base class of the metrics. The values are kept per label set.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation=''):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(labels):
+        if not labels:
+            return tuple()
+        return tuple(sorted(labels.items()))
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def get_samples(self):
+        """
+        :returns: list of (suffix, labels, extra label, value).
+        """
+        raise NotImplementedError
+
+    def to_prometheus_text(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        for suffix, labels, extra, value in self.get_samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(labels, extra), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, value=1, labels=None):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, labels=None):
+        return self._values.get(self.get_key(labels), 0)
+
+    def get_samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, labels=None):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value=1, labels=None):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, labels=None):
+        return self._values.get(self.get_key(labels), 0)
+
+    def get_samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation='', buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=None):
+        key = self.get_key(labels)
+        with self._lock:
+            if key not in self._values:
+                # [bucket counts (not cumulative), sum, count]
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            state = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def get(self, labels=None):
+        """
+        :returns: (sum, count).
+        """
+        state = self._values.get(self.get_key(labels), None)
+        if state is None:
+            return 0, 0
+        return state[1], state[2]
+
+    def get_samples(self):
+        samples = []
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', key, ('le', format_value(bound)), cumulative))
+                samples.append(('_bucket', key, ('le', '+Inf'), count))
+                samples.append(('_sum', key, None, total))
+                samples.append(('_count', key, None, count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Registry of the metrics, by name.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def get_metric(self, cls, name, documentation='', **kwargs):
+        metric = self._metrics.get(name, None)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name, None)
+                if metric is None:
+                    metric = cls(name, documentation, **kwargs)
+                    self._metrics[name] = metric
+        return metric
+
+    def counter(self, name, documentation=''):
+        return self.get_metric(Counter, name, documentation)
+
+    def gauge(self, name, documentation=''):
+        return self.get_metric(Gauge, name, documentation)
+
+    def histogram(self, name, documentation='', buckets=DEFAULT_BUCKETS):
+        return self.get_metric(Histogram, name, documentation, buckets=buckets)
+
+    def get_metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics.keys())]
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def to_prometheus_text(self):
+        text = '\n'.join(metric.to_prometheus_text() for metric in self.get_metrics())
+        return text + '\n' if text else text
+
+    def dump(self, path):
+        """
+        Write the metrics in the Prometheus text format to a file.
+        The file is replaced atomically, so readers never see a partial file.
+        """
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus_text())
+        os.rename(tmp_path, path)
+
+
+_REGISTRY = MetricsRegistry()
+_ENABLED = False
+
+
+def get_registry():
+    return _REGISTRY
+
+
+def is_enabled():
+    return _ENABLED
+
+
+def enable():
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    global _ENABLED
+    _ENABLED = False
+
+
+def inc_counter(name, value=1, labels=None, documentation=''):
+    if not _ENABLED:
+        return
+    _REGISTRY.counter(name, documentation).inc(value, labels)
+
+
+def set_gauge(name, value, labels=None, documentation=''):
+    if not _ENABLED:
+        return
+    _REGISTRY.gauge(name, documentation).set(value, labels)
+
+
+def observe(name, value, labels=None, documentation='', buckets=DEFAULT_BUCKETS):
+    if not _ENABLED:
+        return
+    _REGISTRY.histogram(name, documentation, buckets).observe(value, labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        output = _REGISTRY.to_prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        # don't log every scrape
+        return
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, addr=''):
+    """
+    Start an http server in a daemon thread which exports the metrics in the Prometheus text format.
+
+    :param port: The port to listen on.
+    :param addr: The address to bind, all addresses by default.
+
+    :returns: the http server.
+    """
+    server = ThreadingHTTPServer((addr, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='MetricsHTTPServer')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Dump the metrics to a file periodically.
+    """
+
+    def __init__(self, path, period=60, logger=None):
+        super(MetricsExporter, self).__init__(name='MetricsExporter')
+        self.daemon = True
+        self.path = path
+        self.period = int(period)
+        self.logger = logger
+        self.graceful_stop = threading.Event()
+
+    def stop(self):
+        self.graceful_stop.set()
+
+    def dump(self):
+        try:
+            _REGISTRY.dump(self.path)
+        except Exception as error:
+            if self.logger:
+                self.logger.error("Failed to dump metrics to %s: %s" % (self.path, error))
+
+    def run(self):
+        while not self.graceful_stop.is_set():
+            start = time.time()
+            self.dump()
+            self.graceful_stop.wait(max(self.period - (time.time() - start), 0))
+        # the last values before stopping
+        self.dump()
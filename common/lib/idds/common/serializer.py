@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+"""
+Serializer for the Work/Workflow objects stored in the json metadata columns.
+
+Compared to DictClass.to_dict/from_dict, an object is encoded as
+    {'$c': 'module:Class', '$v': <version>, '$a': {<attributes>}}
+and an enum as
+    {'$e': 'module:Class', '$x': <value>}
+The encoding is done by the json (or msgpack) encoder through a 'default' hook and the
+decoding through an 'object_hook', so every node is visited only once. The classes are
+resolved once and cached. The old DictClass format is still accepted when loading.
+"""
+
+import copy
+import json
+
+from enum import Enum
+
+from idds.common import exceptions
+from idds.common.dict_class import DictClass
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SERIALIZER_VERSION = 1
+
+CLASS_KEY = '$c'
+VERSION_KEY = '$v'
+ATTRIBUTES_KEY = '$a'
+ENUM_KEY = '$e'
+VALUE_KEY = '$x'
+
+# attributes which are not serialized. They are rebuilt when loading.
+EXCLUDED_ATTRIBUTES = ['logger']
+
+
+class ClassSchema(object):
+    """
+    What the serializer needs to know about a class, resolved once per class.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.path = '%s:%s' % (cls.__module__, cls.__name__)
+        self.is_enum = issubclass(cls, Enum)
+        self.has_setup_logger = callable(getattr(cls, 'setup_logger', None))
+        self._defaults = None
+
+    def get_defaults(self):
+        """
+        The attributes of a new instance, which are used for the attributes missing in the
+        stored objects (e.g. objects stored before an attribute was added to the class).
+        """
+        if self._defaults is None:
+            defaults = {}
+            if not self.is_enum:
+                try:
+                    impl = self.cls()
+                    defaults = dict([(key, value) for key, value in impl.__dict__.items()
+                                     if not key.startswith('__') and key not in EXCLUDED_ATTRIBUTES])
+                except TypeError:
+                    # the class cannot be created without arguments
+                    pass
+            self._defaults = defaults
+        return self._defaults
+
+
+# class -> ClassSchema
+_schemas = {}
+# 'module:Class' -> ClassSchema
+_schemas_by_path = {}
+
+
+def get_schema(cls):
+    schema = _schemas.get(cls, None)
+    if schema is None:
+        schema = ClassSchema(cls)
+        _schemas[cls] = schema
+        _schemas_by_path[schema.path] = schema
+    return schema
+
+
+def get_schema_by_path(path):
+    schema = _schemas_by_path.get(path, None)
+    if schema is None:
+        module_name, class_name = path.split(':')
+        schema = get_schema(DictClass.load_class(module_name, class_name))
+        _schemas_by_path[path] = schema
+    return schema
+
+
+def encode_object(obj):
+    """
+    'default' hook of the encoder. Objects which are not supported by json/msgpack are converted here.
+    """
+    if isinstance(obj, Enum):
+        return {ENUM_KEY: get_schema(obj.__class__).path, VALUE_KEY: obj.value}
+    elif isinstance(obj, DictClass):
+        attributes = {}
+        for key, value in obj.__dict__.items():
+            if not key.startswith('__') and key not in EXCLUDED_ATTRIBUTES:
+                attributes[key] = value
+        return {CLASS_KEY: get_schema(obj.__class__).path,
+                VERSION_KEY: SERIALIZER_VERSION,
+                ATTRIBUTES_KEY: attributes}
+    elif isinstance(obj, LazyJSON):
+        return obj.value
+    raise TypeError("Object of type %s is not serializable" % obj.__class__.__name__)
+
+
+def decode_object(d):
+    """
+    'object_hook' of the decoder. Both the current format and the DictClass format are accepted.
+    """
+    if CLASS_KEY in d and ATTRIBUTES_KEY in d:
+        version = d.get(VERSION_KEY, SERIALIZER_VERSION)
+        if version > SERIALIZER_VERSION:
+            raise exceptions.IDDSException("Serializer version %s of %s is not supported (current version: %s)" %
+                                           (version, d[CLASS_KEY], SERIALIZER_VERSION))
+        schema = get_schema_by_path(d[CLASS_KEY])
+        attributes = d[ATTRIBUTES_KEY]
+        impl = schema.cls.__new__(schema.cls)
+        for key, value in schema.get_defaults().items():
+            if key not in attributes:
+                impl.__dict__[key] = copy.deepcopy(value)
+        impl.__dict__.update(attributes)
+        if schema.has_setup_logger:
+            impl.setup_logger()
+        return impl
+    elif ENUM_KEY in d and VALUE_KEY in d:
+        return get_schema_by_path(d[ENUM_KEY]).cls(d[VALUE_KEY])
+    elif DictClass.is_class(d):
+        return DictClass.from_dict(d)
+    return d
+
+
+def has_msgpack():
+    return msgpack is not None
+
+
+def dumps(obj, binary=False):
+    """
+    Serialize an object.
+
+    :param obj: The object, which can include Work/Workflow objects and enums.
+    :param binary: If True, encode with msgpack to bytes. Otherwise encode with json to a string.
+
+    :raises NotImplementedException: If binary is True but msgpack is not installed.
+
+    :returns: the json string, or the msgpack bytes.
+    """
+    if binary:
+        if msgpack is None:
+            raise exceptions.NotImplementedException("msgpack is not installed")
+        return msgpack.packb(obj, default=encode_object, use_bin_type=True)
+    return json.dumps(obj, default=encode_object)
+
+
+def loads(data):
+    """
+    Deserialize an object from a json string or from msgpack bytes.
+
+    :param data: The json string or the msgpack bytes.
+
+    :raises NotImplementedException: If data is bytes but msgpack is not installed.
+
+    :returns: the object.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        if msgpack is None:
+            raise exceptions.NotImplementedException("msgpack is not installed")
+        return msgpack.unpackb(data, object_hook=decode_object, raw=False, strict_map_key=False)
+    return json.loads(data, object_hook=decode_object)
+
+
+class LazyJSON(object):
+    """
+    Proxy of a json string which is only decoded when it's accessed.
+
+    It behaves like the decoded dict for reading and updating. If it's never decoded,
+    the original string is written back as it is when it's stored again.
+    """
+
+    def __init__(self, text):
+        self._text = text
+        self._decoded = False
+        self._value = None
+
+    @property
+    def is_decoded(self):
+        return self._decoded
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def value(self):
+        if not self._decoded:
+            self._value = loads(self._text)
+            self._decoded = True
+            self._text = None
+        return self._value
+
+    def dumps(self):
+        if not self._decoded:
+            return self._text
+        return dumps(self._value)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __setitem__(self, key, value):
+        self.value[key] = value
+
+    def __delitem__(self, key):
+        del self.value[key]
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        if not self._decoded:
+            return 'LazyJSON(%s)' % self._text
+        return repr(self._value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def get(self, key, default=None):
+        return self.value.get(key, default)
+
+    def keys(self):
+        return self.value.keys()
+
+    def values(self):
+        return self.value.values()
+
+    def items(self):
+        return self.value.items()
+
+    def update(self, *args, **kwargs):
+        return self.value.update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        return self.value.setdefault(key, default)
+
+    def pop(self, key, *args):
+        return self.value.pop(key, *args)
+
+    def copy(self):
+        return self.value.copy()
@@ -29,6 +29,7 @@ from idds.common.constants import (IDDSEnum, RequestType, RequestStatus,
                                    ContentType, ContentStatus,
                                    GranularityType, ProcessingStatus)
 from idds.common.dict_class import DictClass
+from idds.common.serializer import LazyJSON, decode_object
 
 
 # RFC 1123
@@ -336,6 +337,8 @@ class DictClassEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, IDDSEnum) or isinstance(obj, DictClass):
             return obj.to_dict()
+        elif isinstance(obj, LazyJSON):
+            return obj.value
         # elif isinstance(obj, datetime.datetime):
         #     return date_to_str(obj)
         # elif isinstance(obj, (datetime.time, datetime.date)):
@@ -348,9 +351,7 @@ class DictClassEncoder(json.JSONEncoder):
 
 
 def as_has_dict(dct):
-    if DictClass.is_class(dct):
-        return DictClass.from_dict(dct)
-    return dct
+    return decode_object(dct)
 
 
 def json_dumps(obj):
@@ -8,6 +8,7 @@ DROP SEQUENCE CONTENT_ID_SEQ;
 
 
 DROP table MESSAGES purge;
+DROP table COLLECTION_COUNTERS purge;
 DROP table CONTENTS purge;
 DROP table REQ2WORKLOAD purge;
 DROP table REQ2TRANSFORMS purge;
@@ -295,6 +296,18 @@ CREATE INDEX COLLECTIONS_TRANSFORM_IDX ON COLLECTIONS(transform_id, coll_id);
 CREATE INDEX COLLECTIONS_STATUS_UPDATED_IDX ON COLLECTIONS (status, locking, updated_at, next_poll_at, created_at) LOCAL;
 
 
+--- collection counters
+CREATE TABLE COLLECTION_COUNTERS
+(
+    coll_id NUMBER(14) constraint COLL_COUNTERS_COLL_ID_NN NOT NULL,
+    status NUMBER(2) constraint COLL_COUNTERS_STATUS_NN NOT NULL,
+    num_files NUMBER(10) DEFAULT 0,
+    updated_at DATE DEFAULT SYS_EXTRACT_UTC(systimestamp(0)),
+    CONSTRAINT COLL_COUNTERS_PK PRIMARY KEY (coll_id, status),
+    CONSTRAINT COLL_COUNTERS_COLL_ID_FK FOREIGN KEY(coll_id) REFERENCES COLLECTIONS(coll_id)
+);
+
+
 --- contents
 CREATE SEQUENCE CONTENT_ID_SEQ MINVALUE 1 INCREMENT BY 1 NOORDER CACHE 10 NOCYCLE;
 CREATE TABLE CONTENTS
@@ -351,6 +364,9 @@ CREATE OR REPLACE TRIGGER TRIG_CONTENT_ID
 
 
 CREATE INDEX CONTENTS_STATUS_UPDATED_IDX ON CONTENTS (status, locking, updated_at, created_at) LOCAL;
+CREATE INDEX CONTENTS_TRANSFORM_MAP_IDX ON CONTENTS (transform_id, map_id) LOCAL;
+CREATE INDEX CONTENTS_TRANSFORM_UPDATED_IDX ON CONTENTS (transform_id, updated_at) LOCAL;
+CREATE INDEX CONTENTS_COLL_NAME_IDX ON CONTENTS (coll_id, name, scope, min_id, max_id, status) LOCAL;
 
 
 --- messages
@@ -371,6 +387,8 @@ CREATE TABLE MESSAGES
     CONSTRAINT MESSAGES_PK PRIMARY KEY (msg_id) -- USING INDEX LOCAL,  
 );
 
+CREATE INDEX MESSAGES_TRANSFORM_IDX ON MESSAGES (transform_id, msg_type, status, created_at);
+
 CREATE OR REPLACE TRIGGER TRIG_MESSAGE_ID
     BEFORE INSERT
     ON MESSAGES
@@ -12,15 +12,14 @@ import datetime
 import traceback
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
 from idds.common.constants import (Sections, ProcessingStatus, ProcessingLocking)
 from idds.common.utils import setup_logging
-from idds.core import (transforms as core_transforms,
-                       processings as core_processings)
+from idds.core import processings as core_processings
 from idds.agents.common.baseagent import BaseAgent
 
 setup_logging(__name__)
@@ -32,12 +31,14 @@ class Carrier(BaseAgent):
     """
 
     def __init__(self, num_threads=1, poll_time_period=10, retrieve_bulk_size=None,
-                 message_bulk_size=1000, **kwargs):
+                 message_bulk_size=1000, poll_bulk_size=100, **kwargs):
         super(Carrier, self).__init__(num_threads=num_threads, **kwargs)
         self.config_section = Sections.Carrier
         self.poll_time_period = int(poll_time_period)
         self.retrieve_bulk_size = int(retrieve_bulk_size)
         self.message_bulk_size = int(message_bulk_size)
+        # max number of running processings which are polled together
+        self.poll_bulk_size = int(poll_bulk_size)
 
         self.new_task_queue = Queue()
         self.new_output_queue = Queue()
@@ -54,6 +55,9 @@ class Carrier(BaseAgent):
         Get new processing
         """
         processing_status = [ProcessingStatus.New]
+        # check the ids first, so an idle poll doesn't lock and load the processing metadata
+        if not core_processings.get_processings_by_status(status=processing_status, bulk_size=1, columns=['processing_id']):
+            return []
         processings = core_processings.get_processings_by_status(status=processing_status, locking=True, bulk_size=self.retrieve_bulk_size)
 
         self.logger.debug("Main thread get %s [new] processings to process" % len(processings))
@@ -73,34 +77,45 @@ class Carrier(BaseAgent):
         ret = []
         while not self.new_task_queue.empty():
             try:
-                processing = self.new_task_queue.get()
+                processing = self.new_task_queue.get(block=False)
                 if processing:
                     self.logger.info("Main thread processing new processing: %s" % processing)
                     ret_processing = self.process_new_processing(processing)
                     if ret_processing:
                         ret.append(ret_processing)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
         return ret
 
+    def get_new_processing_update(self, processing):
+        self.logger.info("Main thread submitted new processing: %s" % (processing['processing_id']))
+        parameters = dict(processing)
+        if 'next_poll_at' not in parameters:
+            parameters['next_poll_at'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.poll_time_period)
+        parameters['locking'] = ProcessingLocking.Idle
+        return parameters
+
+    def update_processing(self, parameters):
+        parameters = dict(parameters)
+        processing_id = parameters.pop('processing_id')
+        core_processings.update_processing(processing_id=processing_id, parameters=parameters)
+
     def finish_new_processings(self):
         while not self.new_output_queue.empty():
-            processing = self.new_output_queue.get()
-            self.logger.info("Main thread submitted new processing: %s" % (processing['processing_id']))
-            processing_id = processing['processing_id']
-            if 'next_poll_at' not in processing:
-                processing['next_poll_at'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.poll_time_period)
-            del processing['processing_id']
-            processing['locking'] = ProcessingLocking.Idle
-            # self.logger.debug("wen: %s" % str(processing))
-            core_processings.update_processing(processing_id=processing_id, parameters=processing)
+            processings = self.get_queue_items(self.new_output_queue, self.finish_bulk_size)
+            parameters = [self.get_new_processing_update(processing) for processing in processings]
+            self.finish_in_bulk(parameters, core_processings.update_processings, self.update_processing)
 
     def get_running_processings(self):
         """
         Get running processing
         """
         processing_status = [ProcessingStatus.Submitting, ProcessingStatus.Submitted, ProcessingStatus.Running, ProcessingStatus.FinishedOnExec]
+        if not core_processings.get_processings_by_status(status=processing_status, bulk_size=1, columns=['processing_id']):
+            return []
         processings = core_processings.get_processings_by_status(status=processing_status,
                                                                  # time_period=self.poll_time_period,
                                                                  locking=True,
@@ -112,8 +127,11 @@ class Carrier(BaseAgent):
 
     def process_running_processing(self, processing):
         transform_id = processing['transform_id']
-        input_output_maps = core_transforms.get_transform_input_output_maps(transform_id)
+        input_output_maps = self.get_transform_input_output_maps(transform_id)
         work = processing['processing_metadata']['work']
+        # the work is stored with the processing before the processing_id is known
+        if 'internal_id' in processing['processing_metadata']:
+            work.set_processing_id(processing, processing['processing_id'])
         # outputs = work.poll_processing()
         processing_update, content_updates = work.poll_processing_updates(input_output_maps)
 
@@ -127,31 +145,62 @@ class Carrier(BaseAgent):
                'content_updates': content_updates}
         return ret
 
+    def prefetch_running_processings(self, processings):
+        """
+        Let the works which support it (prefetch_processings) poll the processings of the same
+        work class in bulk, before the processings are processed one by one.
+        """
+        works = {}
+        for processing in processings:
+            try:
+                work = processing['processing_metadata']['work']
+            except Exception as ex:
+                # the processing fails and is logged when it's processed
+                self.logger.warning("Failed to get the work of processing %s: %s" % (processing.get('processing_id', None), ex))
+                continue
+            if hasattr(work, 'prefetch_processings'):
+                if type(work) not in works:
+                    works[type(work)] = []
+                works[type(work)].append(work)
+
+        for work_class in works:
+            try:
+                work_class.prefetch_processings(works[work_class])
+            except Exception as ex:
+                # the processings are polled one by one
+                self.logger.warning("Failed to prefetch %s %s processings: %s" % (len(works[work_class]), work_class.__name__, ex))
+
     def process_running_processings(self):
         ret = []
         while not self.running_task_queue.empty():
-            try:
-                processing = self.running_task_queue.get()
-                if processing:
+            processings = self.get_queue_items(self.running_task_queue, self.poll_bulk_size)
+            processings = [processing for processing in processings if processing]
+            self.prefetch_running_processings(processings)
+            for processing in processings:
+                try:
                     self.logger.info("Main thread processing running processing: %s" % processing)
                     ret_processing = self.process_running_processing(processing)
                     if ret_processing:
                         ret.append(ret_processing)
-            except Exception as ex:
-                self.logger.error(ex)
-                self.logger.error(traceback.format_exc())
+                except Exception as ex:
+                    self.logger.error(ex)
+                    self.logger.error(traceback.format_exc())
         return ret
 
+    def update_processing_contents(self, processing):
+        core_processings.update_processing_contents(processing_update=processing['processing_update'],
+                                                    content_updates=processing['content_updates'])
+
     def finish_running_processings(self):
         while not self.running_output_queue.empty():
-            processing = self.running_output_queue.get()
-            if processing:
-                self.logger.info("Main thread processing(processing_id: %s) status changed to %s" % (processing['processing_updates']['processing_id'],
-                                                                                                     processing['processing_updates']['parameters']['status']))
+            processings = self.get_queue_items(self.running_output_queue, self.finish_bulk_size)
+            processings = [processing for processing in processings if processing]
+            for processing in processings:
+                self.logger.info("Main thread processing(processing_id: %s) status changed to %s" % (processing['processing_update']['processing_id'],
+                                                                                                     processing['processing_update']['parameters'].get('status', None)))
 
                 self.logger.info("Main thread finishing running processing %s" % str(processing))
-                core_processings.update_processing_contents(processing_update=processing['processing_update'],
-                                                            content_updates=processing['content_updates'])
+            self.finish_in_bulk(processings, core_processings.update_processings_contents, self.update_processing_contents)
 
     def clean_locks(self):
         self.logger.info("clean locking")
@@ -169,16 +218,19 @@ class Carrier(BaseAgent):
 
             task = self.create_task(task_func=self.get_new_processings, task_output_queue=self.new_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_new_processings, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_new_processings, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_new_processings, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_new_processings, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1, task_input_queue=self.new_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.get_running_processings, task_output_queue=self.running_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_running_processings, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_running_processings, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_running_processings, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_running_processings, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.clean_locks, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1800, priority=1)
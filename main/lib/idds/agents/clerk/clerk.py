@@ -11,10 +11,10 @@
 import traceback
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
 from idds.common.constants import (Sections, RequestStatus, RequestLocking,
                                    WorkprogressStatus)
@@ -51,6 +51,9 @@ class Clerk(BaseAgent):
         # self.logger.info("Main thread get %s TransformingOpen requests to process" % len(reqs_open))
 
         req_status = [RequestStatus.New, RequestStatus.Extend]
+        # check without the metadata first, so an idle poll doesn't lock and load the workflows
+        if not core_requests.get_requests_by_status_type(status=req_status, bulk_size=1, with_metadata=False):
+            return []
         reqs_new = core_requests.get_requests_by_status_type(status=req_status, locking=True,
                                                              bulk_size=self.retrieve_bulk_size)
 
@@ -108,12 +111,14 @@ class Clerk(BaseAgent):
         ret = []
         while not self.new_task_queue.empty():
             try:
-                req = self.new_task_queue.get()
+                req = self.new_task_queue.get(block=False)
                 if req:
                     self.logger.info("Main thread processing new requst: %s" % req)
                     ret_req = self.process_new_request(req)
                     if ret_req:
                         ret.append(ret_req)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
@@ -150,6 +155,9 @@ class Clerk(BaseAgent):
         Get running requests
         """
         req_status = [RequestStatus.Transforming]
+        if not core_requests.get_requests_by_status_type(status=req_status, time_period=self.poll_time_period,
+                                                         bulk_size=1, with_metadata=False):
+            return []
         reqs = core_requests.get_requests_by_status_type(status=req_status, time_period=self.poll_time_period,
                                                          locking=True, bulk_size=self.retrieve_bulk_size)
 
@@ -208,26 +216,37 @@ class Clerk(BaseAgent):
         ret = []
         while not self.running_task_queue.empty():
             try:
-                req = self.running_task_queue.get()
+                req = self.running_task_queue.get(block=False)
                 if req:
                     self.logger.info("Main thread processing running requst: %s" % req)
                     ret_req = self.process_running_request(req)
                     if ret_req:
                         ret.append(ret_req)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
         return ret
 
+    def get_running_request_update(self, req):
+        self.logger.info("finish_running_requests: req: %s" % req)
+        parameter = {'request_id': req['request_id'], 'locking': RequestLocking.Idle}
+        for key in ['status', 'errors', 'request_metadata', 'processing_metadata']:
+            if key in req:
+                parameter[key] = req[key]
+        return parameter
+
+    def update_request(self, parameter):
+        parameter = dict(parameter)
+        request_id = parameter.pop('request_id')
+        core_requests.update_request(request_id, parameter)
+
     def finish_running_requests(self):
         while not self.running_output_queue.empty():
-            req = self.running_output_queue.get()
-            self.logger.info("finish_running_requests: req: %s" % req)
-            parameter = {'locking': RequestLocking.Idle}
-            for key in ['status', 'errors', 'request_metadata', 'processing_metadata']:
-                if key in req:
-                    parameter[key] = req[key]
-            core_requests.update_request(req['request_id'], parameter)
+            reqs = self.get_queue_items(self.running_output_queue, self.finish_bulk_size)
+            parameters = [self.get_running_request_update(req) for req in reqs]
+            self.finish_in_bulk(parameters, core_requests.update_requests, self.update_request)
 
     def clean_locks(self):
         self.logger.info("clean locking")
@@ -244,16 +263,19 @@ class Clerk(BaseAgent):
 
             task = self.create_task(task_func=self.get_new_requests, task_output_queue=self.new_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_new_requests, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_new_requests, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_new_requests, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_new_requests, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1, task_input_queue=self.new_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.get_running_requests, task_output_queue=self.running_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_running_requests, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_running_requests, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_running_requests, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_running_requests, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.clean_locks, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1800, priority=1)
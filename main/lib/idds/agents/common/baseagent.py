@@ -8,12 +8,23 @@
 # Authors:
 # - Wen Guan, <wen.guan@cern.ch>, 2019
 
+import datetime
+import threading
+import traceback
+from collections import OrderedDict
+try:
+    # python 3
+    from queue import Empty
+except ImportError:
+    # Python 2
+    from Queue import Empty
 
 from idds.common.constants import (Sections, TransformType,
                                    MessageType, MessageStatus, MessageSource)
 from idds.common.plugin.plugin_base import PluginBase
 from idds.common.plugin.plugin_utils import load_plugins, load_plugin_sequence
 from idds.common.utils import setup_logging
+from idds.core import transforms as core_transforms
 from idds.agents.common.timerscheduler import TimerScheduler
 
 
@@ -25,8 +36,24 @@ class BaseAgent(TimerScheduler, PluginBase):
     The base IDDS agent class
     """
 
-    def __init__(self, num_threads=1, **kwargs):
+    def __init__(self, num_threads=1, num_process_workers=1, finish_bulk_size=100,
+                 maps_refresh_period=3600, maps_update_margin=60, maps_cache_size=100000, **kwargs):
         super(BaseAgent, self).__init__(num_threads)
+        # number of threads which can run one 'process' task in parallel
+        self.num_process_workers = int(num_process_workers)
+        # max number of results written in one transaction by 'finish' tasks
+        self.finish_bulk_size = int(finish_bulk_size)
+        # cached input output maps are fully re-read after maps_refresh_period seconds.
+        # Between the full reads, only the contents updated since the last read minus
+        # maps_update_margin seconds (for clock skews and long transactions) are read.
+        self.maps_refresh_period = int(maps_refresh_period)
+        self.maps_update_margin = int(maps_update_margin)
+        # max number of contents in the cached maps of all transforms. The maps of the transforms
+        # polled least recently are dropped first, the transforms with more contents are not cached.
+        self.maps_cache_size = int(maps_cache_size)
+        # transform_id -> cached maps, in the order of the last poll
+        self._input_output_maps = OrderedDict()
+        self._input_output_maps_lock = threading.Lock()
         self.name = self.__class__.__name__
         self.logger = None
         self.setup_logger()
@@ -73,6 +100,132 @@ class BaseAgent(TimerScheduler, PluginBase):
     def terminate(self):
         self.stop()
 
+    def get_queue_items(self, queue, max_items):
+        """
+        Get up to max_items items from the queue without blocking.
+        """
+        items = []
+        while len(items) < max_items:
+            try:
+                items.append(queue.get(block=False))
+            except Empty:
+                break
+        return items
+
+    def finish_in_bulk(self, items, bulk_func, item_func):
+        """
+        Write the items in one transaction with bulk_func. If it fails, write them
+        one by one with item_func, so that one bad item doesn't fail the others.
+        """
+        if not items:
+            return
+
+        try:
+            bulk_func(items)
+            return
+        except Exception as ex:
+            self.logger.warning("Failed to finish %s items in bulk, retry them one by one: %s" % (len(items), ex))
+
+        for item in items:
+            try:
+                item_func(item)
+            except Exception as ex:
+                self.logger.error(ex)
+                self.logger.error(traceback.format_exc())
+
+    def index_input_output_maps(self, input_output_maps):
+        """
+        Index the contents of the maps: content_id -> (map_id, key, position in the list).
+        """
+        index = {}
+        for map_id in input_output_maps:
+            for key in input_output_maps[map_id]:
+                for i, content in enumerate(input_output_maps[map_id][key]):
+                    index[content['content_id']] = (map_id, key, i)
+        return index
+
+    def merge_input_output_maps(self, input_output_maps, updated_maps, index=None):
+        """
+        Merge the updated contents into the maps, replacing the contents with the same content_id.
+
+        :param index: The index of the maps (see index_input_output_maps), which is kept up to date.
+        """
+        if index is None:
+            index = self.index_input_output_maps(input_output_maps)
+        for map_id in updated_maps:
+            for key in updated_maps[map_id]:
+                contents = input_output_maps.setdefault(map_id, {}).setdefault(key, [])
+                for content in updated_maps[map_id][key]:
+                    position = index.get(content['content_id'], None)
+                    if position is None:
+                        index[content['content_id']] = (map_id, key, len(contents))
+                        contents.append(content)
+                    else:
+                        old_map_id, old_key, i = position
+                        input_output_maps[old_map_id][old_key][i] = content
+
+    def copy_input_output_maps(self, input_output_maps):
+        """
+        Copy the maps and their content dicts, so that the copy can be changed.
+        """
+        maps = {}
+        for map_id in input_output_maps:
+            maps[map_id] = {}
+            for key in input_output_maps[map_id]:
+                maps[map_id][key] = [dict(content) for content in input_output_maps[map_id][key]]
+        return maps
+
+    def get_transform_input_output_maps(self, transform_id):
+        """
+        Get the input output maps of a transform.
+        The maps are cached per transform with a watermark, so that a poll only reads
+        the contents updated since the previous one. The contents deleted since then are
+        not in the updates: if the number of contents differs, the maps are fully re-read.
+        The cache is only updated from the database: a copy is returned, so the changes of
+        the callers are never cached before they are written.
+        """
+        now = datetime.datetime.utcnow()
+        with self._input_output_maps_lock:
+            for tf_id in list(self._input_output_maps.keys()):
+                # not polled anymore
+                if self._input_output_maps[tf_id]['accessed_at'] < now - datetime.timedelta(seconds=self.maps_refresh_period):
+                    del self._input_output_maps[tf_id]
+            cached = self._input_output_maps.pop(transform_id, None)
+            if cached is None:
+                cached = {'lock': threading.Lock(), 'maps': None, 'num_contents': 0, 'accessed_at': now}
+            self._input_output_maps[transform_id] = cached
+
+        # one worker reads and merges the updates of a transform at a time
+        with cached['lock']:
+            watermark = now - datetime.timedelta(seconds=self.maps_update_margin)
+            maps, index = None, None
+            if cached['maps'] is not None and cached['refreshed_at'] >= now - datetime.timedelta(seconds=self.maps_refresh_period):
+                updated_maps = core_transforms.get_transform_input_output_maps(transform_id, updated_after=cached['updated_after'])
+                self.merge_input_output_maps(cached['maps'], updated_maps, cached['index'])
+                if len(cached['index']) == core_transforms.get_num_transform_contents(transform_id):
+                    maps, index = cached['maps'], cached['index']
+            if maps is None:
+                maps = core_transforms.get_transform_input_output_maps(transform_id)
+                index = self.index_input_output_maps(maps)
+                cached['refreshed_at'] = now
+            cached['updated_after'] = watermark
+            cached['accessed_at'] = now
+
+            if len(index) > self.maps_cache_size:
+                # too large to be cached, the maps are not shared
+                cached['maps'], cached['index'], cached['num_contents'] = None, None, 0
+                ret = maps
+            else:
+                cached['maps'], cached['index'], cached['num_contents'] = maps, index, len(index)
+                ret = self.copy_input_output_maps(maps)
+
+        with self._input_output_maps_lock:
+            num_contents = sum([item['num_contents'] for item in self._input_output_maps.values()])
+            while num_contents > self.maps_cache_size:
+                tf_id, item = self._input_output_maps.popitem(last=False)
+                num_contents -= item['num_contents']
+        return ret
+
     def generate_file_message(self, transform, files):
         if not files:
             return []
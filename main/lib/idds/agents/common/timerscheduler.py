@@ -11,6 +11,7 @@
 
 import heapq
 import threading
+import time
 import traceback
 from concurrent import futures
 
@@ -30,6 +31,8 @@ class TimerScheduler(threading.Thread):
 
         self._task_queue = []
         self._lock = threading.RLock()
+        # notified when a task is added or woken up, or when the scheduler is stopped
+        self._cond = threading.Condition(self._lock)
 
         self.logger = logger
 
@@ -38,45 +41,123 @@ class TimerScheduler(threading.Thread):
 
     def stop(self, signum=None, frame=None):
         self.graceful_stop.set()
-
-    def create_task(self, task_func, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=10, priority=1):
-        return TimerTask(task_func, task_output_queue, task_args, task_kwargs, delay_time, priority, self.logger)
+        with self._cond:
+            self._cond.notify_all()
+
+    def create_task(self, task_func, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=10, priority=1,
+                    task_input_queue=None, max_workers=1):
+        """
+        Create a TimerTask.
+
+        :param task_input_queue: The queue consumed by task_func. When other tasks put items into it,
+                                 the task is woken up without waiting for delay_time.
+        :param max_workers: The max number of concurrent executions of the task. When it's bigger than 1,
+                            the task fans out to drain task_input_queue with up to max_workers threads.
+        """
+        return TimerTask(task_func, task_output_queue, task_args, task_kwargs, delay_time, priority, self.logger,
+                         task_input_queue=task_input_queue, max_workers=max_workers)
 
     def add_task(self, task):
-        with self._lock:
+        with self._cond:
+            if task.queued:
+                return
+            task.queued = True
             heapq.heappush(self._task_queue, task)
+            self._cond.notify()
+
+    def wake_up_tasks(self, task_input_queue):
+        """
+        Wake up the waiting tasks which consume task_input_queue.
+        """
+        with self._cond:
+            woken = False
+            for task in self._task_queue:
+                if task.task_input_queue is task_input_queue and not task.is_ready():
+                    task.wake_up()
+                    woken = True
+            if woken:
+                heapq.heapify(self._task_queue)
+                self._cond.notify()
 
     def remove_task(self, task):
-        with self._lock:
-            self._task_queue.remove(task)
+        with self._cond:
+            self._task_queue = [t for t in self._task_queue if t is not task]
             heapq.heapify(self._task_queue)
+            task.queued = False
 
     def remove_all(self):
-        with self._lock:
+        with self._cond:
+            for task in self._task_queue:
+                task.queued = False
             self._task_queue = []
 
+    def pop_task(self):
+        with self._cond:
+            task = heapq.heappop(self._task_queue)
+            task.queued = False
+            return task
+
     def get_ready_task(self):
         with self._lock:
             if not self._task_queue:
                 return None
             task = self._task_queue[0]
             if task.is_ready():
-                heapq.heappop(self._task_queue)
+                return self.pop_task()
+        return None
+
+    def wait_ready_task(self):
+        """
+        Wait until the first task is ready, a task is added or woken up, or the scheduler is stopped.
+        The returned task is counted as running.
+        """
+        with self._cond:
+            while not self.graceful_stop.is_set():
+                if not self._task_queue:
+                    self._cond.wait()
+                    continue
+                task = self._task_queue[0]
+                wait_time = task.to_execute_time - time.time()
+                if wait_time > 0:
+                    self._cond.wait(wait_time)
+                    continue
+
+                self.pop_task()
+                if task.num_running >= task.max_workers:
+                    # it will be rescheduled when a running execution finishes
+                    continue
+                task.num_running += 1
+                if task.num_running < task.max_workers and task.has_input():
+                    # fan out: let another worker drain the input queue
+                    task.wake_up()
+                    self.add_task(task)
                 return task
         return None
 
     def execute_task(self, task):
         # self.logger.info('execute task: %s' % task)
-        task.execute()
-        self.add_task(task)
+        try:
+            task.execute()
+        finally:
+            with self._cond:
+                task.num_running -= 1
+                if task.task_output_queue is not None and not task.task_output_queue.empty():
+                    self.wake_up_tasks(task.task_output_queue)
+                if not task.queued:
+                    if task.has_input():
+                        # more items arrived while it was running
+                        task.wake_up()
+                        self.add_task(task)
+                    elif task.num_running == 0:
+                        task.delay()
+                        self.add_task(task)
 
     def execute(self):
         while not self.graceful_stop.is_set():
             try:
-                task = self.get_ready_task()
+                task = self.wait_ready_task()
                 if task:
                     self.executors.submit(self.execute_task, task)
-                else:
-                    self.graceful_stop.wait(1)
             except Exception as error:
                 self.logger.critical("Caught an exception: %s\n%s" % (str(error), traceback.format_exc()))
+                self.graceful_stop.wait(1)
@@ -12,13 +12,16 @@
 import time
 import traceback
 
+from idds.common import metrics
+
 
 class TimerTask(object):
     """
     The base class for Task which will be executed after some time
     """
 
-    def __init__(self, task_func, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=10, priority=1, logger=None):
+    def __init__(self, task_func, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=10, priority=1, logger=None,
+                 task_input_queue=None, max_workers=1):
         self.to_execute_time = time.time()
         self.delay_time = delay_time
         self.priority = priority
@@ -26,9 +29,20 @@ class TimerTask(object):
         self.task_output_queue = task_output_queue
         self.task_args = task_args
         self.task_kwargs = task_kwargs
+        self.task_input_queue = task_input_queue
+        self.max_workers = max(int(max_workers), 1)
+
+        # maintained by the scheduler
+        self.queued = False
+        self.num_running = 0
 
         self.logger = logger
 
+        # labels of the metrics of this task
+        owner = getattr(task_func, '__self__', None)
+        self.metrics_labels = {'agent': owner.__class__.__name__ if owner is not None else '',
+                               'task': getattr(task_func, '__name__', str(task_func))}
+
     def __eq__(one, two):
         return (one.to_execute_time, one.priority) == (two.to_execute_time, two.priority)
 
@@ -49,20 +63,44 @@ class TimerTask(object):
             return True
         return False
 
+    def wake_up(self):
+        self.to_execute_time = time.time()
+
+    def delay(self):
+        self.to_execute_time = time.time() + self.delay_time
+
+    def has_input(self):
+        if self.task_input_queue is not None and not self.task_input_queue.empty():
+            return True
+        return False
+
     def execute(self):
+        # to_execute_time is not changed here: with max_workers > 1 the task
+        # can be in the scheduler heap while it's running.
+        start = time.time() if metrics.is_enabled() else None
+        status = 'success'
         try:
-            # set it to avoid an exception
-            self.to_execute_time = time.time() + self.delay_time
-
             ret = self.task_func(*self.task_args, **self.task_kwargs)
             if self.task_output_queue and ret is not None:
                 for ret_item in ret:
                     self.task_output_queue.put(ret_item)
-
-            # if there is no exception, this one is the correct one.
-            self.to_execute_time = time.time() + self.delay_time
         except:
+            status = 'failed'
             if self.logger:
                 self.logger.error('Failed to execute task func: %s, %s' % (self.task_func, traceback.format_exc()))
             else:
                 print('Failed to execute task func: %s, %s' % (self.task_func, traceback.format_exc()))
+        if start is not None:
+            self.record_metrics(time.time() - start, status)
+
+    def record_metrics(self, duration, status):
+        metrics.observe('idds_task_duration_seconds', duration, self.metrics_labels,
+                        documentation='Duration of the executions of the agent tasks')
+        metrics.inc_counter('idds_task_executions_total', labels=dict(self.metrics_labels, status=status),
+                            documentation='Number of the executions of the agent tasks')
+        if self.task_input_queue is not None:
+            metrics.set_gauge('idds_task_queue_depth', self.task_input_queue.qsize(), dict(self.metrics_labels, queue='input'),
+                              documentation='Number of the items in the input/output queues of the agent tasks')
+        if self.task_output_queue is not None:
+            metrics.set_gauge('idds_task_queue_depth', self.task_output_queue.qsize(), dict(self.metrics_labels, queue='output'),
+                              documentation='Number of the items in the input/output queues of the agent tasks')
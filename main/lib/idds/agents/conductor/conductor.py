@@ -12,11 +12,12 @@ import time
 import traceback
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
+from idds.common import metrics
 from idds.common.constants import (Sections, MessageStatus)
 from idds.common.exceptions import AgentPluginError, IDDSException
 from idds.common.utils import setup_logging
@@ -30,22 +31,43 @@ setup_logging(__name__)
 class Conductor(BaseAgent):
     """
     Conductor works to notify workload management that the data is available.
+
+    The delivery is pipelined: messages are claimed and queued for the notifier as long as
+    less than max_in_flight messages are waiting for their acknowledgements. The notifier
+    acknowledges every message on the response queue, and only the sent messages are marked
+    as Delivered. The messages which failed to be sent are set back to New.
     """
 
-    def __init__(self, num_threads=1, retrieve_bulk_size=None, **kwargs):
+    def __init__(self, num_threads=1, retrieve_bulk_size=None, fetched_timeout=3600, max_in_flight=1000,
+                 poll_time_period=5, message_coalesce_window=0, notifier_stop_timeout=60, **kwargs):
         super(Conductor, self).__init__(num_threads=num_threads, **kwargs)
         self.config_section = Sections.Conductor
         self.retrieve_bulk_size = int(retrieve_bulk_size)
+        # messages which are Fetched but not Delivered after fetched_timeout seconds are released to New
+        self.fetched_timeout = int(fetched_timeout)
+        self.last_release_time = None
+        # max number of messages sent to the notifier but not acknowledged yet
+        self.max_in_flight = int(max_in_flight)
+        self.poll_time_period = int(poll_time_period)
+        # messages are only sent when they are older than message_coalesce_window seconds,
+        # so that the agents can still append files to them
+        self.message_coalesce_window = int(message_coalesce_window)
+        # seconds to wait for the notifier to finish the messages it's sending when stopping
+        self.notifier_stop_timeout = int(notifier_stop_timeout)
         self.message_queue = Queue()
+        self.response_queue = Queue()
+        # msg_id -> message, for the messages waiting for acknowledgements
+        self.in_flight = {}
 
     def __del__(self):
         self.stop_notifier()
 
-    def get_messages(self):
+    def get_messages(self, bulk_size=None):
         """
-        Get messages
+        Get messages. The messages are claimed (New -> Fetched), so other conductors don't get them.
         """
-        messages = core_messages.retrieve_messages(status=MessageStatus.New, bulk_size=self.retrieve_bulk_size)
+        messages = core_messages.claim_messages(bulk_size=bulk_size or self.retrieve_bulk_size,
+                                                min_age=self.message_coalesce_window)
 
         self.logger.debug("Main thread get %s new messages" % len(messages))
         if messages:
@@ -53,13 +75,84 @@ class Conductor(BaseAgent):
 
         return messages
 
-    def clean_messages(self, msgs):
+    def clean_messages(self, msgs, failed_msgs=None):
+        """
+        Mark the sent messages as Delivered and the failed messages as New, so they will be sent again.
+        """
         # core_messages.delete_messages(msgs)
         to_updates = []
         for msg in msgs:
             to_updates.append({'msg_id': msg['msg_id'],
                                'status': MessageStatus.Delivered})
-        core_messages.update_messages(to_updates)
+        for msg in failed_msgs or []:
+            to_updates.append({'msg_id': msg['msg_id'],
+                               'status': MessageStatus.New})
+        if to_updates:
+            core_messages.update_messages(to_updates)
+
+    def send_messages(self, messages):
+        for message in messages:
+            self.in_flight[message['msg_id']] = message
+            self.message_queue.put(message)
+
+    def handle_responses(self, timeout=None):
+        """
+        Handle the acknowledgements of the notifier.
+
+        :param timeout: Seconds to wait for the first acknowledgement. The available ones are handled without waiting.
+
+        :returns: (number of sent messages, number of failed messages).
+        """
+        responses = []
+        if timeout:
+            try:
+                responses.append(self.response_queue.get(timeout=timeout))
+            except Empty:
+                pass
+        responses += self.get_queue_items(self.response_queue, max(self.max_in_flight, 1))
+
+        sent_msgs, failed_msgs = [], []
+        for response in responses:
+            msg = self.in_flight.get(response['msg_id'], None)
+            if msg is None:
+                continue
+            if response['sent']:
+                sent_msgs.append(msg)
+            else:
+                failed_msgs.append(msg)
+        try:
+            self.clean_messages(sent_msgs, failed_msgs)
+            # only forget the messages when their status is written
+            for msg in sent_msgs + failed_msgs:
+                self.in_flight.pop(msg['msg_id'], None)
+        except Exception:
+            # the acknowledgements are handled again with the next ones
+            self.logger.error("Failed to update the status of %s sent and %s failed messages" % (len(sent_msgs), len(failed_msgs)))
+            sent_msgs, failed_msgs = [], []
+            for response in responses:
+                self.response_queue.put(response)
+            raise
+        finally:
+            metrics.inc_counter('idds_messages_total', len(sent_msgs), labels={'status': 'delivered'},
+                                documentation='Number of messages handled by the conductor')
+            metrics.inc_counter('idds_messages_total', len(failed_msgs), labels={'status': 'failed'},
+                                documentation='Number of messages handled by the conductor')
+            metrics.set_gauge('idds_messages_in_flight', len(self.in_flight),
+                              documentation='Number of messages waiting for acknowledgements')
+        if failed_msgs:
+            self.logger.warning("Failed to send %s messages, they will be sent again" % len(failed_msgs))
+        return len(sent_msgs), len(failed_msgs)
+
+    def release_messages(self):
+        """
+        Release the messages claimed by a conductor which didn't deliver them, e.g. it's killed.
+        """
+        if self.last_release_time is None or self.last_release_time + self.fetched_timeout / 10 < time.time():
+            self.last_release_time = time.time()
+            num_released = core_messages.release_messages(time_period=self.fetched_timeout)
+            if num_released:
+                self.logger.info("Released %s messages which were fetched but not delivered for more than %s seconds" %
+                                 (num_released, self.fetched_timeout))
 
     def start_notifier(self):
         if 'notifier' not in self.plugins:
@@ -68,6 +161,7 @@ class Conductor(BaseAgent):
 
         self.logger.info("Starting notifier: %s" % self.notifier)
         self.notifier.set_request_queue(self.message_queue)
+        self.notifier.set_response_queue(self.response_queue)
         self.notifier.start()
 
     def stop_notifier(self):
@@ -75,6 +169,18 @@ class Conductor(BaseAgent):
             self.logger.info("Stopping notifier: %s" % self.notifier)
             self.notifier.stop()
 
+    def join_notifier(self, timeout=None):
+        """
+        Wait for the notifier to stop.
+
+        :returns: True if the notifier is stopped, False if it's still running after timeout seconds.
+        """
+        if hasattr(self, 'notifier') and self.notifier and hasattr(self.notifier, 'join'):
+            if self.notifier.is_alive():
+                self.notifier.join(timeout)
+            return not self.notifier.is_alive()
+        return True
+
     def run(self):
         """
         Main run function.
@@ -86,20 +192,63 @@ class Conductor(BaseAgent):
             self.start_notifier()
             while not self.graceful_stop.is_set():
                 try:
-                    messages = self.get_messages()
-                    for message in messages:
-                        self.message_queue.put(message)
-                    while not self.message_queue.empty():
-                        time.sleep(1)
-                    self.clean_messages(messages)
+                    self.release_messages()
+
+                    num_messages = 0
+                    bulk_size = min(self.retrieve_bulk_size, self.max_in_flight - len(self.in_flight))
+                    if bulk_size > 0:
+                        messages = self.get_messages(bulk_size)
+                        self.send_messages(messages)
+                        num_messages = len(messages)
+
+                    # Keep fetching while there are new messages and the window is not full.
+                    # Otherwise wait for acknowledgements.
+                    if num_messages and num_messages == bulk_size:
+                        timeout = None
+                    else:
+                        timeout = self.poll_time_period
+                    num_sent, num_failed = self.handle_responses(timeout=timeout)
+                    if num_failed and not num_sent:
+                        # the brokers are probably not available, don't resend the messages immediately
+                        self.graceful_stop.wait(self.poll_time_period)
                 except IDDSException as error:
                     self.logger.error("Main thread IDDSException: %s" % str(error))
+                    self.graceful_stop.wait(self.poll_time_period)
                 except Exception as error:
                     self.logger.critical("Main thread exception: %s\n%s" % (str(error), traceback.format_exc()))
-                time.sleep(5)
+                    self.graceful_stop.wait(self.poll_time_period)
+            self.finish_in_flight()
         except KeyboardInterrupt:
             self.stop()
 
+    def finish_in_flight(self):
+        """
+        When stopping, handle the last acknowledgements and release the messages which are not sent.
+
+        The notifier is stopped first, so its senders don't send the released messages.
+        The queued messages were not picked up by the senders and are released. If the notifier
+        doesn't stop in time, the messages it may still be sending stay Fetched and are released
+        after fetched_timeout.
+        """
+        try:
+            self.stop_notifier()
+            notifier_stopped = self.join_notifier(self.notifier_stop_timeout)
+            queued_msgs = [msg for msg in self.get_queue_items(self.message_queue, len(self.in_flight)) if msg]
+
+            self.handle_responses()
+            if notifier_stopped:
+                unsent_msgs = list(self.in_flight.values())
+            else:
+                self.logger.warning("Notifier is not stopped after %s seconds" % self.notifier_stop_timeout)
+                unsent_msgs = [msg for msg in queued_msgs if msg['msg_id'] in self.in_flight]
+            if unsent_msgs:
+                self.logger.info("Releasing %s messages which are not sent" % len(unsent_msgs))
+                self.clean_messages([], unsent_msgs)
+                for msg in unsent_msgs:
+                    self.in_flight.pop(msg['msg_id'], None)
+        except Exception as error:
+            self.logger.error("Failed to release the in-flight messages: %s" % str(error))
+
     def stop(self):
         super(Conductor, self).stop()
         self.stop_notifier()
@@ -18,6 +18,7 @@ import signal
 import time
 import traceback
 
+from idds.common import metrics
 from idds.common.constants import Sections
 from idds.common.config import config_has_section, config_has_option, config_list_options, config_get
 from idds.common.utils import setup_logging
@@ -36,6 +37,7 @@ AGENTS = {
     'conductor': ['idds.agents.conductor.conductor.Conductor', Sections.Conductor]
 }
 RUNNING_AGENTS = []
+METRICS_EXPORTERS = []
 
 
 def load_config_agents():
@@ -83,9 +85,41 @@ def load_agent(agent):
     return impl
 
 
+def setup_metrics():
+    """
+    Enable the metrics and start the exporters if they are configured.
+    """
+    attrs = load_agent_attrs(Sections.Metrics)
+    if not attrs.get('enabled', False):
+        return
+
+    metrics.enable()
+    if attrs.get('http_port', None):
+        logging.info("Exporting metrics on http port %s" % attrs['http_port'])
+        METRICS_EXPORTERS.append(metrics.start_http_server(int(attrs['http_port']), attrs.get('http_addr', '')))
+    if attrs.get('dump_file', None):
+        logging.info("Dumping metrics to %s" % attrs['dump_file'])
+        exporter = metrics.MetricsExporter(attrs['dump_file'], int(attrs.get('dump_period', 60)), logger=logging.getLogger())
+        exporter.start()
+        METRICS_EXPORTERS.append(exporter)
+
+
+def stop_metrics():
+    global METRICS_EXPORTERS
+
+    for exporter in METRICS_EXPORTERS:
+        if isinstance(exporter, metrics.MetricsExporter):
+            exporter.stop()
+        else:
+            exporter.shutdown()
+    METRICS_EXPORTERS = []
+
+
 def run_agents():
     global RUNNING_AGENTS
 
+    setup_metrics()
+
     agents = load_config_agents()
     logging.info("Configured to run agents: %s" % str(agents))
     for agent in agents:
@@ -124,6 +158,8 @@ def stop(signum=None, frame=None):
         [thr.join(timeout=3.14) for thr in RUNNING_AGENTS if thr and thr.is_alive()]
         RUNNING_AGENTS = [thr for thr in RUNNING_AGENTS if thr and thr.is_alive()]
 
+    stop_metrics()
+
 
 if __name__ == '__main__':
 
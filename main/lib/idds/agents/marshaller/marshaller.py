@@ -11,10 +11,10 @@
 import traceback
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
 
 from idds.common.constants import (Sections, WorkprogressStatus, WorkprogressLocking, TransformStatus)
@@ -90,12 +90,14 @@ class Marshaller(BaseAgent):
         ret = []
         while not self.new_task_queue.empty():
             try:
-                workprogress = self.new_task_queue.get()
+                workprogress = self.new_task_queue.get(block=False)
                 if workprogress:
                     self.logger.info("Main thread processing new workprogress: %s" % workprogress)
                     ret_workprogress = self.process_new_workprogress(workprogress)
                     if ret_workprogress:
                         ret.append(ret_workprogress)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
@@ -167,23 +169,34 @@ class Marshaller(BaseAgent):
         ret = []
         while not self.running_task_queue.empty():
             try:
-                workprogress = self.running_task_queue.get()
+                workprogress = self.running_task_queue.get(block=False)
                 if workprogress:
                     self.logger.info("Main thread processing running workprogress: %s" % workprogress)
                     ret_workprogress = self.process_running_workprogress(workprogress)
                     if ret_workprogress:
                         ret.append(ret_workprogress)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
         return ret
 
+    def get_running_workprogress_update(self, ret):
+        parameters = dict(ret['parameters'])
+        parameters['workprogress_id'] = ret['workprogress_id']
+        return parameters
+
+    def update_workprogress(self, parameters):
+        parameters = dict(parameters)
+        wp_id = parameters.pop('workprogress_id')
+        core_workprogress.update_workprogress(workprogress_id=wp_id, parameters=parameters)
+
     def finish_running_workprogresses(self):
         while not self.running_output_queue.empty():
-            ret = self.running_output_queue.get()
-            wp_id = ret['workprogress_id']
-            parameters = ret['parameters']
-            core_workprogress.update_workprogress(workprogress_id=wp_id, parameters=parameters)
+            rets = self.get_queue_items(self.running_output_queue, self.finish_bulk_size)
+            parameters = [self.get_running_workprogress_update(ret) for ret in rets]
+            self.finish_in_bulk(parameters, core_workprogress.update_workprogresses, self.update_workprogress)
 
     def clean_locks(self):
         self.logger.info("clean locking")
@@ -200,16 +213,20 @@ class Marshaller(BaseAgent):
 
             task = self.create_task(task_func=self.get_new_workprogresses, task_output_queue=self.new_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_new_workprogresses, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_new_workprogresses, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_new_workprogresses, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=2, priority=1)
+            task = self.create_task(task_func=self.finish_new_workprogresses, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=2, priority=1,
+                                    task_input_queue=self.new_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.get_running_workprogresses, task_output_queue=self.running_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_running_workprogresses, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_running_workprogresses, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_running_workprogresses, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_running_workprogresses, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.clean_locks, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1800, priority=1)
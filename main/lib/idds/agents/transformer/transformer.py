@@ -11,10 +11,10 @@
 import traceback
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
 
 from idds.common.constants import (Sections, TransformStatus, TransformLocking,
@@ -35,12 +35,14 @@ class Transformer(BaseAgent):
     """
 
     def __init__(self, num_threads=1, poll_time_period=1800, retrieve_bulk_size=10,
-                 message_bulk_size=1000, **kwargs):
+                 message_bulk_size=1000, message_coalesce_window=0, **kwargs):
         super(Transformer, self).__init__(num_threads=num_threads, **kwargs)
         self.config_section = Sections.Transformer
         self.poll_time_period = int(poll_time_period)
         self.retrieve_bulk_size = int(retrieve_bulk_size)
         self.message_bulk_size = int(message_bulk_size)
+        # files are appended to the pending file messages created in the last message_coalesce_window seconds
+        self.message_coalesce_window = int(message_coalesce_window)
 
         self.new_task_queue = Queue()
         self.new_output_queue = Queue()
@@ -60,7 +62,7 @@ class Transformer(BaseAgent):
             self.logger.info("Main thread get %s New+Ready+Extend transforms to process" % len(transforms_new))
         return transforms_new
 
-    def generate_collection_model(transform, collection, relation_type=CollectionRelationType.Input):
+    def generate_collection_model(self, transform, collection, relation_type=CollectionRelationType.Input):
         if 'coll_metadata' in collection:
             coll_metadata = collection['coll_metadata']
         else:
@@ -99,8 +101,8 @@ class Transformer(BaseAgent):
     def get_new_contents(self, transform, new_input_output_maps):
         new_contents = []
         for map_id in new_input_output_maps:
-            inputs = new_input_output_maps['map_id']['inputs']
-            outputs = new_input_output_maps['map_id']['outputs']
+            inputs = new_input_output_maps[map_id]['inputs']
+            outputs = new_input_output_maps[map_id]['outputs']
 
             for input_content in inputs:
                 content = {'transform_id': transform['transform_id'],
@@ -137,10 +139,11 @@ class Transformer(BaseAgent):
     def get_updated_contents(self, transform, registered_input_output_maps):
         updated_contents = []
         for map_id in registered_input_output_maps:
-            outputs = registered_input_output_maps['map_id']['outputs']
+            outputs = registered_input_output_maps[map_id]['outputs']
 
             for content in outputs:
-                if content['status'] != content['substatus']:
+                # substatus is not set before the output is processed
+                if content['substatus'] is not None and content['status'] != content['substatus']:
                     updated_content = {'content_id': content['content_id'],
                                        'status': content['substatus']}
                     updated_contents.append(updated_content)
@@ -194,46 +197,56 @@ class Transformer(BaseAgent):
         #        'log_collections': log_colls, 'new_input_output_maps': input_output_maps, 'messages': file_msgs,
         #        'new_processing': processing}
         ret = {'transform': transform, 'input_collections': input_colls, 'output_collections': output_colls,
-               'log_collections': log_coll}
+               'log_collections': log_colls}
         return ret
 
     def process_new_transforms(self):
         ret = []
         while not self.new_task_queue.empty():
             try:
-                transform = self.new_task_queue.get()
+                transform = self.new_task_queue.get(block=False)
                 if transform:
                     self.logger.info("Main thread processing new transform: %s" % transform)
                     ret_transform = self.process_new_transform(transform)
                     if ret_transform:
                         ret.append(ret_transform)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
         return ret
 
+    def get_transform_outputs(self, ret):
+        """
+        Convert the result of processing a transform to the parameters of add_transform_outputs.
+        """
+        keys = ['input_collections', 'output_collections', 'log_collections', 'new_contents',
+                'update_input_collections', 'update_output_collections', 'update_log_collections',
+                'update_contents', 'messages', 'new_processing']
+        transform_outputs = {'transform': ret['transform']}
+        for key in keys:
+            transform_outputs[key] = ret.get(key, None)
+        return transform_outputs
+
+    def add_transforms_outputs(self, rets):
+        transforms_outputs = [self.get_transform_outputs(ret) for ret in rets]
+        core_transforms.add_transforms_outputs(transforms_outputs, message_bulk_size=self.message_bulk_size,
+                                               message_coalesce_window=self.message_coalesce_window)
+
+    def add_transform_outputs(self, ret):
+        transform_outputs = self.get_transform_outputs(ret)
+        core_transforms.add_transform_outputs(message_bulk_size=self.message_bulk_size,
+                                              message_coalesce_window=self.message_coalesce_window,
+                                              **transform_outputs)
+
     def finish_new_transforms(self):
         while not self.new_output_queue.empty():
-            try:
-                ret = self.new_output_queue.get()
+            rets = self.get_queue_items(self.new_output_queue, self.finish_bulk_size)
+            rets = [ret for ret in rets if ret]
+            for ret in rets:
                 self.logger.info("Main thread finishing processing transform: %s" % ret['transform'])
-                if ret:
-                    # self.logger.debug("wen: %s" % str(ret['output_contents']))
-                    core_transforms.add_transform_outputs(transform=ret['transform'],
-                                                          input_collections=ret.get('input_collections', None),
-                                                          output_collections=ret.get('output_collections', None),
-                                                          log_collections=ret.get('log_collections', None),
-                                                          new_contents=ret.get('new_contents', None),
-                                                          update_input_collections=ret.get('update_input_collections', None),
-                                                          update_output_collections=ret.get('update_output_collections', None),
-                                                          update_log_collections=ret.get('update_log_collections', None),
-                                                          update_contents=ret.get('update_contents', None),
-                                                          messages=ret.get('messages', None),
-                                                          new_processing=ret.get('new_processing', None),
-                                                          message_bulk_size=self.message_bulk_size)
-            except Exception as ex:
-                self.logger.error(ex)
-                self.logger.error(traceback.format_exc())
+            self.finish_in_bulk(rets, self.add_transforms_outputs, self.add_transform_outputs)
 
     def get_running_transforms(self):
         """
@@ -288,14 +301,23 @@ class Transformer(BaseAgent):
         output_collections = work.get_output_collections()
         log_collections = work.get_log_collections()
 
-        registered_input_output_maps = core_transforms.get_transform_input_output_maps(transform['transform_id'])
+        # The maps are streamed and the updated contents are found map by map. The works still
+        # get all the maps, but they are not cached or copied by the transformer.
+        registered_input_output_maps = {}
+        update_contents = []
+        for map_id, io_map in core_transforms.iter_transform_input_output_maps(transform['transform_id']):
+            update_contents += self.get_updated_contents(transform, {map_id: io_map})
+            registered_input_output_maps[map_id] = io_map
         # update_input_output_maps = self.get_update_input_output_maps(registered_input_output_maps)
-        update_contents = self.get_updated_contents(transform, registered_input_output_maps)
         if work.has_new_inputs():
             new_input_output_maps = work.get_new_input_output_maps(registered_input_output_maps)
         else:
             new_input_output_maps = {}
         new_contents = self.get_new_contents(transform, new_input_output_maps)
+        if new_contents or update_contents:
+            # the transporter polls the output collections which are being processed.
+            # The collections kept in the work are not changed.
+            output_collections = [dict(coll, status=CollectionStatus.Processing) for coll in output_collections]
 
         # new_input_output_maps = work.get_new_input_output_maps()
         # new_contents = self.get_new_contents(new_input_output_maps)
@@ -314,9 +336,10 @@ class Transformer(BaseAgent):
         processing = work.get_processing(new_input_output_maps)
         new_processing = None
         if not processing:
-            new_processing = work.create_processing(new_input_output_maps)
+            processing = work.create_processing(new_input_output_maps)
             new_processing = {'transform_id': transform['transform_id'],
-                              'status': ProcessingStatus.New}
+                              'status': ProcessingStatus.New,
+                              'processing_metadata': dict(processing['processing_metadata'])}
             new_processing['processing_metadata']['work'] = work
 
         transform['locking'] = TransformLocking.Idle
@@ -345,12 +368,14 @@ class Transformer(BaseAgent):
         ret = []
         while not self.running_task_queue.empty():
             try:
-                transform = self.running_task_queue.get()
+                transform = self.running_task_queue.get(block=False)
                 if transform:
                     self.logger.info("Main thread processing running transform: %s" % transform)
                     ret_transform = self.process_running_transform(transform)
                     if ret_transform:
                         ret.append(ret_transform)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
@@ -358,38 +383,9 @@ class Transformer(BaseAgent):
 
     def finish_running_transforms(self):
         while not self.running_output_queue.empty():
-            ret = self.running_output_queue.get()
-            core_transforms.add_transform_outputs(transform=ret['transform'],
-                                                  input_collections=ret.get('input_collections', None),
-                                                  output_collections=ret.get('output_collections', None),
-                                                  log_collections=ret.get('log_collections', None),
-                                                  new_contents=ret.get('new_contents', None),
-                                                  update_input_collections=ret.get('update_input_collections', None),
-                                                  update_output_collections=ret.get('update_output_collections', None),
-                                                  update_log_collections=ret.get('update_log_collections', None),
-                                                  update_contents=ret.get('update_contents', None),
-                                                  messages=ret.get('messages', None),
-                                                  new_processing=ret.get('new_processing', None),
-                                                  message_bulk_size=self.message_bulk_size)
-
-        while not self.running_output_queue.empty():
-            try:
-                ret = self.new_output_queue.get()
-                self.logger.info("Main thread finishing processing transform: %s" % ret['transform'])
-                if ret:
-                    # self.logger.debug("wen: %s" % str(ret['output_contents']))
-                    core_transforms.add_transform_outputs(transform=ret['transform'],
-                                                          update_input_collections=ret['update_input_collections'],
-                                                          update_output_collections=ret['update_output_collections'],
-                                                          update_log_collections=ret['update_log_collections'],
-                                                          new_input_output_maps=ret['new_input_output_maps'],
-                                                          update_input_output_maps=ret['update_input_output_maps'],
-                                                          processing=ret['processing'],
-                                                          messages=ret['messages'],
-                                                          message_bulk_size=self.message_bulk_size)
-            except Exception as ex:
-                self.logger.error(ex)
-                self.logger.error(traceback.format_exc())
+            rets = self.get_queue_items(self.running_output_queue, self.finish_bulk_size)
+            rets = [ret for ret in rets if ret]
+            self.finish_in_bulk(rets, self.add_transforms_outputs, self.add_transform_outputs)
 
     def clean_locks(self):
         self.logger.info("clean locking")
@@ -406,16 +402,19 @@ class Transformer(BaseAgent):
 
             task = self.create_task(task_func=self.get_new_transforms, task_output_queue=self.new_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_new_transforms, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_new_transforms, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_new_transforms, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=2, priority=1)
+            task = self.create_task(task_func=self.finish_new_transforms, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=2, priority=1, task_input_queue=self.new_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.get_running_transforms, task_output_queue=self.running_task_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_running_transforms, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_running_transforms, task_output_queue=self.running_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_task_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_running_transforms, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_running_transforms, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.running_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.clean_locks, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1800, priority=1)
@@ -10,13 +10,17 @@
 
 import copy
 import datetime
+import functools
+import threading
+import time
 import traceback
+from concurrent import futures
 try:
     # python 3
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
     # Python 2
-    from Queue import Queue
+    from Queue import Queue, Empty
 
 from idds.common.constants import (Sections, CollectionRelationType, CollectionStatus,
                                    CollectionLocking, CollectionType, ContentType, ContentStatus,
@@ -35,7 +39,8 @@ class Transporter(BaseAgent):
     Transporter works to list collections from DDM and register contents to DDM.
     """
 
-    def __init__(self, num_threads=1, poll_time_period=10, retrieve_bulk_size=None, poll_input_time_period=None, poll_output_time_period=None, **kwargs):
+    def __init__(self, num_threads=1, poll_time_period=10, retrieve_bulk_size=None, poll_input_time_period=None, poll_output_time_period=None,
+                 num_io_workers=1, max_calls_per_endpoint=None, call_timeout=None, **kwargs):
         super(Transporter, self).__init__(num_threads=num_threads, **kwargs)
         self.poll_time_period = int(poll_time_period)
         if poll_input_time_period is None:
@@ -50,6 +55,17 @@ class Transporter(BaseAgent):
         self.retrieve_bulk_size = int(retrieve_bulk_size)
         self.config_section = Sections.Transporter
 
+        # The plugin calls to list the input collections run in a dedicated pool of num_io_workers threads.
+        # At most max_calls_per_endpoint calls run at the same time against one endpoint (by default num_io_workers).
+        # A call which runs more than call_timeout seconds is abandoned: its collection is unlocked
+        # and the contents it lists afterwards are not added.
+        self.num_io_workers = int(num_io_workers)
+        self.max_calls_per_endpoint = int(max_calls_per_endpoint) if max_calls_per_endpoint else self.num_io_workers
+        self.call_timeout = int(call_timeout) if call_timeout else None
+        self.io_executors = futures.ThreadPoolExecutor(max_workers=self.num_io_workers)
+        self._endpoint_semaphores = {}
+        self._endpoint_semaphores_lock = threading.Lock()
+
         self.new_input_queue = Queue()
         self.processed_input_queue = Queue()
         self.new_output_queue = Queue()
@@ -102,6 +118,128 @@ class Transporter(BaseAgent):
             raise AgentPluginError('Plugin contents_lister is required')
         return self.plugins['contents_lister'](scope, name)
 
+    def get_content_pages(self, scope, name):
+        """
+        Iterate the contents of a collection page by page. If the contents_lister plugin
+        doesn't support pages (list_pages), all contents are returned as one page.
+        """
+        if 'contents_lister' not in self.plugins:
+            raise AgentPluginError('Plugin contents_lister is required')
+        plugin = self.plugins['contents_lister']
+        if hasattr(plugin, 'list_pages'):
+            return plugin.list_pages(scope, name)
+        return [plugin(scope, name)]
+
+    def get_endpoint(self, plugin_name):
+        """
+        The endpoint of a plugin: the host of its client if it has one, otherwise the plugin itself.
+        """
+        client = getattr(self.plugins[plugin_name], 'client', None)
+        host = getattr(client, 'host', None)
+        return host if host else plugin_name
+
+    def get_endpoint_semaphore(self, endpoint):
+        with self._endpoint_semaphores_lock:
+            if endpoint not in self._endpoint_semaphores:
+                self._endpoint_semaphores[endpoint] = threading.BoundedSemaphore(self.max_calls_per_endpoint)
+            return self._endpoint_semaphores[endpoint]
+
+    def submit_plugin_call(self, plugin_name, *args, **kwargs):
+        """
+        Submit a plugin call to the io workers.
+
+        :param func: The function to call, which uses the plugin. By default the plugin itself.
+        :param cancelled: threading.Event which is set when the call is abandoned.
+
+        :returns: (future, call info). The call info has the time when the call started, after
+                  waiting for the endpoint semaphore.
+        """
+        if plugin_name not in self.plugins:
+            raise AgentPluginError('Plugin %s is required' % plugin_name)
+        func = kwargs.get('func', None) or self.plugins[plugin_name]
+        semaphore = self.get_endpoint_semaphore(self.get_endpoint(plugin_name))
+        call_info = {'plugin': plugin_name, 'args': args, 'started_at': None,
+                     'cancelled': kwargs.get('cancelled', None) or threading.Event()}
+
+        def call():
+            with semaphore:
+                if call_info['cancelled'].is_set():
+                    raise AgentPluginError("Call %s(%s) is abandoned" % (plugin_name, args))
+                call_info['started_at'] = time.time()
+                return func(*args)
+        return self.io_executors.submit(call), call_info
+
+    def abandon_calls(self, calls):
+        """
+        Abandon the calls: the ones which didn't start are cancelled, the running ones are flagged.
+        """
+        for future, call_info in calls:
+            call_info['cancelled'].set()
+            future.cancel()
+
+    def is_call_timeout(self, call_info):
+        return (self.call_timeout is not None and call_info['started_at'] is not None                  # noqa: W503
+                and call_info['started_at'] + self.call_timeout < time.time())                          # noqa: W503
+
+    def need_listing(self, coll):
+        if coll['coll_type'] in [CollectionType.PseudoDataset, CollectionType.PseudoDataset.value]:
+            return False
+        if (coll['coll_metadata'] and 'status' in coll['coll_metadata']                                                                  # noqa: W503
+           and coll['coll_metadata']['status'] in [CollectionStatus.Closed, CollectionStatus.Closed.name, CollectionStatus.Closed.value]):  # noqa: W503
+            return False
+        return True
+
+    def get_new_content(self, coll, content):
+        return {'coll_id': coll['coll_id'],
+                'scope': content['scope'],
+                'name': content['name'],
+                'min_id': 0,
+                'max_id': content['events'],
+                'content_type': ContentType.File,
+                'status': ContentStatus.Available,
+                'bytes': content['bytes'],
+                'md5': content['md5'] if 'md5' in content else None,
+                'adler32': content['adler32'] if 'adler32' in content else None,
+                'expired_at': coll['expired_at']}
+
+    def add_input_contents(self, coll, cancelled=None):
+        """
+        List the contents of an input collection page by page and add the new ones, one transaction per page,
+        so that the memory doesn't depend on the size of the collection.
+
+        :param cancelled: threading.Event. When it's set, the listing is abandoned and no more page is added.
+
+        :returns: (number of listed contents, number of added contents).
+        """
+        num_listed, num_added = 0, 0
+        for page in self.get_content_pages(coll['scope'], coll['name']):
+            if cancelled is not None and cancelled.is_set():
+                raise AgentPluginError("Listing of input collection(%s) is abandoned after %s contents" % (coll['coll_id'], num_listed))
+            new_contents = [self.get_new_content(coll, content) for content in page]
+            num_listed += len(new_contents)
+            num_added += core_catalog.add_input_contents(coll, new_contents)
+        self.logger.info("Listed %s contents of input collection(%s), %s are new" % (num_listed, coll['coll_id'], num_added))
+        return num_listed, num_added
+
+    def get_new_input_collection(self, coll, coll_metadata):
+        """
+        Build the updated input collection from the metadata listed from DDM.
+        The contents are already added by add_input_contents.
+        """
+        coll['bytes'] = coll_metadata['bytes']
+        coll['total_files'] = coll_metadata['total_files']
+        new_coll = {'coll': coll,
+                    'bytes': coll_metadata['bytes'],
+                    'status': CollectionStatus.Open,
+                    'total_files': coll_metadata['total_files'],
+                    'coll_metadata': {'availability': coll_metadata['availability'],
+                                      'events': coll_metadata['events'],
+                                      'is_open': coll_metadata['is_open'],
+                                      'status': coll_metadata['status'].name,
+                                      'run_number': coll_metadata['run_number']},
+                    'contents': []}
+        return new_coll
+
     def process_input_collection(self, coll):
         """
         Process input collection
@@ -129,54 +267,85 @@ class Transporter(BaseAgent):
                                           'is_open': False,
                                           'status': CollectionStatus.Closed.name},
                         'contents': [pseudo_content]}
-        elif coll['coll_metadata'] and coll['coll_metadata']['status'] in [CollectionStatus.Closed, CollectionStatus.Closed.name, CollectionStatus.Closed.value]:
+        elif (coll['coll_metadata'] and 'status' in coll['coll_metadata']                                                                 # noqa: W503
+              and coll['coll_metadata']['status'] in [CollectionStatus.Closed, CollectionStatus.Closed.name, CollectionStatus.Closed.value]):  # noqa: W503
             new_coll = {'coll': coll, 'status': coll['status'], 'contents': []}
         else:
             coll_metadata = self.get_collection_metadata(coll['scope'], coll['name'])
-            contents = self.get_contents(coll['scope'], coll['name'])
-            new_contents = []
-            for content in contents:
-                new_content = {'coll_id': coll['coll_id'],
-                               'scope': content['scope'],
-                               'name': content['name'],
-                               'min_id': 0,
-                               'max_id': content['events'],
-                               'content_type': ContentType.File,
-                               'status': ContentStatus.Available,
-                               'bytes': content['bytes'],
-                               'md5': content['md5'] if 'md5' in content else None,
-                               'adler32': content['adler32'] if 'adler32' in content else None,
-                               'expired_at': coll['expired_at']}
-                new_contents.append(new_content)
-
-            coll['bytes'] = coll_metadata['bytes']
-            coll['total_files'] = coll_metadata['total_files']
-            new_coll = {'coll': coll,
-                        'bytes': coll_metadata['bytes'],
-                        'status': CollectionStatus.Open,
-                        'total_files': coll_metadata['total_files'],
-                        'coll_metadata': {'availability': coll_metadata['availability'],
-                                          'events': coll_metadata['events'],
-                                          'is_open': coll_metadata['is_open'],
-                                          'status': coll_metadata['status'].name,
-                                          'run_number': coll_metadata['run_number']},
-                        'contents': new_contents}
+            self.add_input_contents(coll)
+            new_coll = self.get_new_input_collection(coll, coll_metadata)
         return new_coll
 
+    def put_processed_input_collection(self, new_coll):
+        self.processed_input_queue.put(new_coll)
+        self.wake_up_tasks(self.processed_input_queue)
+
     def process_input_collections(self):
-        ret = []
+        """
+        Process the queued input collections. The metadata and the contents of the collections are
+        listed in parallel by the io workers, and every collection is queued to be finished as soon
+        as both calls complete. The new contents are added by the io workers page by page.
+        """
+        # coll_id -> (coll, {'metadata': (future, call_info), 'contents': (future, call_info)})
+        listings = {}
         while not self.new_input_queue.empty():
             try:
-                coll = self.new_input_queue.get()
+                coll = self.new_input_queue.get(block=False)
                 if coll:
                     self.logger.info("Main thread processing input collection: %s" % coll)
-                    ret_coll = self.process_input_collection(coll)
-                    if ret_coll:
-                        ret.append(ret_coll)
+                    if self.need_listing(coll):
+                        cancelled = threading.Event()
+                        calls = {'metadata': self.submit_plugin_call('collection_metadata_reader', coll['scope'], coll['name'],
+                                                                     cancelled=cancelled),
+                                 'contents': self.submit_plugin_call('contents_lister', coll, cancelled=cancelled,
+                                                                     func=functools.partial(self.add_input_contents, cancelled=cancelled))}
+                        listings[coll['coll_id']] = (coll, calls)
+                    else:
+                        ret_coll = self.process_input_collection(coll)
+                        if ret_coll:
+                            self.put_processed_input_collection(ret_coll)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
-        return ret
+
+        while listings:
+            pending = [future for coll, calls in listings.values() for future, call_info in calls.values() if not future.done()]
+            if pending:
+                futures.wait(pending, timeout=1, return_when=futures.FIRST_COMPLETED)
+
+            for coll_id in list(listings.keys()):
+                coll, calls = listings[coll_id]
+                try:
+                    timeout_calls = [call_info for future, call_info in calls.values() if not future.done() and self.is_call_timeout(call_info)]
+                    if timeout_calls:
+                        raise AgentPluginError("Call %s(%s) timed out after %s seconds" %
+                                               (timeout_calls[0]['plugin'], timeout_calls[0]['args'], self.call_timeout))
+                    if all([future.done() for future, call_info in calls.values()]):
+                        del listings[coll_id]
+                        calls['contents'][0].result()
+                        new_coll = self.get_new_input_collection(coll, calls['metadata'][0].result())
+                        self.put_processed_input_collection(new_coll)
+                except Exception as ex:
+                    listings.pop(coll_id, None)
+                    self.abandon_calls(calls.values())
+                    self.logger.error("Failed to process input collection %s: %s" % (coll_id, ex))
+                    self.logger.error(traceback.format_exc())
+                    self.release_input_collection(coll)
+        return None
+
+    def release_input_collection(self, coll):
+        """
+        Unlock an input collection which failed to be processed, so that it's polled again later.
+        """
+        try:
+            parameters = {'locking': CollectionLocking.Idle,
+                          'next_poll_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=self.poll_input_time_period)}
+            core_catalog.update_collection(coll['coll_id'], parameters)
+        except Exception as ex:
+            # it's unlocked by clean_locks
+            self.logger.error("Failed to unlock input collection %s: %s" % (coll['coll_id'], ex))
 
     def finish_processing_input_collections(self):
         while not self.processed_input_queue.empty():
@@ -215,13 +384,13 @@ class Transporter(BaseAgent):
         return self.plugins['contents_register'](scope, name, contents)
 
     def is_input_collection_all_processed(self, coll_id_list):
-        is_all_processed = True
-        for coll_id in coll_id_list:
-            coll = core_catalog.get_collection(coll_id)
+        colls = core_catalog.get_collections_by_ids(coll_id_list, columns=['coll_id', 'status', 'total_files', 'processed_files'])
+        if len(colls) < len(set(coll_id_list)):
+            return False
+        for coll in colls:
             if not (coll['status'] == CollectionStatus.Closed and coll['total_files'] == coll['processed_files']):
-                is_all_processed = False
-                return is_all_processed
-        return is_all_processed
+                return False
+        return True
 
     def is_all_processings_finished(self, transform_id):
         last_processing = None
@@ -247,8 +416,9 @@ class Transporter(BaseAgent):
         """
         if coll['coll_metadata'] and 'to_register' in coll['coll_metadata'] and coll['coll_metadata']['to_register'] is True:
             contents = core_catalog.get_contents(coll_id=coll['coll_id'])
-            registered_contents = self.get_contents(coll['scope'], coll['name'])
-            registered_content_names = [con['name'] for con in registered_contents]
+            registered_content_names = set()
+            for page in self.get_content_pages(coll['scope'], coll['name']):
+                registered_content_names.update([con['name'] for con in page])
             new_contents = []
             for content in contents:
                 if content['name'] not in registered_content_names:
@@ -263,7 +433,7 @@ class Transporter(BaseAgent):
             input_coll_list = coll['coll_metadata']['input_collections']
             is_input_collection_all_processed = self.is_input_collection_all_processed(input_coll_list)
 
-        contents_statistics = core_catalog.get_content_status_statistics(coll_id=coll['coll_id'])
+        contents_statistics = core_catalog.get_collection_counters(coll['coll_id'])
         contents_statistics_with_name = {}
         for key in contents_statistics:
             contents_statistics_with_name[key.name] = contents_statistics[key]
@@ -361,12 +531,14 @@ class Transporter(BaseAgent):
         ret = []
         while not self.new_output_queue.empty():
             try:
-                coll = self.new_output_queue.get()
+                coll = self.new_output_queue.get(block=False)
                 if coll:
                     self.logger.info("Main thread processing output collection: %s" % coll)
                     ret_coll = self.process_output_collection(coll)
                     if ret_coll:
                         ret.append(ret_coll)
+            except Empty:
+                break
             except Exception as ex:
                 self.logger.error(ex)
                 self.logger.error(traceback.format_exc())
@@ -388,6 +560,11 @@ class Transporter(BaseAgent):
         self.logger.info("clean locking")
         core_catalog.clean_locking()
 
+    def stop(self, signum=None, frame=None):
+        super(Transporter, self).stop(signum, frame)
+        # the running calls are not waited for
+        self.io_executors.shutdown(wait=False)
+
     def run(self):
         """
         Main run function.
@@ -400,16 +577,20 @@ class Transporter(BaseAgent):
 
             task = self.create_task(task_func=self.get_new_input_collections, task_output_queue=self.new_input_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_input_collections, task_output_queue=self.processed_input_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_input_collections, task_output_queue=self.processed_input_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_input_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_processing_input_collections, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_processing_input_collections, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.processed_input_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.get_new_output_collections, task_output_queue=self.new_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
             self.add_task(task)
-            task = self.create_task(task_func=self.process_output_collections, task_output_queue=self.processed_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.process_output_collections, task_output_queue=self.processed_output_queue, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.new_output_queue, max_workers=self.num_process_workers)
             self.add_task(task)
-            task = self.create_task(task_func=self.finish_processing_output_collections, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1)
+            task = self.create_task(task_func=self.finish_processing_output_collections, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1, priority=1,
+                                    task_input_queue=self.processed_output_queue)
             self.add_task(task)
 
             task = self.create_task(task_func=self.clean_locks, task_output_queue=None, task_args=tuple(), task_kwargs={}, delay_time=1800, priority=1)
@@ -56,9 +56,11 @@ def register_output_contents(coll_scope, coll_name, contents, request_id=None, w
     :param request_id: the request id.
     :param workload_id: The workload_id of the request.
     :param contents: list of contents [{'scope': <scope>, 'name': <name>, 'min_id': min_id, 'max_id': max_id, 'path': <path>}].
+
+    :returns: list of the contents which are not matched, with the error in 'error'.
     """
-    catalog.register_output_contents(coll_scope=coll_scope, coll_name=coll_name, contents=contents,
-                                     request_id=request_id, workload_id=workload_id)
+    return catalog.register_output_contents(coll_scope=coll_scope, coll_name=coll_name, contents=contents,
+                                            request_id=request_id, workload_id=workload_id)
 
 
 def get_match_contents(coll_scope, coll_name, scope, name, min_id=None, max_id=None,
@@ -13,9 +13,10 @@
 operations related to Catalog(Collections and Contents).
 """
 
+import itertools
 
 from idds.common import exceptions
-from idds.common.constants import (CollectionType, CollectionStatus, CollectionLocking,
+from idds.common.constants import (CollectionType, CollectionStatus,
                                    CollectionRelationType, ContentStatus)
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm import (transforms as orm_transforms,
@@ -33,7 +34,7 @@ def get_collections_by_status(status, relation_type=CollectionRelationType.Input
     :param status: The collection status.
     :param relation_type: The relation_type of the collection to the transform.
     :param time_period: time period in seconds since last update.
-    :param locking: Whether to retrieve unlocked files and lock them.
+    :param locking: Whether to retrieve unlocked collections and lock them atomically.
     :param to_json: return json format.
 
     :param session: The database session in use.
@@ -42,15 +43,12 @@ def get_collections_by_status(status, relation_type=CollectionRelationType.Input
 
     :returns: list of Collections.
     """
-    colls = orm_collections.get_collections_by_status(status=status, relation_type=relation_type, bulk_size=bulk_size,
-                                                      time_period=time_period, locking=locking, to_json=to_json,
-                                                      session=session)
-
     if locking:
-        parameters = {'locking': CollectionLocking.Locking}
-        for coll in colls:
-            orm_collections.update_collection(coll_id=coll['coll_id'], parameters=parameters, session=session)
-    return colls
+        return orm_collections.claim_collections_by_status(status=status, relation_type=relation_type, bulk_size=bulk_size,
+                                                           time_period=time_period, to_json=to_json, session=session)
+    return orm_collections.get_collections_by_status(status=status, relation_type=relation_type, bulk_size=bulk_size,
+                                                     time_period=time_period, locking=locking, to_json=to_json,
+                                                     session=session)
 
 
 @read_session
@@ -175,6 +173,42 @@ def get_collection(coll_id=None, transform_id=None, relation_type=None, to_json=
                                           session=session)
 
 
+@read_session
+def get_collections_by_ids(coll_ids, columns=None, session=None):
+    """
+    Get collections by ids.
+
+    :param coll_ids: list of collection ids.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param session: The database session in use.
+
+    :returns: list of collections.
+    """
+    return orm_collections.get_collections_by_ids(coll_ids, columns=columns, session=session)
+
+
+@transactional_session
+def get_collection_counters(coll_id, session=None):
+    """
+    Get the number of contents per status of a collection, from the counters which are
+    updated together with the contents. The counters of a collection created before
+    the counters existed are initialized from the contents.
+
+    :param coll_id: Collection id.
+    :param session: The database session in use.
+
+    :returns: dict of content status and number of contents, only for the statuses with contents.
+    """
+    counters = orm_collections.get_collection_counters(coll_id, session=session)
+    if counters is None:
+        # another agent can be initializing them
+        counters = orm_collections.get_collection_counters(coll_id, lock=True, session=session)
+    if counters is None:
+        counters = orm_contents.get_content_status_statistics(coll_id=coll_id, session=session)
+        orm_collections.add_collection_counters(coll_id, counts=counters, session=session)
+    return dict((status, count) for status, count in counters.items() if count)
+
+
 @transactional_session
 def add_contents(contents, bulk_size=1000, session=None):
     """
@@ -193,6 +227,43 @@ def add_contents(contents, bulk_size=1000, session=None):
                                      session=session)
 
 
+@transactional_session
+def add_input_contents(coll, contents, bulk_size=1000, session=None):
+    """
+    Add the contents of an input collection which are not there yet.
+
+    :param coll: the collection.
+    :param contents: iterable of contents. It's consumed bulk_size contents at a time, so it can be a generator.
+    :param bulk_size: bulk per insert to db.
+    :param session: The database session in use.
+
+    :raises DatabaseException: If there is a database error.
+
+    :returns: number of added contents.
+    """
+    num_added = 0
+    contents = iter(contents)
+    while True:
+        chunk = list(itertools.islice(contents, bulk_size))
+        if not chunk:
+            break
+
+        existing_keys = orm_contents.get_existing_content_keys(coll['coll_id'], chunk, bulk_size=bulk_size, session=session)
+        to_addes = []
+        for content in chunk:
+            key = (content['scope'], content['name'], content['min_id'], content['max_id'])
+            if key not in existing_keys:
+                # a content listed twice is only added once
+                existing_keys.add(key)
+                to_addes.append(content)
+
+        # there are new files
+        if to_addes:
+            add_contents(to_addes, bulk_size=bulk_size, session=session)
+            num_added += len(to_addes)
+    return num_added
+
+
 @transactional_session
 def update_input_collection_with_contents(coll, parameters, contents, bulk_size=1000, session=None):
     """
@@ -200,53 +271,24 @@ def update_input_collection_with_contents(coll, parameters, contents, bulk_size=
 
     :param coll_id: the collection id.
     :param parameters: A dictionary of parameters.
-    :param contents: dict of contents.
+    :param contents: iterable of contents, consumed chunk by chunk.
     :param bulk_size: bulk per insert to db.
     :param session: The database session in use.
 
     :raises NoObject: If no request is founded.
     :raises DatabaseException: If there is a database error.
 
-    :returns new contents
-    """
-    new_files = 0
-    processed_files = 0
-    avail_contents = orm_contents.get_contents(coll_id=coll['coll_id'], session=session)
-    avail_contents_dict = {}
-    for content in avail_contents:
-        key = '%s:%s:%s:%s' % (content['scope'], content['name'], content['min_id'], content['max_id'])
-        avail_contents_dict[key] = content
-        if content['status'] in [ContentStatus.Mapped, ContentStatus.Mapped.value]:
-            processed_files += 1
-        if content['status'] in [ContentStatus.New, ContentStatus.New.value]:
-            new_files += 1
-
-    to_addes = []
-    # to_updates = []
-    for content in contents:
-        key = '%s:%s:%s:%s' % (content['scope'], content['name'], content['min_id'], content['max_id'])
-        if key in avail_contents_dict:
-            """
-            to_update = {'content_id': content['content_id'],
-                         'status': content['status']}
-            if 'bytes' in content:
-                to_update['bytes'] = content['bytes']
-            if 'md5' in content:
-                to_update['md5'] = content['md5']
-            if 'adler32' in content:
-                to_update['adler32'] = content['adler32']
-            if 'expired_at' in content:
-                to_update['expired_at'] = content['expired_at']
-            to_updates.append(to_updated)
-            # not to do anything, no need to update
-            """
-            pass
-        else:
-            to_addes.append(content)
+    :returns: number of new contents
+    """
+    num_added = add_input_contents(coll, contents, bulk_size=bulk_size, session=session)
 
-    # there are new files
-    if to_addes:
-        add_contents(to_addes, bulk_size=bulk_size, session=session)
+    statistics = get_collection_counters(coll['coll_id'], session=session)
+    new_files, processed_files = 0, 0
+    for status, count in statistics.items():
+        if status in [ContentStatus.Mapped, ContentStatus.Mapped.value]:
+            processed_files += count
+        if status in [ContentStatus.New, ContentStatus.New.value]:
+            new_files += count
 
     if 'total_files' in parameters:
         total_files = parameters['total_files']
@@ -258,7 +300,7 @@ def update_input_collection_with_contents(coll, parameters, contents, bulk_size=
         parameters['status'] = CollectionStatus.Closed
 
     update_collection(coll['coll_id'], parameters, session=session)
-    return to_addes
+    return num_added
 
 
 @transactional_session
@@ -332,12 +374,14 @@ def get_contents(coll_scope=None, coll_name=None, request_id=None, workload_id=N
 
 
 @read_session
-def get_contents_by_coll_id_status(coll_id, status=None, to_json=False, session=None):
+def get_contents_by_coll_id_status(coll_id, status=None, columns=None, raw=False, to_json=False, session=None):
     """
     Get contents or raise a NoObject exception.
 
     :param coll_id: Collection id.
     :param status: Content status or list of content status.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name.
     :param to_json: return json format.
     :param session: The database session in use.
 
@@ -345,12 +389,13 @@ def get_contents_by_coll_id_status(coll_id, status=None, to_json=False, session=
 
     :returns: list of contents.
     """
-    return orm_contents.get_contents(coll_id=coll_id, status=status, to_json=to_json, session=session)
+    return orm_contents.get_contents(coll_id=coll_id, status=status, columns=columns, raw=raw,
+                                     to_json=to_json, session=session)
 
 
 @transactional_session
 def register_output_contents(coll_scope, coll_name, contents, request_id=None, workload_id=None,
-                             relation_type=CollectionRelationType.Output, session=None):
+                             relation_type=CollectionRelationType.Output, raise_on_error=True, session=None):
     """
     register contents with collection scope, collection name, request id, workload id and contents.
 
@@ -360,7 +405,13 @@ def register_output_contents(coll_scope, coll_name, contents, request_id=None, w
     :param workload_id: The workload_id of the request.
     :param contents: list of contents [{'scope': <scope>, 'name': <name>, 'min_id': min_id, 'max_id': max_id,
                                         'status': <status>, 'path': <path>}].
+    :param raise_on_error: If True, nothing is updated when some contents are not matched.
+                           Otherwise the matched contents are updated and the others are returned.
     :param session: The database session in use.
+
+    :raises WrongParameterException: If the collection is not found, or if raise_on_error and some contents are not matched.
+
+    :returns: list of the contents which are not matched, with the error in 'error'.
     """
     transform_ids = orm_transforms.get_transform_ids(request_id=request_id,
                                                      workload_id=workload_id,
@@ -382,27 +433,32 @@ def register_output_contents(coll_scope, coll_name, contents, request_id=None, w
 
     coll_id = collections[0]['coll_id']
 
+    content_ids = orm_contents.get_content_ids_by_keys(coll_id, contents, session=session)
+
     keys = ['scope', 'name', 'min_id', 'max_id']
+    errors = []
+    to_updates = []
     for content in contents:
-        ex_content = orm_contents.get_content(coll_id=coll_id, scope=content['scope'],
-                                              name=content['name'], min_id=content['min_id'],
-                                              max_id=content['max_id'], session=session)
-
-        content_def = "scope: %s, name: %s, min_id: %s, max_id: %s" % (content['scope'],
-                                                                       content['name'],
-                                                                       content['min_id'],
-                                                                       content['max_id'])
-
-        if not ex_content:
+        key = (content['scope'], content['name'], content['min_id'], content['max_id'])
+        if key not in content_ids:
+            content_def = "scope: %s, name: %s, min_id: %s, max_id: %s" % key
             msg = "No matched content in collection(%s) with content(%s)" % (coll_def, content_def)
-            raise exceptions.WrongParameterException(msg)
+            errors.append(dict(zip(keys, key), error=msg))
+            continue
 
-        for key in keys:
-            if key in content:
-                del content[key]
-        content['content_id'] = ex_content['content_id']
+        # the fields which are not in the content are not changed, the ones set to None are cleared.
+        to_update = dict((k, v) for k, v in content.items() if k not in keys)
+        to_update['content_id'] = content_ids[key]
+        to_updates.append(to_update)
+
+    if errors and raise_on_error:
+        msg = "%s of %s contents are not matched. " % (len(errors), len(contents))
+        msg += "; ".join([error['error'] for error in errors[:10]])
+        raise exceptions.WrongParameterException(msg)
 
-    orm_contents.update_contents(contents, session=session)
+    if to_updates:
+        orm_contents.update_contents(to_updates, session=session)
+    return errors
 
 
 @read_session
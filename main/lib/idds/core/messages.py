@@ -19,7 +19,8 @@ from idds.orm import messages as orm_messages
 
 
 @transactional_session
-def add_message(msg_type, status, source, transform_id, num_contents, msg_content, bulk_size=None, session=None):
+def add_message(msg_type, status, source, transform_id, num_contents, msg_content, bulk_size=None,
+                coalesce_window=None, session=None):
     """
     Add a message to be submitted asynchronously to a message broker.
 
@@ -27,11 +28,14 @@ def add_message(msg_type, status, source, transform_id, num_contents, msg_conten
     :param status: The status about the message
     :param source: The source where the message is from.
     :param msg_content: The message msg_content as JSON.
+    :param bulk_size: Max number of files in one message.
+    :param coalesce_window: The files are appended to the pending file messages created in this period (seconds).
     :param session: The database session.
     """
     return orm_messages.add_message(msg_type=msg_type, status=status, source=source,
                                     transform_id=transform_id, num_contents=num_contents,
-                                    bulk_size=bulk_size, msg_content=msg_content, session=session)
+                                    bulk_size=bulk_size, coalesce_window=coalesce_window,
+                                    msg_content=msg_content, session=session)
 
 
 @read_session
@@ -69,3 +73,33 @@ def update_messages(messages, session=None):
     :param messages: The messages to be updated as a list of dictionaries.
     """
     return orm_messages.update_messages(messages=messages, session=session)
+
+
+@transactional_session
+def claim_messages(bulk_size=1000, msg_type=None, source=None, min_age=None, session=None):
+    """
+    Claim up to bulk_size new messages by moving them from New to Fetched atomically.
+
+    :param bulk_size: Number of messages as an integer.
+    :param msg_type: Return only specified msg_type.
+    :param source: The source where the message is from.
+    :param min_age: Only claim the messages created more than min_age seconds ago.
+    :param session: The database session.
+
+    :returns messages: List of dictionaries
+    """
+    return orm_messages.claim_messages(bulk_size=bulk_size, msg_type=msg_type, source=source,
+                                       min_age=min_age, session=session)
+
+
+@transactional_session
+def release_messages(time_period=3600, session=None):
+    """
+    Move the messages which are Fetched for more than time_period seconds back to New.
+
+    :param time_period: in seconds.
+    :param session: The database session.
+
+    :returns: number of released messages.
+    """
+    return orm_messages.release_messages(time_period=time_period, session=session)
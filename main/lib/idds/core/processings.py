@@ -14,8 +14,9 @@ operations related to Processings.
 """
 
 
+from idds.common import exceptions
 from idds.orm.base.session import read_session, transactional_session
-from idds.common.constants import ProcessingLocking, GranularityType
+from idds.common.constants import GranularityType
 from idds.orm import (processings as orm_processings,
                       collections as orm_collections,
                       contents as orm_contents,
@@ -81,27 +82,33 @@ def get_processings_by_transform_id(transform_id=None, to_json=False, session=No
 
 
 @transactional_session
-def get_processings_by_status(status, time_period=None, locking=False, bulk_size=None, to_json=False, session=None):
+def get_processings_by_status(status, time_period=None, locking=False, bulk_size=None, columns=None, raw=False,
+                              with_metadata=True, to_json=False, session=None):
     """
     Get processing or raise a NoObject exception.
 
     :param status: Processing status of list of processing status.
     :param time_period: Time period in seconds.
-    :param locking: Whether to retrieve only unlocked items and lock them.
+    :param locking: Whether to retrieve only unlocked items and lock them atomically.
+    :param columns: list of column names to read. All columns are read if it's None. Not supported with locking.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name. Not supported with locking.
+    :param with_metadata: Whether to load processing_metadata and output_metadata. Not supported to be False with locking.
     :param to_json: return json format.
     :param session: The database session in use.
 
     :raises NoObject: If no processing is founded.
+    :raises WrongParameterException: If columns, raw or with_metadata=False is used with locking.
 
     :returns: Processings.
     """
-    processings = orm_processings.get_processings_by_status(status=status, period=time_period, locking=locking,
-                                                            bulk_size=bulk_size, to_json=to_json, session=session)
     if locking:
-        parameters = {'locking': ProcessingLocking.Locking}
-        for processing in processings:
-            orm_processings.update_processing(processing['processing_id'], parameters=parameters, session=session)
-    return processings
+        if columns or raw or not with_metadata:
+            raise exceptions.WrongParameterException("columns, raw and with_metadata=False are not supported with locking")
+        return orm_processings.claim_processings_by_status(status=status, period=time_period, bulk_size=bulk_size,
+                                                           to_json=to_json, session=session)
+    return orm_processings.get_processings_by_status(status=status, period=time_period, locking=locking,
+                                                     bulk_size=bulk_size, columns=columns, raw=raw,
+                                                     with_metadata=with_metadata, to_json=to_json, session=session)
 
 
 @transactional_session
@@ -120,6 +127,20 @@ def update_processing(processing_id, parameters, session=None):
     return orm_processings.update_processing(processing_id=processing_id, parameters=parameters, session=session)
 
 
+@transactional_session
+def update_processings(parameters, session=None):
+    """
+    update processings in bulk.
+
+    :param parameters: list of dictionary of parameters, with processing_id in every dictionary.
+    :param session: The database session in use.
+
+    :raises DatabaseException: If there is a database error.
+
+    """
+    return orm_processings.update_processings(parameters, session=session)
+
+
 @transactional_session
 def delete_processing(processing_id=None, session=None):
     """
@@ -138,7 +159,7 @@ def delete_processing(processing_id=None, session=None):
 def update_processing_with_collection_contents(updated_processing, new_processing=None, updated_collection=None,
                                                updated_files=None, new_files=None,
                                                coll_msg_content=None, file_msg_content=None, transform_updates=None,
-                                               message_bulk_size=1000, session=None):
+                                               message_bulk_size=1000, message_coalesce_window=None, session=None):
     """
     Update processing with collection, contents, file messages and collection messages.
 
@@ -147,6 +168,7 @@ def update_processing_with_collection_contents(updated_processing, new_processin
     :param updated_files: list of content files.
     :param coll_msg_content: message with collection info.
     :param file_msg_content: message with files info.
+    :param message_coalesce_window: The files are appended to the pending file messages created in this period (seconds).
     """
     if updated_files:
         orm_contents.update_contents(updated_files, session=session)
@@ -163,6 +185,7 @@ def update_processing_with_collection_contents(updated_processing, new_processin
                                      num_contents=file_msg_con['num_contents'],
                                      msg_content=file_msg_con['msg_content'],
                                      bulk_size=message_bulk_size,
+                                     coalesce_window=message_coalesce_window,
                                      session=session)
     if updated_collection:
         orm_collections.update_collection(coll_id=updated_collection['coll_id'],
@@ -204,6 +227,29 @@ def update_processing_contents(processing_update, content_updates, session=None)
                                           session=session)
 
 
+@transactional_session
+def update_processings_contents(processings_updates, session=None):
+    """
+    Update processings with contents in one transaction.
+
+    :param processings_updates: list of dict with processing_update and content_updates.
+    """
+    content_updates, processing_updates = [], []
+    for updates in processings_updates:
+        if updates['content_updates']:
+            content_updates.extend(updates['content_updates'])
+        processing_update = updates['processing_update']
+        if processing_update:
+            parameters = dict(processing_update['parameters'])
+            parameters['processing_id'] = processing_update['processing_id']
+            processing_updates.append(parameters)
+
+    if content_updates:
+        orm_contents.update_contents(content_updates, session=session)
+    if processing_updates:
+        orm_processings.update_processings(processing_updates, session=session)
+
+
 @transactional_session
 def clean_locking(time_period=3600, session=None):
     """
@@ -159,6 +159,16 @@ def update_request(request_id, parameters, session=None):
     return orm_requests.update_request(request_id, parameters, session=session)
 
 
+@transactional_session
+def update_requests(parameters, session=None):
+    """
+    update requests in bulk.
+
+    :param parameters: list of dictionary of parameters, with request_id in every dictionary.
+    """
+    return orm_requests.update_requests(parameters, session=session)
+
+
 @transactional_session
 def update_request_with_transforms(request_id, parameters, transforms_to_add, transforms_to_extend, session=None):
     """
@@ -220,7 +230,8 @@ def update_request_with_workprogresses(request_id, parameters, new_workprogresse
 
 
 @transactional_session
-def get_requests_by_status_type(status, request_type=None, time_period=None, locking=False, bulk_size=None, to_json=False, session=None):
+def get_requests_by_status_type(status, request_type=None, time_period=None, locking=False, bulk_size=None, with_metadata=True,
+                                to_json=False, session=None):
     """
     Get requests by status and type
 
@@ -229,17 +240,20 @@ def get_requests_by_status_type(status, request_type=None, time_period=None, loc
     :param time_period: Delay of seconds before last update.
     :param locking: Wheter to lock requests to avoid others get the same request.
     :param bulk_size: Size limitation per retrieve.
+    :param with_metadata: Whether to load request_metadata and processing_metadata. Not supported to be False with locking.
     :param to_json: return json format.
 
+    :raises WrongParameterException: If with_metadata=False is used with locking.
+
     :returns: list of Request.
     """
-    reqs = orm_requests.get_requests_by_status_type(status, request_type, time_period, locking=locking, bulk_size=bulk_size,
-                                                    to_json=to_json, session=session)
     if locking:
-        parameters = {'locking': RequestLocking.Locking}
-        for req in reqs:
-            orm_requests.update_request(request_id=req['request_id'], parameters=parameters, session=session)
-    return reqs
+        if not with_metadata:
+            raise exceptions.WrongParameterException("with_metadata=False is not supported with locking")
+        return orm_requests.claim_requests_by_status_type(status, request_type, time_period, bulk_size=bulk_size,
+                                                          to_json=to_json, session=session)
+    return orm_requests.get_requests_by_status_type(status, request_type, time_period, locking=locking, bulk_size=bulk_size,
+                                                    with_metadata=with_metadata, to_json=to_json, session=session)
 
 
 @transactional_session
@@ -13,11 +13,12 @@
 operations related to Transform.
 """
 
-# from idds.common import exceptions
+from idds.common import exceptions
 
 from idds.common.constants import (TransformStatus,
-                                   TransformLocking)
-from idds.orm.base.session import read_session, transactional_session
+                                   TransformLocking,
+                                   CollectionRelationType)
+from idds.orm.base.session import read_session, stream_session, transactional_session
 from idds.orm import (transforms as orm_transforms,
                       collections as orm_collections,
                       contents as orm_contents,
@@ -119,27 +120,33 @@ def get_transforms(workprogress_id, to_json=False, session=None):
     return orm_transforms.get_transforms(workprogress_id=workprogress_id, to_json=to_json, session=session)
 
 
-@read_session
-def get_transforms_by_status(status, period=None, locking=False, bulk_size=None, to_json=False, session=None):
+@transactional_session
+def get_transforms_by_status(status, period=None, locking=False, bulk_size=None, columns=None, raw=False,
+                             with_metadata=True, to_json=False, session=None):
     """
     Get transforms or raise a NoObject exception.
 
     :param status: Transform status or list of transform status.
     :param session: The database session in use.
-    :param locking: Whether to lock retrieved items.
+    :param locking: Whether to retrieve only unlocked items and lock them atomically.
+    :param columns: list of column names to read. All columns are read if it's None. Not supported with locking.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name. Not supported with locking.
+    :param with_metadata: Whether to load transform_metadata. Not supported to be False with locking.
     :param to_json: return json format.
 
     :raises NoObject: If no transform is founded.
+    :raises WrongParameterException: If columns, raw or with_metadata=False is used with locking.
 
     :returns: list of transform.
     """
-    transforms = orm_transforms.get_transforms_by_status(status=status, period=period, locking=locking,
-                                                         bulk_size=bulk_size, to_json=to_json, session=session)
     if locking:
-        parameters = {'locking': TransformLocking.Locking}
-        for transform in transforms:
-            orm_transforms.update_transform(transform_id=transform['transform_id'], parameters=parameters, session=session)
-    return transforms
+        if columns or raw or not with_metadata:
+            raise exceptions.WrongParameterException("columns, raw and with_metadata=False are not supported with locking")
+        return orm_transforms.claim_transforms_by_status(status=status, period=period, bulk_size=bulk_size,
+                                                         to_json=to_json, session=session)
+    return orm_transforms.get_transforms_by_status(status=status, period=period, locking=locking,
+                                                   bulk_size=bulk_size, columns=columns, raw=raw,
+                                                   with_metadata=with_metadata, to_json=to_json, session=session)
 
 
 @transactional_session
@@ -162,7 +169,8 @@ def update_transform(transform_id, parameters, session=None):
 def add_transform_outputs(transform, input_collections=None, output_collections=None, log_collections=None,
                           update_input_collections=None, update_output_collections=None, update_log_collections=None,
                           new_contents=None, update_contents=None,
-                          new_processing=None, messages=None, message_bulk_size=1000, session=None):
+                          new_processing=None, messages=None, message_bulk_size=1000, message_coalesce_window=None,
+                          session=None):
     """
     For input contents, add corresponding output contents.
 
@@ -178,6 +186,7 @@ def add_transform_outputs(transform, input_collections=None, output_collections=
     :param new_processing: The new processing.
     :param messages: Messages.
     :param message_bulk_size: The message bulk size.
+    :param message_coalesce_window: The files are appended to the pending file messages created in this period (seconds).
     :param session: The database session in use.
 
     :raises DatabaseException: If there is a database error.
@@ -207,7 +216,7 @@ def add_transform_outputs(transform, input_collections=None, output_collections=
     if new_contents:
         orm_contents.add_contents(new_contents, session=session)
     if update_contents:
-        orm_contents.add_contents(update_contents, session=session)
+        orm_contents.update_contents(update_contents, session=session)
 
     processing_id = None
     if new_processing:
@@ -228,6 +237,7 @@ def add_transform_outputs(transform, input_collections=None, output_collections=
                                      num_contents=message['num_contents'],
                                      msg_content=message['msg_content'],
                                      bulk_size=message_bulk_size,
+                                     coalesce_window=message_coalesce_window,
                                      session=session)
 
     if to_cancel_processing:
@@ -257,6 +267,23 @@ def add_transform_outputs(transform, input_collections=None, output_collections=
                                         session=session)
 
 
+@transactional_session
+def add_transforms_outputs(transforms_outputs, message_bulk_size=1000, message_coalesce_window=None, session=None):
+    """
+    Add outputs of many transforms in one transaction.
+
+    :param transforms_outputs: list of dict with the parameters of add_transform_outputs.
+    :param message_bulk_size: The message bulk size.
+    :param message_coalesce_window: The files are appended to the pending file messages created in this period (seconds).
+    :param session: The database session in use.
+
+    :raises DatabaseException: If there is a database error.
+    """
+    for transform_outputs in transforms_outputs:
+        add_transform_outputs(message_bulk_size=message_bulk_size, message_coalesce_window=message_coalesce_window,
+                              session=session, **transform_outputs)
+
+
 @transactional_session
 def delete_transform(transform_id=None, session=None):
     """
@@ -291,26 +318,97 @@ def clean_next_poll_at(status, session=None):
     orm_transforms.clean_next_poll_at(status=status, session=session)
 
 
-@read_session
-def get_transform_input_output_maps(transform_id, input_coll_ids, output_coll_ids, log_coll_ids=[], session=None):
+# content columns kept in the input output maps
+CONTENT_MAP_COLUMNS = ['content_id', 'coll_id', 'map_id', 'scope', 'name', 'min_id', 'max_id',
+                       'content_type', 'status', 'substatus', 'bytes', 'md5', 'adler32', 'path',
+                       'content_metadata']
+
+
+@stream_session
+def iter_transform_input_output_maps(transform_id, input_coll_ids=None, output_coll_ids=None, log_coll_ids=None,
+                                     updated_after=None, bulk_size=1000, session=None):
     """
-    Get transform input output maps.
+    Iterate transform input output maps in map_id order.
+    Only the contents of the current map are kept in memory.
 
     :param transform_id: transform id.
+    :param input_coll_ids: list of input collection ids. Looked up with the transform collections if all coll ids are None.
+    :param output_coll_ids: list of output collection ids.
+    :param log_coll_ids: list of log collection ids.
+    :param updated_after: If set, only the contents updated at or after this datetime are read.
+                          The maps then only include the changed contents.
+    :param bulk_size: number of contents fetched per round trip.
+
+    :returns: generator of (map_id, {'inputs': [], 'outputs': [], 'logs': [], 'others': []}).
     """
-    contents = orm_contents.get_contents_by_transform(transform_id=transform_id, session=session)
-    ret = {}
+    if input_coll_ids is None and output_coll_ids is None and log_coll_ids is None:
+        input_coll_ids, output_coll_ids, log_coll_ids = [], [], []
+        for coll in orm_collections.get_collections(transform_id=transform_id, session=session):
+            if coll['relation_type'] == CollectionRelationType.Input:
+                input_coll_ids.append(coll['coll_id'])
+            elif coll['relation_type'] == CollectionRelationType.Output:
+                output_coll_ids.append(coll['coll_id'])
+            elif coll['relation_type'] == CollectionRelationType.Log:
+                log_coll_ids.append(coll['coll_id'])
+    input_coll_ids = set(input_coll_ids or [])
+    output_coll_ids = set(output_coll_ids or [])
+    log_coll_ids = set(log_coll_ids or [])
+
+    map_id, io_map = None, None
+    contents = orm_contents.iter_contents_by_transform(transform_id=transform_id, columns=CONTENT_MAP_COLUMNS,
+                                                       updated_after=updated_after, bulk_size=bulk_size,
+                                                       session=session)
     for content in contents:
-        map_id = content['map_id']
-        if map_id not in ret:
-            ret[map_id] = {'inputs': [], 'outputs': [], 'logs': [], 'others': []}
+        if io_map is None or content['map_id'] != map_id:
+            if io_map is not None:
+                yield map_id, io_map
+            map_id = content['map_id']
+            io_map = {'inputs': [], 'outputs': [], 'logs': [], 'others': []}
 
         if content['coll_id'] in input_coll_ids:
-            ret[map_id]['inputs'].append(content)
+            io_map['inputs'].append(content)
         elif content['coll_id'] in output_coll_ids:
-            ret[map_id]['outputs'].append(content)
+            io_map['outputs'].append(content)
         elif content['coll_id'] in log_coll_ids:
-            ret[map_id]['logs'].append(content)
+            io_map['logs'].append(content)
         else:
-            ret[map_id]['others'].append(content)
+            io_map['others'].append(content)
+    if io_map is not None:
+        yield map_id, io_map
+
+
+@read_session
+def get_transform_input_output_maps(transform_id, input_coll_ids=None, output_coll_ids=None, log_coll_ids=None,
+                                    updated_after=None, session=None):
+    """
+    Get transform input output maps.
+    The contents in the maps only have the columns in CONTENT_MAP_COLUMNS.
+
+    :param transform_id: transform id.
+    :param input_coll_ids: list of input collection ids. Looked up with the transform collections if all coll ids are None.
+    :param output_coll_ids: list of output collection ids.
+    :param log_coll_ids: list of log collection ids.
+    :param updated_after: If set, only the contents updated at or after this datetime are read.
+                          The maps then only include the changed contents.
+
+    :returns: dict of map_id: {'inputs': [], 'outputs': [], 'logs': [], 'others': []}.
+    """
+    ret = {}
+    for map_id, io_map in iter_transform_input_output_maps(transform_id, input_coll_ids=input_coll_ids,
+                                                           output_coll_ids=output_coll_ids,
+                                                           log_coll_ids=log_coll_ids, updated_after=updated_after,
+                                                           session=session):
+        ret[map_id] = io_map
     return ret
+
+
+@read_session
+def get_num_transform_contents(transform_id, session=None):
+    """
+    Get the number of contents of a transform.
+
+    :param transform_id: transform id.
+
+    :returns: number of contents.
+    """
+    return orm_contents.get_num_contents_by_transform(transform_id, session=session)
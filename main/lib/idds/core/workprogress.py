@@ -125,7 +125,7 @@ def get_workprogress(workprogress_id, to_json=False, session=None):
     return orm_workprogress.get_workprogress(workprogress_id=workprogress_id, to_json=to_json, session=session)
 
 
-@read_session
+@transactional_session
 def get_workprogresses_by_status(status, period=None, locking=False, bulk_size=None, to_json=False, session=None):
     """
     Get workprogresses.
@@ -140,6 +140,9 @@ def get_workprogresses_by_status(status, period=None, locking=False, bulk_size=N
     :returns: list of Workprogress.
     """
 
+    if locking:
+        return orm_workprogress.claim_workprogresses_by_status(status=status, period=period, bulk_size=bulk_size,
+                                                               to_json=to_json, session=session)
     return orm_workprogress.get_workprogresses_by_status(status=status, period=period, locking=locking,
                                                          bulk_size=bulk_size, to_json=to_json, session=session)
 
@@ -167,6 +170,20 @@ def update_workprogress(workprogress_id, parameters, new_transforms=None, sessio
     return orm_workprogress.update_workprogress(workprogress_id=workprogress_id, parameters=parameters, session=session)
 
 
+@transactional_session
+def update_workprogresses(parameters, session=None):
+    """
+    update workprogresses in bulk.
+
+    :param parameters: list of dictionary of parameters, with workprogress_id in every dictionary.
+    :param session: The database session in use.
+
+    :raises DatabaseException: If there is a database error.
+
+    """
+    return orm_workprogress.update_workprogresses(parameters, session=session)
+
+
 @transactional_session
 def delete_workprogress(workprogress_id=None, session=None):
     """
@@ -140,8 +140,8 @@ class Request(BASE, ModelBase):
     accessed_at = Column("accessed_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     expired_at = Column("expired_at", DateTime)
     errors = Column(JSON())
-    request_metadata = Column(JSON())
-    processing_metadata = Column(JSON())
+    request_metadata = Column(JSON(lazy=True))
+    processing_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('request_id', name='REQUESTS_PK'),
                    CheckConstraint('status IS NOT NULL', name='REQUESTS_STATUS_ID_NN'),
@@ -171,8 +171,8 @@ class Workprogress(BASE, ModelBase):
     accessed_at = Column("accessed_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     expired_at = Column("expired_at", DateTime)
     errors = Column(JSON())
-    workprogress_metadata = Column(JSON())
-    processing_metadata = Column(JSON())
+    workprogress_metadata = Column(JSON(lazy=True))
+    processing_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('workprogress_id', name='WORKPROGRESS_PK'),
                    ForeignKeyConstraint(['request_id'], ['requests.request_id'], name='REQ2WORKPROGRESS_REQ_ID_FK'),
@@ -200,7 +200,7 @@ class Transform(BASE, ModelBase):
     started_at = Column("started_at", DateTime)
     finished_at = Column("finished_at", DateTime)
     expired_at = Column("expired_at", DateTime)
-    transform_metadata = Column(JSON())
+    transform_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('transform_id', name='TRANSFORMS_PK'),
                    CheckConstraint('status IS NOT NULL', name='TRANSFORMS_STATUS_ID_NN'),
@@ -237,8 +237,8 @@ class Processing(BASE, ModelBase):
     submitted_at = Column("submitted_at", DateTime)
     finished_at = Column("finished_at", DateTime)
     expired_at = Column("expired_at", DateTime)
-    processing_metadata = Column(JSON())
-    output_metadata = Column(JSON())
+    processing_metadata = Column(JSON(lazy=True))
+    output_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('processing_id', name='PROCESSINGS_PK'),
                    ForeignKeyConstraint(['transform_id'], ['transforms.transform_id'], name='PROCESSINGS_TRANSFORM_ID_FK'),
@@ -272,7 +272,7 @@ class Collection(BASE, ModelBase):
     next_poll_at = Column("next_poll_at", DateTime, default=datetime.datetime.utcnow)
     accessed_at = Column("accessed_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     expired_at = Column("expired_at", DateTime)
-    coll_metadata = Column(JSON())
+    coll_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('coll_id', name='COLLECTIONS_PK'),
                    UniqueConstraint('name', 'scope', 'transform_id', 'relation_type', name='COLLECTIONS_NAME_SCOPE_UQ'),
@@ -310,7 +310,7 @@ class Content(BASE, ModelBase):
     updated_at = Column("updated_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     accessed_at = Column("accessed_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     expired_at = Column("expired_at", DateTime)
-    content_metadata = Column(JSON())
+    content_metadata = Column(JSON(lazy=True))
 
     _table_args = (PrimaryKeyConstraint('content_id', name='CONTENTS_PK'),
                    # UniqueConstraint('name', 'scope', 'coll_id', 'content_type', 'min_id', 'max_id', name='CONTENT_SCOPE_NAME_UQ'),
@@ -321,7 +321,22 @@ class Content(BASE, ModelBase):
                    ForeignKeyConstraint(['coll_id'], ['collections.coll_id'], name='CONTENTS_COLL_ID_FK'),
                    CheckConstraint('status IS NOT NULL', name='CONTENTS_STATUS_ID_NN'),
                    CheckConstraint('coll_id IS NOT NULL', name='CONTENTS_COLL_ID_NN'),
-                   Index('CONTENTS_STATUS_UPDATED_IDX', 'status', 'locking', 'updated_at', 'created_at'))
+                   Index('CONTENTS_STATUS_UPDATED_IDX', 'status', 'locking', 'updated_at', 'created_at'),
+                   Index('CONTENTS_TRANSFORM_MAP_IDX', 'transform_id', 'map_id'),
+                   Index('CONTENTS_TRANSFORM_UPDATED_IDX', 'transform_id', 'updated_at'),
+                   Index('CONTENTS_COLL_NAME_IDX', 'coll_id', 'name', 'scope', 'min_id', 'max_id', 'status'))
+
+
+class CollectionCounter(BASE, ModelBase):
+    """Represents the number of contents per status of a collection"""
+    __tablename__ = 'collection_counters'
+    coll_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    status = Column(EnumWithValue(ContentStatus), primary_key=True)
+    num_files = Column(Integer(), default=0)
+    updated_at = Column("updated_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    _table_args = (PrimaryKeyConstraint('coll_id', 'status', name='COLL_COUNTERS_PK'),
+                   ForeignKeyConstraint(['coll_id'], ['collections.coll_id'], name='COLL_COUNTERS_COLL_ID_FK'))
 
 
 class Message(BASE, ModelBase):
@@ -341,7 +356,8 @@ class Message(BASE, ModelBase):
     updated_at = Column("updated_at", DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     msg_content = Column(JSON())
 
-    _table_args = (PrimaryKeyConstraint('msg_id', name='MESSAGES_PK'))
+    _table_args = (PrimaryKeyConstraint('msg_id', name='MESSAGES_PK'),
+                   Index('MESSAGES_TRANSFORM_IDX', 'transform_id', 'msg_type', 'status', 'created_at'))
 
 
 def register_models(engine):
@@ -349,7 +365,7 @@ def register_models(engine):
     Creates database tables for all models with the given engine
     """
 
-    models = (Request, Workprogress, Transform, Workprogress2transform, Processing, Collection, Content)
+    models = (Request, Workprogress, Transform, Workprogress2transform, Processing, Collection, Content, CollectionCounter)
 
     for model in models:
         model.metadata.create_all(engine)   # pylint: disable=maybe-no-member
@@ -360,7 +376,7 @@ def unregister_models(engine):
     Drops database tables for all models with the given engine
     """
 
-    models = (Request, Workprogress, Transform, Workprogress2transform, Processing, Collection, Content)
+    models = (Request, Workprogress, Transform, Workprogress2transform, Processing, Collection, Content, CollectionCounter)
 
     for model in models:
         model.metadata.drop_all(engine)   # pylint: disable=maybe-no-member
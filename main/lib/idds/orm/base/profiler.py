@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+"""
+SQL statement profiler.
+
+When it's enabled, before/after_cursor_execute listeners are attached to the engine.
+The statements are normalized (literals and bind parameter lists are collapsed) and
+the execution time and the row counts are aggregated per normalized statement and per
+caller. The caller is the function which opened the session with one of the session
+decorators, normally a function in idds.core. The number of calls of every caller is
+counted too, so that callers which run many statements per call (N+1 patterns) stand out.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+
+# statements longer than it are truncated in the report
+MAX_STATEMENT_LENGTH = 200
+MAX_CACHED_STATEMENTS = 10000
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(\.\d+)?\b")
+_BIND_RE = re.compile(r"(:\w+|%\(\w+\)s|\?)")
+_BIND_LIST_RE = re.compile(r"\(\s*\?(\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_statement(statement):
+    """
+    Normalize a statement, so that the same statement with different literals,
+    bind parameter names or IN list lengths is aggregated together.
+    """
+    statement = _STRING_RE.sub('?', statement)
+    statement = _BIND_RE.sub('?', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    statement = _BIND_LIST_RE.sub('(?...)', statement)
+    statement = _SPACE_RE.sub(' ', statement).strip()
+    return statement
+
+
+class Stats(object):
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.rows = 0
+        # number of calls, only for the callers
+        self.calls = 0
+
+    def add(self, duration, rows):
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        if rows > 0:
+            self.rows += rows
+
+    def to_dict(self):
+        return {'count': self.count,
+                'total_time': self.total_time,
+                'avg_time': self.total_time / self.count if self.count else 0,
+                'max_time': self.max_time,
+                'rows': self.rows,
+                'calls': self.calls,
+                'statements_per_call': float(self.count) / self.calls if self.calls else 0}
+
+
+class SQLProfiler(object):
+    """
+    Profiler of the statements executed by an engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._normalized = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.statements = {}
+            self.callers = {}
+            self.caller_statements = {}
+
+    def start(self):
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def stop(self):
+        event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def get_caller(self):
+        return getattr(self._local, 'caller', None)
+
+    def set_caller(self, function, new_call=True):
+        """
+        Set the function which opens a session in this thread.
+
+        :param function: The function.
+        :param new_call: Whether it's a new call of the function, which is counted.
+                         It's False when a generator is resumed.
+
+        :returns: the previous caller, which should be restored with reset_caller when the session is closed.
+        """
+        previous = self.get_caller()
+        caller = '%s.%s' % (function.__module__, function.__name__)
+        self._local.caller = caller
+        with self._lock:
+            if caller not in self.callers:
+                self.callers[caller] = Stats()
+            if new_call:
+                self.callers[caller].calls += 1
+        return previous
+
+    def reset_caller(self, previous):
+        self._local.caller = previous
+
+    def normalize(self, statement):
+        normalized = self._normalized.get(statement, None)
+        if normalized is None:
+            normalized = normalize_statement(statement)
+            if len(self._normalized) < MAX_CACHED_STATEMENTS:
+                self._normalized[statement] = normalized
+        return normalized
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('idds_profiler_start', []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('idds_profiler_start', None)
+        if not starts:
+            return
+        duration = time.time() - starts.pop()
+        # rowcount is only known for DML statements, it's -1 for most SELECTs
+        rows = cursor.rowcount if cursor.rowcount is not None else -1
+        normalized = self.normalize(statement)
+        caller = self.get_caller() or 'unknown'
+
+        with self._lock:
+            if normalized not in self.statements:
+                self.statements[normalized] = Stats()
+            self.statements[normalized].add(duration, rows)
+            if caller not in self.callers:
+                self.callers[caller] = Stats()
+            self.callers[caller].add(duration, rows)
+            key = (caller, normalized)
+            if key not in self.caller_statements:
+                self.caller_statements[key] = Stats()
+            self.caller_statements[key].add(duration, rows)
+
+    def get_stats(self, top=20, order_by='total_time'):
+        """
+        Get the top statements and callers.
+
+        :param top: The number of items to return per category.
+        :param order_by: One of total_time, count, avg_time, max_time, rows and statements_per_call.
+
+        :returns: dict with the lists of 'statements', 'callers' and 'caller_statements'.
+        """
+        with self._lock:
+            statements = [dict(stats.to_dict(), statement=statement) for statement, stats in self.statements.items()]
+            callers = [dict(stats.to_dict(), caller=caller) for caller, stats in self.callers.items()]
+            caller_statements = [dict(stats.to_dict(), caller=caller, statement=statement)
+                                 for (caller, statement), stats in self.caller_statements.items()]
+        ret = {'duration': time.time() - self.started_at}
+        for key, items in [('statements', statements), ('callers', callers), ('caller_statements', caller_statements)]:
+            ret[key] = sorted(items, key=lambda item: item[order_by], reverse=True)[:top]
+        return ret
+
+    def report(self, top=20, order_by='total_time'):
+        """
+        Get a text report of the top statements and callers.
+        """
+        stats = self.get_stats(top=top, order_by=order_by)
+        lines = ['SQL profile of %.1f seconds, top %s by %s' % (stats['duration'], top, order_by)]
+
+        lines.append('')
+        lines.append('Callers:')
+        lines.append('%10s %10s %8s %12s %12s %12s  %s' % ('calls', 'statements', 'per_call', 'total(s)', 'max(s)', 'rows', 'caller'))
+        for item in stats['callers']:
+            lines.append('%10s %10s %8.1f %12.4f %12.4f %12s  %s' % (item['calls'], item['count'], item['statements_per_call'],
+                                                                     item['total_time'], item['max_time'], item['rows'], item['caller']))
+
+        for title, key in [('Statements:', 'statements'), ('Statements per caller:', 'caller_statements')]:
+            lines.append('')
+            lines.append(title)
+            lines.append('%10s %12s %12s %12s %12s  %s' % ('count', 'total(s)', 'avg(s)', 'max(s)', 'rows', 'statement'))
+            for item in stats[key]:
+                statement = item['statement'][:MAX_STATEMENT_LENGTH]
+                if key == 'caller_statements':
+                    statement = '%s: %s' % (item['caller'], statement)
+                lines.append('%10s %12.4f %12.4f %12.4f %12s  %s' % (item['count'], item['total_time'], item['avg_time'],
+                                                                     item['max_time'], item['rows'], statement))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, top=20, order_by='total_time'):
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.report(top=top, order_by=order_by))
+        os.rename(tmp_path, path)
+
+
+class ProfileDumper(threading.Thread):
+    """
+    Dump the report of the profiler to a file periodically.
+    """
+
+    def __init__(self, profiler, path, period=600, top=20, logger=None):
+        super(ProfileDumper, self).__init__(name='SQLProfileDumper')
+        self.daemon = True
+        self.profiler = profiler
+        self.path = path
+        self.period = int(period)
+        self.top = int(top)
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.graceful_stop = threading.Event()
+
+    def stop(self):
+        self.graceful_stop.set()
+
+    def run(self):
+        while not self.graceful_stop.wait(self.period):
+            try:
+                self.profiler.dump(self.path, top=self.top)
+            except Exception as error:
+                self.logger.error("Failed to dump the SQL profile to %s: %s" % (self.path, error))
+
+
+_PROFILER = None
+_DUMPER = None
+
+
+def is_enabled():
+    return _PROFILER is not None
+
+
+def get_profiler():
+    return _PROFILER
+
+
+def enable(engine, dump_file=None, dump_period=600, top=20):
+    """
+    Start profiling the statements executed by the engine.
+
+    :param engine: The sqlalchemy engine.
+    :param dump_file: If it's set, the report is written to this file every dump_period seconds.
+    :param top: The number of statements and callers in the dumped report.
+
+    :returns: the profiler.
+    """
+    global _PROFILER, _DUMPER
+    if _PROFILER is None:
+        profiler = SQLProfiler(engine)
+        profiler.start()
+        _PROFILER = profiler
+        if dump_file:
+            _DUMPER = ProfileDumper(profiler, dump_file, dump_period, top)
+            _DUMPER.start()
+    return _PROFILER
+
+
+def disable():
+    global _PROFILER, _DUMPER
+    if _DUMPER is not None:
+        _DUMPER.stop()
+        _DUMPER = None
+    if _PROFILER is not None:
+        _PROFILER.stop()
+        _PROFILER = None
+
+
+def set_caller(function, new_call=True):
+    profiler = _PROFILER
+    if profiler is None:
+        return None
+    return profiler.set_caller(function, new_call=new_call)
+
+
+def reset_caller(previous):
+    profiler = _PROFILER
+    if profiler is not None:
+        profiler.reset_caller(previous)
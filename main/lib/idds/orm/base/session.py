@@ -16,6 +16,7 @@ https://github.com/rucio/rucio/blob/master/lib/rucio/db/sqla/session.py
 """
 
 import sys
+import time
 
 from functools import wraps
 from inspect import isgeneratorfunction
@@ -28,8 +29,10 @@ from sqlalchemy.exc import DatabaseError, DisconnectionError, OperationalError,
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from idds.common.config import config_get, config_has_option
+from idds.common import metrics
+from idds.common.config import config_get, config_get_bool, config_has_option
 from idds.common.exceptions import IDDSException, DatabaseException
+from idds.orm.base import profiler
 
 
 DATABASE_SECTION = 'database'
@@ -154,6 +157,13 @@ def get_engine(echo=True):
             event.listen(_ENGINE, 'connect', _fk_pragma_on_connect)
         elif 'oracle' in sql_connection:
             event.listen(_ENGINE, 'connect', my_on_connect)
+
+        if config_has_option(DATABASE_SECTION, 'profile') and config_get_bool(DATABASE_SECTION, 'profile'):
+            profile_params = {}
+            for param, param_type in [('dump_file', str), ('dump_period', int), ('top', int)]:
+                if config_has_option(DATABASE_SECTION, 'profile_' + param):
+                    profile_params[param] = param_type(config_get(DATABASE_SECTION, 'profile_' + param))
+            profiler.enable(_ENGINE, **profile_params)
     assert _ENGINE
     return _ENGINE
 
@@ -230,6 +240,17 @@ def retry_if_db_connection_error(exception):
     return False
 
 
+def record_session_metrics(session_type, function, start, status):
+    """
+    Record the duration and the status of a session created by the session decorators.
+    """
+    labels = {'type': session_type, 'function': '%s.%s' % (function.__module__, function.__name__)}
+    metrics.observe('idds_db_session_duration_seconds', time.time() - start, labels,
+                    documentation='Duration of the database sessions, by the decorated functions')
+    metrics.inc_counter('idds_db_sessions_total', labels=dict(labels, status=status),
+                        documentation='Number of the database sessions, by the decorated functions')
+
+
 def read_session(function):
     '''
     decorator that set the session variable to use inside a function.
@@ -250,9 +271,14 @@ def read_session(function):
 
         if not kwargs.get('session'):
             session = get_session()
+            start = time.time() if metrics.is_enabled() else None
+            status = 'failed'
+            previous_caller = profiler.set_caller(function)
             try:
                 kwargs['session'] = session
-                return function(*args, **kwargs)
+                result = function(*args, **kwargs)
+                status = 'success'
+                return result
             except TimeoutError as error:
                 session.rollback()  # pylint: disable=maybe-no-member
                 raise DatabaseException(str(error))
@@ -264,6 +290,9 @@ def read_session(function):
                 raise
             finally:
                 session.remove()
+                if start is not None:
+                    record_session_metrics('read', function, start, status)
+                profiler.reset_caller(previous_caller)
         try:
             return function(*args, **kwargs)
         except:  # noqa: B901
@@ -292,10 +321,24 @@ def stream_session(function):
 
         if not kwargs.get('session'):
             session = get_session()
+            start = time.time() if metrics.is_enabled() else None
+            status = 'failed'
             try:
                 kwargs['session'] = session
-                for row in function(*args, **kwargs):
+                rows = function(*args, **kwargs)
+                # the caller is only set while a row is fetched, not while the consumer runs
+                new_call = True
+                while True:
+                    previous_caller = profiler.set_caller(function, new_call=new_call)
+                    new_call = False
+                    try:
+                        row = next(rows)
+                    except StopIteration:
+                        break
+                    finally:
+                        profiler.reset_caller(previous_caller)
                     yield row
+                status = 'success'
             except TimeoutError as error:
                 print(error)
                 session.rollback()  # pylint: disable=maybe-no-member
@@ -304,11 +347,18 @@ def stream_session(function):
                 print(error)
                 session.rollback()  # pylint: disable=maybe-no-member
                 raise DatabaseException(str(error))
+            except GeneratorExit:
+                # the consumer stopped reading before the end
+                status = 'closed'
+                session.rollback()  # pylint: disable=maybe-no-member
+                raise
             except:  # noqa: B901
                 session.rollback()  # pylint: disable=maybe-no-member
                 raise
             finally:
                 session.remove()
+                if start is not None:
+                    record_session_metrics('stream', function, start, status)
         else:
             try:
                 for row in function(*args, **kwargs):
@@ -329,10 +379,14 @@ def transactional_session(function):
     def new_funct(*args, **kwargs):
         if not kwargs.get('session'):
             session = get_session()
+            start = time.time() if metrics.is_enabled() else None
+            status = 'failed'
+            previous_caller = profiler.set_caller(function)
             try:
                 kwargs['session'] = session
                 result = function(*args, **kwargs)
                 session.commit()  # pylint: disable=maybe-no-member
+                status = 'success'
             except TimeoutError as error:
                 print(error)
                 session.rollback()  # pylint: disable=maybe-no-member
@@ -346,6 +400,9 @@ def transactional_session(function):
                 raise
             finally:
                 session.remove()  # pylint: disable=maybe-no-member
+                if start is not None:
+                    record_session_metrics('transactional', function, start, status)
+                profiler.reset_caller(previous_caller)
         else:
             result = function(*args, **kwargs)
         return result
@@ -23,7 +23,7 @@ from sqlalchemy.dialects.mysql import BINARY
 from sqlalchemy.types import TypeDecorator, CHAR, String, Integer
 import sqlalchemy.types as types
 
-from idds.common.utils import json_dumps, json_loads
+from idds.common.serializer import dumps, loads, LazyJSON
 
 
 class GUID(TypeDecorator):
@@ -80,10 +80,17 @@ class JSON(TypeDecorator):
     """
     Platform independent json type
     JSONB for postgres , JSON for the rest
+
+    With lazy=True, a string loaded from the database is returned as a LazyJSON proxy
+    which is only decoded when it's accessed.
     """
 
     impl = types.JSON
 
+    def __init__(self, lazy=False, *args, **kwargs):
+        super(JSON, self).__init__(*args, **kwargs)
+        self.lazy = lazy
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(JSONB())
@@ -98,24 +105,28 @@ class JSON(TypeDecorator):
     def process_bind_param(self, value, dialect):
         if value is None:
             return value
+        elif isinstance(value, LazyJSON):
+            return value.dumps()
         elif dialect.name == 'postgresql':
-            return json_dumps(value)
+            return dumps(value)
         elif dialect.name == 'oracle':
-            return json_dumps(value)
+            return dumps(value)
         elif dialect.name == 'mysql':
-            return json_dumps(value)
+            return dumps(value)
         else:
-            return json_dumps(value)
+            return dumps(value)
 
     def process_result_value(self, value, dialect):
         if value is None:
             return value
+        elif self.lazy and isinstance(value, str):
+            return LazyJSON(value)
         elif dialect.name == 'oracle':
-            return json_loads(value)
+            return loads(value)
         elif dialect.name == 'mysql':
-            return json_loads(value)
+            return loads(value)
         else:
-            return json_loads(value)
+            return loads(value)
 
 
 class EnumWithValue(TypeDecorator):
@@ -130,10 +141,12 @@ class EnumWithValue(TypeDecorator):
         self._enumtype = enumtype
 
     def process_bind_param(self, value, dialect):
-        if isinstance(value, int):
+        if value is None or isinstance(value, int):
             return value
 
         return value.value
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return value
         return self._enumtype(value)
@@ -13,8 +13,12 @@
 Utils to create the database or destroy the database
 """
 
+import datetime
+import itertools
 import traceback
 
+from sqlalchemy import inspect
+from sqlalchemy.orm import defer
 from sqlalchemy.engine import reflection
 from sqlalchemy.schema import DropTable, DropConstraint, ForeignKeyConstraint, MetaData, Table
 
@@ -105,3 +109,232 @@ def rows2dict(rows):
             row_dict[str(col)] = row[col]
         results.append(row_dict)
     return results
+
+
+def get_metadata_columns(model):
+    """
+    Get the names of the json metadata columns of the model.
+
+    :param model: The model class.
+
+    :returns: list of column names.
+    """
+    return [column.name for column in model.__table__.columns if column.name.endswith('_metadata')]
+
+
+def query_columns(model, columns=None, with_metadata=True, session=None):
+    """
+    Start a query on the model, or only on some columns of the model.
+
+    :param model: The model class.
+    :param columns: list of column names. The whole model is queried if it's None.
+    :param with_metadata: When the whole model is queried, whether to load the json metadata columns.
+                          If False, they are deferred and not included in the returned dicts.
+    :param session: The database session in use.
+
+    :returns: query.
+    """
+    if columns:
+        return session.query(*[getattr(model, column) for column in columns])
+    query = session.query(model)
+    if not with_metadata:
+        query = query.options(*[defer(getattr(model, column)) for column in get_metadata_columns(model)])
+    return query
+
+
+def fetch_rows(query, columns=None, raw=False, to_json=False, session=None):
+    """
+    Fetch the results of a query started with query_columns.
+
+    :param query: The query.
+    :param columns: list of column names used to start the query.
+    :param raw: Execute the query as a Core select and return the rows as they are: tuples
+                with fields accessible by name. No ORM object is built.
+    :param to_json: return json format. Ignored in raw mode.
+    :param session: The database session in use.
+
+    :returns: list of dicts, or list of rows in raw mode.
+    """
+    if raw:
+        return session.execute(query.statement).fetchall()
+
+    rets = []
+    if columns:
+        for row in query.all():
+            if to_json:
+                rets.append(dict((column, models.ModelBase._expand_item(value)) for column, value in zip(columns, row)))
+            else:
+                rets.append(dict(zip(columns, row)))
+    else:
+        for t in query.all():
+            if to_json:
+                rets.append(t.to_dict_json())
+            else:
+                rets.append(t.to_dict())
+    return rets
+
+
+# Oracle doesn't accept more than 1000 expressions in an IN list (ORA-01795).
+MAX_IN_LIST_SIZE = 1000
+
+
+def chunk_list(values, bulk_size=MAX_IN_LIST_SIZE):
+    """
+    Split the values for IN lists. Duplicated values are removed and the order is kept.
+
+    :param values: list of values.
+    :param bulk_size: max number of values per chunk.
+
+    :returns: list of lists.
+    """
+    seen = set()
+    unique_values = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique_values.append(value)
+    return [unique_values[i:i + bulk_size] for i in range(0, len(unique_values), bulk_size)]
+
+
+def fetch_in_chunks(query, column, values, bulk_size=MAX_IN_LIST_SIZE, columns=None, raw=False, to_json=False, session=None):
+    """
+    Fetch the results of a query filtered by 'column IN values', with one statement per chunk of values,
+    so that the IN lists stay small whatever the number of values is.
+    The results are concatenated chunk by chunk, so an order_by of the query only applies inside a chunk.
+
+    :param query: The query, started with query_columns.
+    :param column: The column to filter.
+    :param values: list of values.
+    :param bulk_size: max number of values per statement.
+    :param columns, raw, to_json: as in fetch_rows.
+    :param session: The database session in use.
+
+    :returns: list of dicts, or list of rows in raw mode.
+    """
+    rets = []
+    for chunk in chunk_list(values, bulk_size):
+        rets += fetch_rows(query.filter(column.in_(chunk)), columns=columns, raw=raw, to_json=to_json, session=session)
+    return rets
+
+
+def update_in_chunks(query, column, values, parameters, bulk_size=MAX_IN_LIST_SIZE):
+    """
+    Update the rows of a query filtered by 'column IN values', with one statement per chunk of values.
+
+    :param query: The query.
+    :param column: The column to filter.
+    :param values: list of values.
+    :param parameters: dict of the new values.
+    :param bulk_size: max number of values per statement.
+
+    :returns: number of updated rows.
+    """
+    num_rows = 0
+    for chunk in chunk_list(values, bulk_size):
+        num_rows += query.filter(column.in_(chunk)).update(parameters, synchronize_session=False)
+    return num_rows
+
+
+def delete_in_chunks(query, column, values, bulk_size=MAX_IN_LIST_SIZE):
+    """
+    Delete the rows of a query filtered by 'column IN values', with one statement per chunk of values.
+
+    :param query: The query.
+    :param column: The column to filter.
+    :param values: list of values.
+    :param bulk_size: max number of values per statement.
+
+    :returns: number of deleted rows.
+    """
+    num_rows = 0
+    for chunk in chunk_list(values, bulk_size):
+        num_rows += query.filter(column.in_(chunk)).delete(synchronize_session=False)
+    return num_rows
+
+
+def is_skip_locked_supported(session):
+    """
+    Whether the database behind the session supports SELECT ... FOR UPDATE SKIP LOCKED.
+
+    Oracle and PostgreSQL (>= 9.5) support it. MySQL supports it from 8.0.1, MariaDB doesn't.
+
+    :param session: The database session in use.
+
+    :returns: True if SKIP LOCKED is supported.
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name in ['oracle', 'postgresql']:
+        return True
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            return False
+        version = getattr(dialect, 'server_version_info', None)
+        if version and tuple(version[:3]) >= (8, 0, 1):
+            return True
+    return False
+
+
+def claim_rows(query, model, idle, locked, bulk_size=None, column='locking', session=None):
+    """
+    Atomically claim the rows selected by a query: set locking from idle to locked and return the claimed rows.
+
+    The query should already filter on locking == idle and define the ordering.
+    Another column than locking can be used for the claim, e.g. to move messages from New to Fetched.
+    With Oracle, PostgreSQL and MySQL >= 8.0.1, the rows are selected with FOR UPDATE SKIP LOCKED,
+    so concurrent pollers don't wait for each other and never claim the same row.
+    Otherwise (SQLite, old MySQL) the candidates are claimed with one conditional UPDATE
+    and only the rows really switched by this UPDATE are returned. On these backends,
+    running several agents of the same type is only safe with this fallback, not scalable.
+
+    :param query: The query (on model) selecting the candidate rows.
+    :param model: The model class of the rows.
+    :param idle: The idle locking value.
+    :param locked: The locking value to set.
+    :param bulk_size: The max number of rows to claim.
+    :param column: The name of the column which is switched from idle to locked.
+    :param session: The database session in use.
+
+    :returns: list of claimed model objects, in the order of the query. The objects keep the
+              values read before the claim, e.g. locking is still idle.
+    """
+    id_column = inspect(model).primary_key[0]
+    claim_column = getattr(model, column)
+    dialect_name = session.get_bind().dialect.name
+    claim_time = datetime.datetime.utcnow()
+
+    if is_skip_locked_supported(session):
+        query = query.with_for_update(skip_locked=True)
+        if dialect_name == 'oracle':
+            # ROWNUM with FOR UPDATE raises ORA-02014. Rows are locked while being fetched,
+            # so only fetch the first bulk_size rows.
+            rows = query.yield_per(bulk_size or 1000)
+            if bulk_size:
+                rows = itertools.islice(rows, bulk_size)
+            rows = list(rows)
+        else:
+            if bulk_size:
+                query = query.limit(bulk_size)
+            rows = query.all()
+
+        ids = [getattr(row, id_column.key) for row in rows]
+        if ids:
+            update_in_chunks(session.query(model), id_column, ids, {column: locked, 'updated_at': claim_time})
+        return rows
+
+    if dialect_name == 'mysql':
+        # DATETIME columns without fsp drop the microseconds
+        claim_time = claim_time.replace(microsecond=0)
+
+    if bulk_size:
+        query = query.limit(bulk_size)
+    rows = query.all()
+    ids = [getattr(row, id_column.key) for row in rows]
+    if not ids:
+        return []
+
+    update_in_chunks(session.query(model).filter(claim_column == idle), id_column, ids,
+                     {column: locked, 'updated_at': claim_time})
+
+    query = session.query(id_column).filter(claim_column == locked).filter(model.updated_at == claim_time)
+    claimed_ids = set([row[0] for row in fetch_in_chunks(query, id_column, ids, raw=True, session=session)])
+    return [row for row in rows if getattr(row, id_column.key) in claimed_ids]
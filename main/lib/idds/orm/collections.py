@@ -20,15 +20,17 @@ from sqlalchemy.exc import DatabaseError, IntegrityError
 from sqlalchemy.sql.expression import asc
 
 from idds.common import exceptions
-from idds.common.constants import CollectionType, CollectionStatus, CollectionLocking, CollectionRelationType
+from idds.common.constants import (CollectionType, CollectionStatus, CollectionLocking, CollectionRelationType,
+                                   ContentStatus)
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import claim_rows, query_columns, fetch_rows, fetch_in_chunks, MAX_IN_LIST_SIZE
 
 
 def create_collection(scope, name, coll_type=CollectionType.Dataset, transform_id=None,
                       relation_type=CollectionRelationType.Input, bytes=0, status=CollectionStatus.New,
-                      locking=CollectionLocking.Idle, total_files=0, retries=0, expired_at=None,
-                      coll_metadata=None):
+                      locking=CollectionLocking.Idle, total_files=0, new_files=0, processing_files=0,
+                      processed_files=0, retries=0, expired_at=None, coll_metadata=None):
     """
     Create a collection.
 
@@ -42,6 +44,9 @@ def create_collection(scope, name, coll_type=CollectionType.Dataset, transform_i
     :param status: The status.
     :param locking: The locking.
     :param total_files: Number of total files.
+    :param new_files: Number of new files.
+    :param processing_files: Number of processing files.
+    :param processed_files: Number of processed files.
     :param retries: Number of retries.
     :param expired_at: The datetime when it expires.
     :param coll_metadata: The metadata as json.
@@ -50,7 +55,8 @@ def create_collection(scope, name, coll_type=CollectionType.Dataset, transform_i
     """
     new_coll = models.Collection(scope=scope, name=name, coll_type=coll_type, transform_id=transform_id,
                                  relation_type=relation_type, bytes=bytes, status=status, locking=locking,
-                                 total_files=total_files, retries=retries, expired_at=expired_at,
+                                 total_files=total_files, new_files=new_files, processing_files=processing_files,
+                                 processed_files=processed_files, retries=retries, expired_at=expired_at,
                                  coll_metadata=coll_metadata)
     return new_coll
 
@@ -58,8 +64,8 @@ def create_collection(scope, name, coll_type=CollectionType.Dataset, transform_i
 @transactional_session
 def add_collection(scope, name, coll_type=CollectionType.Dataset, transform_id=None,
                    relation_type=CollectionRelationType.Input, bytes=0, status=CollectionStatus.New,
-                   locking=CollectionLocking.Idle, total_files=0, retries=0, expired_at=None,
-                   coll_metadata=None, session=None):
+                   locking=CollectionLocking.Idle, total_files=0, new_files=0, processing_files=0,
+                   processed_files=0, retries=0, expired_at=None, coll_metadata=None, session=None):
     """
     Add a collection.
 
@@ -73,6 +79,9 @@ def add_collection(scope, name, coll_type=CollectionType.Dataset, transform_id=N
     :param status: The status.
     :param locking: The locking.
     :param total_files: Number of total files.
+    :param new_files: Number of new files.
+    :param processing_files: Number of processing files.
+    :param processed_files: Number of processed files.
     :param retries: Number of retries.
     :param expired_at: The datetime when it expires.
     :param coll_metadata: The metadata as json.
@@ -85,10 +94,12 @@ def add_collection(scope, name, coll_type=CollectionType.Dataset, transform_id=N
     try:
         new_coll = create_collection(scope=scope, name=name, coll_type=coll_type, transform_id=transform_id,
                                      relation_type=relation_type, bytes=bytes, status=status, locking=locking,
-                                     total_files=total_files, retries=retries, expired_at=expired_at,
+                                     total_files=total_files, new_files=new_files, processing_files=processing_files,
+                                     processed_files=processed_files, retries=retries, expired_at=expired_at,
                                      coll_metadata=coll_metadata)
         new_coll.save(session=session)
         coll_id = new_coll.coll_id
+        add_collection_counters(coll_id, session=session)
         return coll_id
     except IntegrityError as error:
         raise exceptions.DuplicatedObject('Collection scope:name(%s:%s) with transform_id(%s) already exists!: %s' %
@@ -251,6 +262,50 @@ def get_collections_by_status(status, relation_type=CollectionRelationType.Input
         raise error
 
 
+@transactional_session
+def claim_collections_by_status(status, relation_type=CollectionRelationType.Input, time_period=None,
+                                bulk_size=None, to_json=False, session=None):
+    """
+    Get unlocked collections and lock them in the same transaction.
+    Concurrent agents never get the same collection.
+
+    :param status: The collection status.
+    :param relation_type: The relation_type of the collection to the transform.
+    :param time_period: time period in seconds since last update.
+    :param bulk_size: bulk size limitation.
+    :param to_json: return json format.
+    :param session: The database session in use.
+
+    :returns: list of claimed Collections.
+    """
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    if len(status) == 1:
+        status = [status[0], status[0]]
+
+    query = session.query(models.Collection)\
+                   .filter(models.Collection.status.in_(status))\
+                   .filter(models.Collection.next_poll_at < datetime.datetime.utcnow())\
+                   .filter(models.Collection.locking == CollectionLocking.Idle)
+
+    if relation_type is not None:
+        query = query.filter(models.Collection.relation_type == relation_type)
+    if time_period:
+        query = query.filter(models.Collection.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=time_period))
+
+    query = query.order_by(asc(models.Collection.updated_at))
+
+    tmp = claim_rows(query, models.Collection, CollectionLocking.Idle, CollectionLocking.Locking,
+                     bulk_size=bulk_size, session=session)
+    rets = []
+    for t in tmp:
+        if to_json:
+            rets.append(t.to_dict_json())
+        else:
+            rets.append(t.to_dict())
+    return rets
+
+
 @read_session
 def get_collections(scope=None, name=None, transform_id=None, relation_type=None, to_json=False, session=None):
     """
@@ -276,22 +331,17 @@ def get_collections(scope=None, name=None, transform_id=None, relation_type=None
             query = query.filter(models.Collection.scope == scope)
         if name:
             query = query.filter(models.Collection.name.like(name.replace('*', '%')))
-        if transform_id:
-            query = query.filter(models.Collection.transform_id.in_(transform_id))
         if relation_type:
             query = query.filter(models.Collection.relation_type == relation_type)
 
         query = query.order_by(asc(models.Collection.updated_at))
 
-        tmp = query.all()
-        rets = []
-        if tmp:
-            for t in tmp:
-                if to_json:
-                    rets.append(t.to_dict_json())
-                else:
-                    rets.append(t.to_dict())
-        return rets
+        if transform_id:
+            rets = fetch_in_chunks(query, models.Collection.transform_id, transform_id, to_json=to_json, session=session)
+            if len(transform_id) > MAX_IN_LIST_SIZE:
+                rets.sort(key=lambda coll: coll['updated_at'])
+            return rets
+        return fetch_rows(query, to_json=to_json, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('No collection with  scope(%s), name(%s), transform_id(%s): %s, relation_type: %s' %
                                   (scope, name, transform_id, relation_type, error))
@@ -333,14 +383,105 @@ def update_collections(parameters, session=None):
 
     """
     try:
-        for parameter in parameters:
-            parameter['updated_at'] = datetime.datetime.utcnow()
+        # the parameters can be the collections kept in a work, don't change them.
+        now = datetime.datetime.utcnow()
+        parameters = [dict(parameter, updated_at=now) for parameter in parameters]
 
         session.bulk_update_mappings(models.Collection, parameters)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('Collection cannot be found: %s' % (error))
 
 
+@read_session
+def get_collections_by_ids(coll_ids, columns=None, session=None):
+    """
+    Get collections by ids.
+
+    :param coll_ids: list of collection ids.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param session: The database session in use.
+
+    :returns: list of collections.
+    """
+    if not coll_ids:
+        return []
+    query = query_columns(models.Collection, columns=columns, session=session)
+    return fetch_in_chunks(query, models.Collection.coll_id, coll_ids, columns=columns, session=session)
+
+
+@transactional_session
+def add_collection_counters(coll_id, counts=None, session=None):
+    """
+    Add the per status counters of the contents of a collection.
+    A counter is added for every content status, so that later changes only need to update them.
+
+    :param coll_id: the collection id.
+    :param counts: dict of content status and number of contents, for collections which already have contents.
+    :param session: The database session in use.
+
+    :raises DuplicatedObject: If the counters already exist.
+    :raises DatabaseException: If there is a database error.
+    """
+    counts = counts or {}
+    now = datetime.datetime.utcnow()
+    counters = []
+    for status in ContentStatus:
+        num_files = counts.get(status, 0) + counts.get(status.value, 0)
+        counters.append({'coll_id': coll_id, 'status': status, 'num_files': num_files, 'updated_at': now})
+    try:
+        session.bulk_insert_mappings(models.CollectionCounter, counters)
+    except IntegrityError as error:
+        raise exceptions.DuplicatedObject('Counters of collection %s already exist: %s' % (coll_id, error))
+    except DatabaseError as error:
+        raise exceptions.DatabaseException(error)
+
+
+@read_session
+def get_collection_counters(coll_id, lock=False, session=None):
+    """
+    Get the per status counters of the contents of a collection.
+
+    :param coll_id: the collection id.
+    :param lock: Lock the collection row first and read the latest committed counters,
+                 so that only one transaction at a time initializes the counters of the collection.
+    :param session: The database session in use.
+
+    :returns: dict of content status and number of contents. None if the collection has no counters.
+    """
+    if lock:
+        session.query(models.Collection.coll_id).filter(models.Collection.coll_id == coll_id).with_for_update().first()
+    query = session.query(models.CollectionCounter.status, models.CollectionCounter.num_files)
+    query = query.filter(models.CollectionCounter.coll_id == coll_id)
+    if lock:
+        query = query.with_for_update()
+    tmp = query.all()
+    if not tmp:
+        return None
+    return dict((status, num_files) for status, num_files in tmp)
+
+
+@transactional_session
+def update_collection_counters(deltas, session=None):
+    """
+    Change the per status counters of the contents of collections, in the transaction which changes the contents.
+    The counters are updated in (coll_id, status) order, so that concurrent transactions don't deadlock.
+
+    :param deltas: dict of (coll_id, content status) and the change of the number of contents.
+    :param session: The database session in use.
+    """
+    now = datetime.datetime.utcnow()
+    for coll_id, status in sorted(deltas.keys(), key=lambda key: (key[0], key[1].value)):
+        delta = deltas[(coll_id, status)]
+        if not delta:
+            continue
+        session.query(models.CollectionCounter)\
+               .filter(models.CollectionCounter.coll_id == coll_id)\
+               .filter(models.CollectionCounter.status == status)\
+               .update({models.CollectionCounter.num_files: models.CollectionCounter.num_files + delta,
+                        models.CollectionCounter.updated_at: now},
+                       synchronize_session=False)
+
+
 @transactional_session
 def delete_collection(coll_id=None, session=None):
     """
@@ -353,6 +494,7 @@ def delete_collection(coll_id=None, session=None):
     :raises DatabaseException: If there is a database error.
     """
     try:
+        session.query(models.CollectionCounter).filter_by(coll_id=coll_id).delete()
         session.query(models.Collection).filter_by(coll_id=coll_id).delete()
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('Collection %s cannot be found: %s' % (coll_id, error))
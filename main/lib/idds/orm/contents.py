@@ -22,8 +22,39 @@ from sqlalchemy.sql.expression import asc
 
 from idds.common import exceptions
 from idds.common.constants import ContentType, ContentStatus, ContentLocking
-from idds.orm.base.session import read_session, transactional_session
+from idds.orm.base.session import read_session, stream_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import query_columns, fetch_rows, chunk_list, MAX_IN_LIST_SIZE
+from idds.orm.collections import update_collection_counters
+
+
+def get_content_status(status):
+    if isinstance(status, ContentStatus):
+        return status
+    return ContentStatus(status)
+
+
+def get_current_statuses(content_ids, session=None):
+    """
+    Get the current statuses of contents which are going to be changed. The contents are locked
+    until the end of the transaction, so that concurrent changes count them from the right status.
+    They are locked in content_id order, so that concurrent transactions don't deadlock.
+
+    :returns: dict of content id and (coll_id, status).
+    """
+    ret = {}
+    for chunk in chunk_list(sorted(content_ids)):
+        query = session.query(models.Content.content_id, models.Content.coll_id, models.Content.status)
+        query = query.filter(models.Content.content_id.in_(chunk))
+        query = query.order_by(asc(models.Content.content_id)).with_for_update()
+        for content_id, coll_id, status in query:
+            ret[content_id] = (coll_id, get_content_status(status))
+    return ret
+
+
+def add_counter_delta(deltas, coll_id, status, delta):
+    key = (coll_id, get_content_status(status))
+    deltas[key] = deltas.get(key, 0) + delta
 
 
 def create_content(transform_id, coll_id, map_id, scope, name, min_id, max_id, content_type=ContentType.File,
@@ -105,6 +136,7 @@ def add_content(transform_id, coll_id, map_id, scope, name, min_id=0, max_id=0,
                                      content_metadata=content_metadata)
         new_content.save(session=session)
         content_id = new_content.content_id
+        update_collection_counters({(coll_id, get_content_status(status)): 1}, session=session)
         return content_id
     except IntegrityError as error:
         raise exceptions.DuplicatedObject('Content transform_id:map_id(%s:%s) already exists!: %s' %
@@ -145,6 +177,12 @@ def add_contents(contents, bulk_size=1000, session=None):
     try:
         for sub_param in sub_params:
             session.bulk_insert_mappings(models.Content, sub_param)
+
+        deltas = {}
+        for content in contents:
+            add_counter_delta(deltas, content['coll_id'], content['status'], 1)
+        update_collection_counters(deltas, session=session)
+
         content_ids = [None for _ in range(len(contents))]
         return content_ids
     except IntegrityError as error:
@@ -260,13 +298,16 @@ def get_match_contents(coll_id, scope, name, content_type=None, min_id=None, max
 
 
 @read_session
-def get_contents(scope=None, name=None, coll_id=None, status=None, to_json=False, session=None):
+def get_contents(scope=None, name=None, coll_id=None, status=None, columns=None, raw=False, to_json=False, session=None):
     """
     Get content or raise a NoObject exception.
 
     :param scope: The scope of the content data.
     :param name: The name of the content data.
     :param coll_id: Collection id.
+    :param status: Content status or list of content status.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name.
     :param to_json: return json format.
 
     :param session: The database session in use.
@@ -283,7 +324,7 @@ def get_contents(scope=None, name=None, coll_id=None, status=None, to_json=False
             if len(status) == 1:
                 status = [status[0], status[0]]
 
-        query = session.query(models.Content)
+        query = query_columns(models.Content, columns=columns, session=session)
         if coll_id:
             query = query.filter(models.Content.coll_id == coll_id)
         if scope:
@@ -293,15 +334,7 @@ def get_contents(scope=None, name=None, coll_id=None, status=None, to_json=False
         if status:
             query = query.filter(models.Content.status.in_(status))
 
-        tmp = query.all()
-        rets = []
-        if tmp:
-            for t in tmp:
-                if to_json:
-                    rets.append(t.to_dict_json())
-                else:
-                    rets.append(t.to_dict())
-        return rets
+        return fetch_rows(query, columns=columns, raw=raw, to_json=to_json, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('No record can be found with (scope=%s, name=%s, coll_id=%s): %s' %
                                   (scope, name, coll_id, error))
@@ -344,6 +377,99 @@ def get_contents_by_transform(transform_id, to_json=False, session=None):
         raise error
 
 
+@stream_session
+def iter_contents_by_transform(transform_id, columns=None, updated_after=None, bulk_size=1000, session=None):
+    """
+    Iterate the contents of a transform in map_id order.
+    Rows are fetched bulk_size by bulk_size (server side cursor where the driver supports it),
+    so the memory doesn't grow with the number of contents.
+
+    :param transform_id: transform id.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param updated_after: If set, only the contents updated at or after this datetime.
+    :param bulk_size: number of rows fetched per round trip.
+
+    :param session: The database session in use.
+
+    :returns: generator of contents as dicts.
+    """
+    if columns:
+        query = session.query(*[getattr(models.Content, column) for column in columns])
+    else:
+        query = session.query(models.Content)
+    query = query.filter(models.Content.transform_id == transform_id)
+    if updated_after:
+        query = query.filter(models.Content.updated_at >= updated_after)
+    query = query.order_by(asc(models.Content.map_id)).order_by(asc(models.Content.content_id))
+
+    for row in query.yield_per(bulk_size):
+        if columns:
+            yield dict(zip(columns, row))
+        else:
+            yield row.to_dict()
+
+
+@read_session
+def get_num_contents_by_transform(transform_id, session=None):
+    """
+    Get the number of contents of a transform.
+
+    :param transform_id: transform id.
+
+    :param session: The database session in use.
+
+    :returns: number of contents.
+    """
+    try:
+        query = session.query(func.count(models.Content.content_id))
+        query = query.filter(models.Content.transform_id == transform_id)
+        return query.scalar()
+    except Exception as error:
+        raise error
+
+
+@read_session
+def get_content_ids_by_keys(coll_id, contents, bulk_size=1000, session=None):
+    """
+    Get the ids of the contents of a collection by their keys.
+    Only the rows with the names of the given contents are read, bulk_size names per query.
+
+    :param coll_id: Collection id.
+    :param contents: list of contents, with scope, name, min_id and max_id.
+    :param bulk_size: number of names per query.
+    :param session: The database session in use.
+
+    :returns: dict of (scope, name, min_id, max_id) and content id. If there are several
+              contents with the same key, the first one is returned.
+    """
+    names = sorted(set(content['name'] for content in contents))
+    content_ids = {}
+    for chunk in chunk_list(names, min(bulk_size, MAX_IN_LIST_SIZE)):
+        query = session.query(models.Content.scope, models.Content.name, models.Content.min_id,
+                              models.Content.max_id, models.Content.content_id)
+        query = query.filter(models.Content.coll_id == coll_id)
+        query = query.filter(models.Content.name.in_(chunk))
+        query = query.order_by(asc(models.Content.content_id))
+        for scope, name, min_id, max_id, content_id in query:
+            content_ids.setdefault((scope, name, min_id, max_id), content_id)
+    return content_ids
+
+
+@read_session
+def get_existing_content_keys(coll_id, contents, bulk_size=1000, session=None):
+    """
+    Get the keys of the contents which already exist in a collection.
+
+    :param coll_id: Collection id.
+    :param contents: list of candidate contents, with scope, name, min_id and max_id.
+    :param bulk_size: number of names per query.
+    :param session: The database session in use.
+
+    :returns: set of (scope, name, min_id, max_id).
+    """
+    return set(get_content_ids_by_keys(coll_id, contents, bulk_size=bulk_size, session=session).keys())
+
+
 @read_session
 def get_content_status_statistics(coll_id=None, session=None):
     """
@@ -385,8 +511,15 @@ def update_content(content_id, parameters, session=None):
     try:
         parameters['updated_at'] = datetime.datetime.utcnow()
 
+        deltas = {}
+        if parameters.get('status', None) is not None:
+            for coll_id, status in get_current_statuses([content_id], session=session).values():
+                add_counter_delta(deltas, coll_id, status, -1)
+                add_counter_delta(deltas, coll_id, parameters['status'], 1)
+
         session.query(models.Content).filter_by(content_id=content_id)\
                .update(parameters, synchronize_session=False)
+        update_collection_counters(deltas, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('Content %s cannot be found: %s' % (content_id, error))
 
@@ -407,7 +540,19 @@ def update_contents(parameters, session=None):
         for parameter in parameters:
             parameter['updated_at'] = datetime.datetime.utcnow()
 
+        deltas = {}
+        status_changes = [parameter for parameter in parameters if parameter.get('status', None) is not None]
+        if status_changes:
+            current = get_current_statuses(set(parameter['content_id'] for parameter in status_changes), session=session)
+            for parameter in status_changes:
+                if parameter['content_id'] in current:
+                    coll_id, status = current[parameter['content_id']]
+                    add_counter_delta(deltas, coll_id, status, -1)
+                    add_counter_delta(deltas, coll_id, parameter['status'], 1)
+                    current[parameter['content_id']] = (coll_id, get_content_status(parameter['status']))
+
         session.bulk_update_mappings(models.Content, parameters)
+        update_collection_counters(deltas, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('Content cannot be found: %s' % (error))
 
@@ -424,6 +569,11 @@ def delete_content(content_id=None, session=None):
     :raises DatabaseException: If there is a database error.
     """
     try:
+        deltas = {}
+        for coll_id, status in get_current_statuses([content_id], session=session).values():
+            add_counter_delta(deltas, coll_id, status, -1)
+
         session.query(models.Content).filter_by(content_id=content_id).delete()
+        update_collection_counters(deltas, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('Content %s cannot be found: %s' % (content_id, error))
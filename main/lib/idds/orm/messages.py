@@ -14,18 +14,74 @@ operations related to Messages.
 """
 
 import re
-import copy
+import datetime
 
-from sqlalchemy import or_
 from sqlalchemy.exc import DatabaseError, IntegrityError
 
 from idds.common import exceptions
+from idds.common.constants import MessageStatus
 from idds.orm.base import models
 from idds.orm.base.session import read_session, transactional_session
+from idds.orm.base.utils import claim_rows, delete_in_chunks, update_in_chunks
 
 
 @transactional_session
-def add_message(msg_type, status, source, transform_id, num_contents, msg_content, bulk_size=None, session=None):
+def coalesce_file_message(msg_type, source, transform_id, msg_content, files, bulk_size=None,
+                          coalesce_window=None, session=None):
+    """
+    Append files to a pending message of the same transform and msg_type, which is still New
+    and created in the last coalesce_window seconds.
+
+    :param msg_type: The type of the msg as a number, e.g., finished_stagein.
+    :param source: The source where the message is from.
+    :param transform_id: The transform id.
+    :param msg_content: The message msg_content as JSON. The other items than 'files' should be the same.
+    :param files: The files to append.
+    :param bulk_size: Max number of files in one message.
+    :param coalesce_window: in seconds.
+    :param session: The database session.
+
+    :returns: Number of appended files, which are the first ones of the files.
+    """
+    query = session.query(models.Message)\
+                   .filter(models.Message.transform_id == transform_id)\
+                   .filter(models.Message.msg_type == msg_type)\
+                   .filter(models.Message.status == MessageStatus.New)\
+                   .filter(models.Message.source == source)\
+                   .filter(models.Message.created_at >= datetime.datetime.utcnow() - datetime.timedelta(seconds=coalesce_window))
+    if bulk_size:
+        query = query.filter(models.Message.num_contents < bulk_size)
+    message = query.order_by(models.Message.created_at.desc()).first()
+    if message is None or not message.msg_content or 'files' not in message.msg_content:
+        return 0
+    for key in msg_content:
+        if key != 'files' and message.msg_content.get(key, None) != msg_content[key]:
+            return 0
+
+    num_files = len(files)
+    if bulk_size:
+        num_files = min(num_files, bulk_size - message.num_contents)
+    if num_files <= 0:
+        return 0
+
+    new_msg_content = dict(message.msg_content)
+    new_msg_content['files'] = message.msg_content['files'] + files[:num_files]
+    # The message is not locked. It's only updated if it's not claimed by the conductor
+    # nor updated by another transaction (num_contents is the version) in the meantime.
+    num_updated = session.query(models.Message)\
+                         .filter(models.Message.msg_id == message.msg_id)\
+                         .filter(models.Message.status == MessageStatus.New)\
+                         .filter(models.Message.num_contents == message.num_contents)\
+                         .update({'msg_content': new_msg_content,
+                                  'num_contents': message.num_contents + num_files,
+                                  'updated_at': datetime.datetime.utcnow()},
+                                 synchronize_session=False)
+    return num_files if num_updated else 0
+
+
+@transactional_session
+def add_message(msg_type, status, source, transform_id, num_contents, msg_content, bulk_size=None,
+                coalesce_window=None, session=None):
     """
     Add a message to be submitted asynchronously to a message broker.
 
@@ -35,18 +91,34 @@ def add_message(msg_type, status, source, transform_id, num_contents, msg_conten
     :param transform_id: The transform id.
     :param num_contents: Number of items in msg_content.
     :param msg_content: The message msg_content as JSON.
+    :param bulk_size: Max number of files in one message. Messages with more files are split.
+    :param coalesce_window: If it's set, the files are first appended to a pending message of the same
+                            transform and msg_type, created in the last coalesce_window seconds.
     :param session: The database session.
     """
 
     try:
         num_contents_list = []
         msg_content_list = []
+        files = msg_content['files'] if msg_content and 'files' in msg_content else None
+        if files and coalesce_window and status == MessageStatus.New:
+            num_coalesced = coalesce_file_message(msg_type=msg_type, source=source, transform_id=transform_id,
+                                                  msg_content=msg_content, files=files, bulk_size=bulk_size,
+                                                  coalesce_window=coalesce_window, session=session)
+            if num_coalesced:
+                files = files[num_coalesced:]
+                if not files:
+                    return
+                msg_content = dict(msg_content)
+                msg_content['files'] = files
+                num_contents = len(files)
+
         if bulk_size and num_contents > bulk_size:
-            if 'files' in msg_content:
-                files = msg_content['files']
+            if files:
                 chunks = [files[i:i + bulk_size] for i in range(0, len(files), bulk_size)]
                 for chunk in chunks:
-                    new_msg_content = copy.deepcopy(msg_content)
+                    # only 'files' differs between the chunks
+                    new_msg_content = dict(msg_content)
                     new_msg_content['files'] = chunk
                     new_num_contents = len(chunk)
                     num_contents_list.append(new_num_contents)
@@ -113,16 +185,13 @@ def delete_messages(messages, session=None):
 
     :param messages: The messages to delete as a list of dictionaries.
     """
-    message_condition = []
-    for message in messages:
-        message_condition.append(models.Message.msg_id == message['msg_id'])
+    msg_ids = [message['msg_id'] for message in messages]
 
     try:
-        if message_condition:
-            session.query(models.Message).\
-                with_hint(models.Message, "index(messages MESSAGES_PK)", 'oracle').\
-                filter(or_(*message_condition)).\
-                delete(synchronize_session=False)
+        if msg_ids:
+            query = session.query(models.Message).\
+                with_hint(models.Message, "index(messages MESSAGES_PK)", 'oracle')
+            delete_in_chunks(query, models.Message.msg_id, msg_ids)
     except IntegrityError as e:
         raise exceptions.DatabaseException(e.args)
 
@@ -131,11 +200,75 @@ def delete_messages(messages, session=None):
 def update_messages(messages, session=None):
     """
     Update all messages status with the given IDs.
+    The messages are grouped by the new status, with one UPDATE per status and chunk of ids.
 
     :param messages: The messages to be updated as a list of dictionaries.
     """
+    msg_ids_by_status = {}
+    for msg in messages:
+        msg_ids_by_status.setdefault(msg['status'], []).append(msg['msg_id'])
+
+    try:
+        now = datetime.datetime.utcnow()
+        for status, msg_ids in msg_ids_by_status.items():
+            update_in_chunks(session.query(models.Message), models.Message.msg_id, msg_ids,
+                             {'status': status, 'updated_at': now})
+    except IntegrityError as e:
+        raise exceptions.DatabaseException(e.args)
+
+
+@transactional_session
+def claim_messages(bulk_size=1000, msg_type=None, source=None, min_age=None, session=None):
+    """
+    Claim up to bulk_size new messages: move them from New to Fetched atomically, so that
+    several conductors can share the messages without sending one twice.
+
+    :param bulk_size: Number of messages as an integer.
+    :param msg_type: Return only specified msg_type.
+    :param source: The source where the message is from.
+    :param min_age: Only claim the messages created more than min_age seconds ago,
+                    e.g. to leave time to coalesce file messages.
+    :param session: The database session.
+
+    :returns messages: List of dictionaries, with status Fetched.
+    """
+    try:
+        query = session.query(models.Message).filter(models.Message.status == MessageStatus.New)
+        if msg_type is not None:
+            query = query.filter(models.Message.msg_type == msg_type)
+        if source is not None:
+            query = query.filter(models.Message.source == source)
+        if min_age:
+            query = query.filter(models.Message.created_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=min_age))
+        query = query.order_by(models.Message.created_at)
+
+        tmp = claim_rows(query, models.Message, MessageStatus.New, MessageStatus.Fetched,
+                         bulk_size=bulk_size, column='status', session=session)
+        messages = []
+        for t in tmp:
+            message = t.to_dict()
+            message['status'] = MessageStatus.Fetched
+            messages.append(message)
+        return messages
+    except IntegrityError as e:
+        raise exceptions.DatabaseException(e.args)
+
+
+@transactional_session
+def release_messages(time_period=3600, session=None):
+    """
+    Move the messages which are Fetched for more than time_period seconds back to New,
+    e.g. when the conductor which claimed them was killed before delivering them.
+
+    :param time_period: in seconds.
+    :param session: The database session.
+
+    :returns: number of released messages.
+    """
     try:
-        for msg in messages:
-            session.query(models.Message).filter_by(msg_id=msg['msg_id']).update({'status': msg['status']}, synchronize_session=False)
+        return session.query(models.Message)\
+                      .filter(models.Message.status == MessageStatus.Fetched)\
+                      .filter(models.Message.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=time_period))\
+                      .update({'status': MessageStatus.New, 'updated_at': datetime.datetime.utcnow()}, synchronize_session=False)
     except IntegrityError as e:
         raise exceptions.DatabaseException(e.args)
@@ -23,6 +23,7 @@ from idds.common import exceptions
 from idds.common.constants import ProcessingStatus, ProcessingLocking, GranularityType
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import claim_rows, query_columns, fetch_rows
 
 
 def create_processing(transform_id, status=ProcessingStatus.New, locking=ProcessingLocking.Idle, submitter=None,
@@ -153,7 +154,8 @@ def get_processings_by_transform_id(transform_id=None, to_json=False, session=No
 
 
 @read_session
-def get_processings_by_status(status, period=None, locking=False, bulk_size=None, submitter=None, to_json=False, session=None):
+def get_processings_by_status(status, period=None, locking=False, bulk_size=None, submitter=None, columns=None, raw=False,
+                              with_metadata=True, to_json=False, session=None):
     """
     Get processing or raise a NoObject exception.
 
@@ -162,6 +164,9 @@ def get_processings_by_status(status, period=None, locking=False, bulk_size=None
     :param locking: Whether to retrieve only unlocked items.
     :param bulk_size: bulk size limitation.
     :param submitter: The submitter name.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name.
+    :param with_metadata: Whether to load processing_metadata and output_metadata when all columns are read.
     :param to_json: return json format.
 
     :param session: The database session in use.
@@ -177,9 +182,9 @@ def get_processings_by_status(status, period=None, locking=False, bulk_size=None
         if len(status) == 1:
             status = [status[0], status[0]]
 
-        query = session.query(models.Processing)\
-                       .filter(models.Processing.status.in_(status))\
-                       .filter(models.Processing.next_poll_at < datetime.datetime.utcnow())
+        query = query_columns(models.Processing, columns=columns, with_metadata=with_metadata, session=session)
+        query = query.filter(models.Processing.status.in_(status))\
+                     .filter(models.Processing.next_poll_at < datetime.datetime.utcnow())
 
         if period:
             query = query.filter(models.Processing.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=period))
@@ -193,21 +198,57 @@ def get_processings_by_status(status, period=None, locking=False, bulk_size=None
         if bulk_size:
             query = query.limit(bulk_size)
 
-        tmp = query.all()
-        rets = []
-        if tmp:
-            for t in tmp:
-                if to_json:
-                    rets.append(t.to_dict_json())
-                else:
-                    rets.append(t.to_dict())
-        return rets
+        return fetch_rows(query, columns=columns, raw=raw, to_json=to_json, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('No processing attached with status (%s): %s' % (status, error))
     except Exception as error:
         raise error
 
 
+@transactional_session
+def claim_processings_by_status(status, period=None, bulk_size=None, submitter=None, to_json=False, session=None):
+    """
+    Get unlocked processings and lock them in the same transaction.
+    Concurrent agents never get the same processing.
+
+    :param status: Processing status of list of processing status.
+    :param period: Time period in seconds.
+    :param bulk_size: bulk size limitation.
+    :param submitter: The submitter name.
+    :param to_json: return json format.
+
+    :param session: The database session in use.
+
+    :returns: list of claimed processings.
+    """
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    if len(status) == 1:
+        status = [status[0], status[0]]
+
+    query = session.query(models.Processing)\
+                   .filter(models.Processing.status.in_(status))\
+                   .filter(models.Processing.next_poll_at < datetime.datetime.utcnow())\
+                   .filter(models.Processing.locking == ProcessingLocking.Idle)
+
+    if period:
+        query = query.filter(models.Processing.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=period))
+    if submitter:
+        query = query.filter(models.Processing.submitter == submitter)
+
+    query = query.order_by(asc(models.Processing.updated_at))
+
+    tmp = claim_rows(query, models.Processing, ProcessingLocking.Idle, ProcessingLocking.Locking,
+                     bulk_size=bulk_size, session=session)
+    rets = []
+    for t in tmp:
+        if to_json:
+            rets.append(t.to_dict_json())
+        else:
+            rets.append(t.to_dict())
+    return rets
+
+
 @transactional_session
 def update_processing(processing_id, parameters, session=None):
     """
@@ -234,6 +275,30 @@ def update_processing(processing_id, parameters, session=None):
         raise exceptions.NoObject('Processing %s cannot be found: %s' % (processing_id, error))
 
 
+@transactional_session
+def update_processings(parameters, session=None):
+    """
+    update processings in bulk.
+
+    :param parameters: list of dictionary of parameters, with processing_id in every dictionary.
+    :param session: The database session in use.
+
+    :raises NoObject: If no processing is founded.
+    :raises DatabaseException: If there is a database error.
+
+    """
+    try:
+        for parameter in parameters:
+            parameter['updated_at'] = datetime.datetime.utcnow()
+            if 'status' in parameter and parameter['status'] in [ProcessingStatus.Finished, ProcessingStatus.Failed,
+                                                                 ProcessingStatus.Lost]:
+                parameter['finished_at'] = datetime.datetime.utcnow()
+
+        session.bulk_update_mappings(models.Processing, parameters)
+    except sqlalchemy.orm.exc.NoResultFound as error:
+        raise exceptions.NoObject('Processing cannot be found: %s' % (error))
+
+
 @transactional_session
 def delete_processing(processing_id=None, session=None):
     """
@@ -24,6 +24,7 @@ from idds.common import exceptions
 from idds.common.constants import RequestType, RequestStatus, RequestLocking
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import claim_rows, query_columns
 
 
 def create_request(scope=None, name=None, requester=None, request_type=None, transform_tag=None,
@@ -317,7 +318,8 @@ def get_requests_by_requester(scope, name, requester, to_json=False, session=Non
 
 
 @read_session
-def get_requests_by_status_type(status, request_type=None, time_period=None, locking=False, bulk_size=None, to_json=False, session=None):
+def get_requests_by_status_type(status, request_type=None, time_period=None, locking=False, bulk_size=None, with_metadata=True,
+                                to_json=False, session=None):
     """
     Get requests.
 
@@ -325,6 +327,7 @@ def get_requests_by_status_type(status, request_type=None, time_period=None, loc
     :param request_type: The type of the request data.
     :param locking: Wheter to lock requests to avoid others get the same request.
     :param bulk_size: Size limitation per retrieve.
+    :param with_metadata: Whether to load request_metadata and processing_metadata.
     :param to_json: return json format.
 
     :raises NoObject: If no request are founded.
@@ -340,10 +343,10 @@ def get_requests_by_status_type(status, request_type=None, time_period=None, loc
         if len(status) == 1:
             status = [status[0], status[0]]
 
-        query = session.query(models.Request)\
-                       .with_hint(models.Request, "INDEX(REQUESTS REQUESTS_SCOPE_NAME_IDX)", 'oracle')\
-                       .filter(models.Request.status.in_(status))\
-                       .filter(models.Request.next_poll_at < datetime.datetime.utcnow())
+        query = query_columns(models.Request, with_metadata=with_metadata, session=session)
+        query = query.with_hint(models.Request, "INDEX(REQUESTS REQUESTS_SCOPE_NAME_IDX)", 'oracle')\
+                     .filter(models.Request.status.in_(status))\
+                     .filter(models.Request.next_poll_at < datetime.datetime.utcnow())
 
         if request_type is not None:
             query = query.filter(models.Request.request_type == request_type)
@@ -369,6 +372,53 @@ def get_requests_by_status_type(status, request_type=None, time_period=None, loc
         raise exceptions.NoObject('No requests with status: %s, request_type: %s, time_period: %s, locking: %s, %s' % (status, request_type, time_period, locking, error))
 
 
+@transactional_session
+def claim_requests_by_status_type(status, request_type=None, time_period=None, bulk_size=None, to_json=False, session=None):
+    """
+    Get unlocked requests and lock them in the same transaction.
+    Concurrent agents never get the same request.
+
+    :param status: list of status of the request data.
+    :param request_type: The type of the request data.
+    :param time_period: Time period in seconds since last update.
+    :param bulk_size: Size limitation per retrieve.
+    :param to_json: return json format.
+
+    :raises WrongParameterException: If status is None.
+
+    :returns: list of claimed Requests.
+    """
+    if status is None:
+        raise exceptions.WrongParameterException("status should not be None")
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    if len(status) == 1:
+        status = [status[0], status[0]]
+
+    query = session.query(models.Request)\
+                   .with_hint(models.Request, "INDEX(REQUESTS REQUESTS_SCOPE_NAME_IDX)", 'oracle')\
+                   .filter(models.Request.status.in_(status))\
+                   .filter(models.Request.next_poll_at < datetime.datetime.utcnow())\
+                   .filter(models.Request.locking == RequestLocking.Idle)
+
+    if request_type is not None:
+        query = query.filter(models.Request.request_type == request_type)
+    if time_period is not None:
+        query = query.filter(models.Request.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=time_period))
+    query = query.order_by(asc(models.Request.updated_at))\
+                 .order_by(desc(models.Request.priority))
+
+    tmp = claim_rows(query, models.Request, RequestLocking.Idle, RequestLocking.Locking,
+                     bulk_size=bulk_size, session=session)
+    rets = []
+    for req in tmp:
+        if to_json:
+            rets.append(req.to_dict_json())
+        else:
+            rets.append(req.to_dict())
+    return rets
+
+
 @transactional_session
 def update_request(request_id, parameters, session=None):
     """
@@ -391,6 +441,27 @@ def update_request(request_id, parameters, session=None):
         raise exceptions.NoObject('Request %s cannot be found: %s' % (request_id, error))
 
 
+@transactional_session
+def update_requests(parameters, session=None):
+    """
+    update requests in bulk.
+
+    :param parameters: list of dictionary of parameters, with request_id in every dictionary.
+    :param session: The database session in use.
+
+    :raises NoObject: If no request is founded.
+    :raises DatabaseException: If there is a database error.
+
+    """
+    try:
+        for parameter in parameters:
+            parameter['updated_at'] = datetime.datetime.utcnow()
+
+        session.bulk_update_mappings(models.Request, parameters)
+    except sqlalchemy.orm.exc.NoResultFound as error:
+        raise exceptions.NoObject('Request cannot be found: %s' % (error))
+
+
 @transactional_session
 def delete_requests(request_id=None, workload_id=None, session=None):
     """
@@ -24,6 +24,7 @@ from idds.common import exceptions
 from idds.common.constants import TransformStatus, TransformLocking, CollectionRelationType
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import claim_rows, query_columns, fetch_rows
 
 
 def create_transform(transform_type, transform_tag=None, priority=0, status=TransformStatus.New, locking=TransformLocking.Idle,
@@ -287,13 +288,18 @@ def get_transforms(request_id=None, workload_id=None, transform_id=None, to_json
 
 
 @read_session
-def get_transforms_by_status(status, period=None, locking=False, bulk_size=None, to_json=False, session=None):
+def get_transforms_by_status(status, period=None, locking=False, bulk_size=None, columns=None, raw=False, with_metadata=True,
+                             to_json=False, session=None):
     """
     Get transforms or raise a NoObject exception.
 
     :param status: Transform status or list of transform status.
     :param period: Time period in seconds.
     :param locking: Whether to retrieved unlocked items.
+    :param bulk_size: bulk size limitation.
+    :param columns: list of column names to read. All columns are read if it's None.
+    :param raw: return the rows of a Core select, as tuples with fields accessible by name.
+    :param with_metadata: Whether to load transform_metadata when all columns are read.
     :param to_json: return json format.
 
     :param session: The database session in use.
@@ -308,9 +314,9 @@ def get_transforms_by_status(status, period=None, locking=False, bulk_size=None,
         if len(status) == 1:
             status = [status[0], status[0]]
 
-        query = session.query(models.Transform)\
-                       .filter(models.Transform.status.in_(status))\
-                       .filter(models.Transform.next_poll_at < datetime.datetime.utcnow())
+        query = query_columns(models.Transform, columns=columns, with_metadata=with_metadata, session=session)
+        query = query.filter(models.Transform.status.in_(status))\
+                     .filter(models.Transform.next_poll_at < datetime.datetime.utcnow())
 
         if period:
             query = query.filter(models.Transform.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=period))
@@ -322,15 +328,7 @@ def get_transforms_by_status(status, period=None, locking=False, bulk_size=None,
         if bulk_size:
             query = query.limit(bulk_size)
 
-        tmp = query.all()
-        rets = []
-        if tmp:
-            for t in tmp:
-                if to_json:
-                    rets.append(t.to_dict_json())
-                else:
-                    rets.append(t.to_dict())
-        return rets
+        return fetch_rows(query, columns=columns, raw=raw, to_json=to_json, session=session)
     except sqlalchemy.orm.exc.NoResultFound as error:
         raise exceptions.NoObject('No transforms attached with status (%s): %s' %
                                   (status, error))
@@ -338,6 +336,47 @@ def get_transforms_by_status(status, period=None, locking=False, bulk_size=None,
         raise error
 
 
+@transactional_session
+def claim_transforms_by_status(status, period=None, bulk_size=None, to_json=False, session=None):
+    """
+    Get unlocked transforms and lock them in the same transaction.
+    Concurrent agents never get the same transform.
+
+    :param status: Transform status or list of transform status.
+    :param period: Time period in seconds.
+    :param bulk_size: bulk size limitation.
+    :param to_json: return json format.
+
+    :param session: The database session in use.
+
+    :returns: list of claimed transforms.
+    """
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    if len(status) == 1:
+        status = [status[0], status[0]]
+
+    query = session.query(models.Transform)\
+                   .filter(models.Transform.status.in_(status))\
+                   .filter(models.Transform.next_poll_at < datetime.datetime.utcnow())\
+                   .filter(models.Transform.locking == TransformLocking.Idle)
+
+    if period:
+        query = query.filter(models.Transform.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=period))
+
+    query = query.order_by(asc(models.Transform.updated_at)).order_by(desc(models.Transform.priority))
+
+    tmp = claim_rows(query, models.Transform, TransformLocking.Idle, TransformLocking.Locking,
+                     bulk_size=bulk_size, session=session)
+    rets = []
+    for t in tmp:
+        if to_json:
+            rets.append(t.to_dict_json())
+        else:
+            rets.append(t.to_dict())
+    return rets
+
+
 @transactional_session
 def update_transform(transform_id, parameters, session=None):
     """
@@ -23,6 +23,7 @@ from idds.common import exceptions
 from idds.common.constants import WorkprogressStatus, WorkprogressLocking
 from idds.orm.base.session import read_session, transactional_session
 from idds.orm.base import models
+from idds.orm.base.utils import claim_rows
 
 
 def create_workprogress(request_id, scope, name, priority=0, status=WorkprogressStatus.New, locking=WorkprogressLocking.Idle,
@@ -227,6 +228,50 @@ def get_workprogresses_by_status(status, period=None, locking=False, bulk_size=N
         raise exceptions.NoObject('No workprogresses with status: %s, period: %s, locking: %s, %s' % (status, period, locking, error))
 
 
+@transactional_session
+def claim_workprogresses_by_status(status, period=None, bulk_size=None, to_json=False, session=None):
+    """
+    Get unlocked workprogresses and lock them in the same transaction.
+    Concurrent agents never get the same workprogress.
+
+    :param status: list of status of the workprogress data.
+    :param period: Time period in seconds since last update.
+    :param bulk_size: Size limitation per retrieve.
+    :param to_json: whether to return json format.
+
+    :raises WrongParameterException: If status is None.
+
+    :returns: list of claimed Workprogresses.
+    """
+    if status is None:
+        raise exceptions.WrongParameterException("status should not be None")
+    if not isinstance(status, (list, tuple)):
+        status = [status]
+    if len(status) == 1:
+        status = [status[0], status[0]]
+
+    query = session.query(models.Workprogress)\
+                   .with_hint(models.Workprogress, "INDEX(WORKPROGRESSES WORKPROGRESS_STATUS_PRIO_IDX)", 'oracle')\
+                   .filter(models.Workprogress.status.in_(status))\
+                   .filter(models.Workprogress.next_poll_at < datetime.datetime.utcnow())\
+                   .filter(models.Workprogress.locking == WorkprogressLocking.Idle)
+
+    if period is not None:
+        query = query.filter(models.Workprogress.updated_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=period))
+    query = query.order_by(asc(models.Workprogress.updated_at))\
+                 .order_by(desc(models.Workprogress.priority))
+
+    tmp = claim_rows(query, models.Workprogress, WorkprogressLocking.Idle, WorkprogressLocking.Locking,
+                     bulk_size=bulk_size, session=session)
+    rets = []
+    for t in tmp:
+        if to_json:
+            rets.append(t.to_dict_json())
+        else:
+            rets.append(t.to_dict())
+    return rets
+
+
 @transactional_session
 def update_workprogress(workprogress_id, parameters, session=None):
     """
@@ -249,6 +294,27 @@ def update_workprogress(workprogress_id, parameters, session=None):
         raise exceptions.NoObject('Workprogress %s cannot be found: %s' % (workprogress_id, error))
 
 
+@transactional_session
+def update_workprogresses(parameters, session=None):
+    """
+    update workprogresses in bulk.
+
+    :param parameters: list of dictionary of parameters, with workprogress_id in every dictionary.
+    :param session: The database session in use.
+
+    :raises NoObject: If no workprogress is founded.
+    :raises DatabaseException: If there is a database error.
+
+    """
+    try:
+        for parameter in parameters:
+            parameter['updated_at'] = datetime.datetime.utcnow()
+
+        session.bulk_update_mappings(models.Workprogress, parameters)
+    except sqlalchemy.orm.exc.NoResultFound as error:
+        raise exceptions.NoObject('Workprogress cannot be found: %s' % (error))
+
+
 @transactional_session
 def delete_workprogress(workprogress_id=None, session=None):
     """
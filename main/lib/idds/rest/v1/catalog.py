@@ -174,8 +174,9 @@ class Catalog(IDDSController):
             400 Bad request
             500 Internal Error
         """
-        kwargs = {'scope': None, 'name': None, 'min_id': None, 'max_id': None,
-                  'path': None, 'status': None}
+        kwargs = {'scope': None, 'name': None, 'min_id': None, 'max_id': None}
+        # the fields which are not in the parameters are not changed
+        optional_keys = ['path', 'status']
         try:
             if coll_scope in ['null', 'None']:
                 coll_scope = None
@@ -195,7 +196,7 @@ class Catalog(IDDSController):
             if parameters:
                 for parameter in parameters:
                     content = copy.deepcopy(kwargs)
-                    for key in kwargs:
+                    for key in list(kwargs.keys()) + optional_keys:
                         if key in parameter:
                             content[key] = parameter[key]
                     contents.append(content)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+
+"""
+performance test of the agent pipeline.
+
+Seeds requests, then runs Clerk -> Marshaller -> Transformer -> Carrier -> Transporter
+in-process against the configured database (for example a local SQLite or PostgreSQL),
+with fake DDM plugins and a fake work instead of Rucio/Condor. It reports the throughput,
+the latency percentiles of every stage, the database round trips and the peak RSS.
+
+Every round runs each stage once: get -> process -> finish, like one iteration of the
+agent's timer tasks, so the results are reproducible for the same parameters.
+
+    IDDS_CONFIG=<cfg with a test database> python performance_test_with_agents.py --build-database \
+        --requests 100 --works 2 --files 100 --rounds 30 --output result.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import resource
+import time
+import traceback
+import uuid
+
+from sqlalchemy import event
+
+from idds.common.constants import (RequestType, RequestStatus, TransformType,
+                                   CollectionStatus, ContentType, ContentStatus,
+                                   ProcessingStatus, WorkStatus)
+from idds.common.plugin.plugin_base import PluginBase
+from idds.core import requests as core_requests
+from idds.orm.base import profiler as db_profiler
+from idds.orm.base import session as db_session
+from idds.orm.base import utils as db_utils
+from idds.workflow.work import Work
+from idds.workflow.workflow import Workflow
+from idds.agents.clerk.clerk import Clerk
+from idds.agents.marshaller.marshaller import Marshaller
+from idds.agents.transformer.transformer import Transformer
+from idds.agents.carrier.carrier import Carrier
+from idds.agents.transporter.transporter import Transporter
+
+
+def get_file_name(coll_name, i):
+    return '%s.file.%06d' % (coll_name, i)
+
+
+class FakeCollectionMetadataReader(PluginBase):
+    def __init__(self, num_files=10, latency=0, **kwargs):
+        super(FakeCollectionMetadataReader, self).__init__(**kwargs)
+        self.num_files = num_files
+        self.latency = latency
+
+    def __call__(self, scope, name):
+        if self.latency:
+            time.sleep(self.latency)
+        return {'bytes': self.num_files * 1000,
+                'availability': True,
+                'events': self.num_files * 10,
+                'is_open': False,
+                'run_number': None,
+                'status': CollectionStatus.Closed,
+                'total_files': self.num_files}
+
+
+class FakeContentsLister(PluginBase):
+    def __init__(self, num_files=10, latency=0, **kwargs):
+        super(FakeContentsLister, self).__init__(**kwargs)
+        self.num_files = num_files
+        self.latency = latency
+
+    def __call__(self, scope, name):
+        if self.latency:
+            time.sleep(self.latency)
+        return [{'scope': scope,
+                 'name': get_file_name(name, i),
+                 'bytes': 1000,
+                 'events': 10,
+                 'adler32': '%08x' % i} for i in range(self.num_files)]
+
+
+class FakeContentsRegister(PluginBase):
+    def __init__(self, latency=0, **kwargs):
+        super(FakeContentsRegister, self).__init__(**kwargs)
+        self.latency = latency
+
+    def __call__(self, scope, name, contents):
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+
+class BenchmarkWork(Work):
+    """
+    Work which fakes the DDM side: the inputs are generated and the outputs are
+    available at the first poll.
+    """
+
+    def __init__(self, num_files=10, **kwargs):
+        super(BenchmarkWork, self).__init__(work_type=TransformType.StageIn, **kwargs)
+        self.num_files = num_files
+
+    def get_input_contents(self):
+        coll = self.collections[self.primary_input_collection]
+        return [{'coll_id': coll.get('coll_id', None),
+                 'scope': coll['scope'],
+                 'name': get_file_name(coll['name'], i),
+                 'bytes': 1000,
+                 'adler32': '%08x' % i,
+                 'min_id': 0,
+                 'max_id': 10,
+                 'content_type': ContentType.File,
+                 'content_metadata': {'events': 10}} for i in range(self.num_files)]
+
+    def get_new_input_output_maps(self, mapped_input_output_maps={}):
+        mapped_inputs = set()
+        for map_id in mapped_input_output_maps:
+            for ip in mapped_input_output_maps[map_id]['inputs']:
+                mapped_inputs.add(ip['scope'] + ':' + ip['name'])
+
+        next_key = max(mapped_input_output_maps.keys()) + 1 if mapped_input_output_maps else 1
+        output_coll = self.collections[self.output_collections[0]]
+        new_input_output_maps = {}
+        for ip in self.get_input_contents():
+            if ip['scope'] + ':' + ip['name'] in mapped_inputs:
+                continue
+            out_ip = dict(ip)
+            out_ip['coll_id'] = output_coll.get('coll_id', None)
+            out_ip['scope'] = output_coll['scope']
+            out_ip['name'] = get_file_name(output_coll['name'], next_key)
+            new_input_output_maps[next_key] = {'inputs': [ip], 'outputs': [out_ip]}
+            next_key += 1
+        # all inputs are generated at once
+        self.set_has_new_inputs(False)
+        return new_input_output_maps
+
+    def poll_processing_updates(self, input_output_maps):
+        processing = self.get_processing(input_output_maps)
+        updated_contents = []
+        for map_id in input_output_maps:
+            for content in input_output_maps[map_id].get('outputs', []):
+                if content['substatus'] != ContentStatus.Available:
+                    updated_contents.append({'content_id': content['content_id'],
+                                             'substatus': ContentStatus.Available})
+                    content['substatus'] = ContentStatus.Available
+
+        update_processing = {}
+        if processing and 'processing_id' in processing:
+            update_processing = {'processing_id': processing['processing_id'],
+                                 'parameters': {'status': ProcessingStatus.Finished}}
+        return update_processing, updated_contents
+
+    def syn_work_status(self, registered_input_output_maps):
+        statuses = set()
+        for map_id in registered_input_output_maps:
+            for content in registered_input_output_maps[map_id].get('outputs', []):
+                statuses.add(content['status'])
+        if statuses and not self.has_new_inputs():
+            if statuses == set([ContentStatus.Available]):
+                self.status = WorkStatus.Finished
+            elif ContentStatus.Available in statuses and len(statuses) == 1:
+                self.status = WorkStatus.Finished
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Count the error logs per logger. The agents catch and log the exceptions of their tasks.
+    """
+
+    def __init__(self):
+        super(ErrorCounter, self).__init__(level=logging.ERROR)
+        self.counts = {}
+
+    def emit(self, record):
+        self.counts[record.name] = self.counts.get(record.name, 0) + 1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.db_statements = 0
+        self.step_times = {'get': [], 'process': [], 'finish': []}
+        self.item_times = []
+
+    def to_dict(self, wall_time):
+        ret = {'items': self.items,
+               'errors': self.errors,
+               'db_statements': self.db_statements,
+               'throughput': self.items / wall_time if wall_time else 0}
+        for step in self.step_times:
+            ret['%s_time' % step] = sum(self.step_times[step])
+        for pct in [50, 95, 99]:
+            ret['item_p%s_ms' % pct] = percentile(self.item_times, pct) * 1000
+        return ret
+
+
+class Stage(object):
+    """
+    One get -> process -> finish chain of an agent.
+    """
+
+    def __init__(self, name, agent, get_func, task_queue, item_func_name, process_func, output_queue, finish_func):
+        self.stats = StageStats(name)
+        self.agent = agent
+        self.get_func = get_func
+        self.task_queue = task_queue
+        self.process_func = process_func
+        self.output_queue = output_queue
+        self.finish_func = finish_func
+
+        # time every item and count its errors. The agent catches and logs the exceptions.
+        item_func = getattr(agent, item_func_name)
+
+        def timed_item_func(*args, **kwargs):
+            start = time.time()
+            try:
+                return item_func(*args, **kwargs)
+            except Exception:
+                self.stats.errors += 1
+                raise
+            finally:
+                self.stats.item_times.append(time.time() - start)
+        setattr(agent, item_func_name, timed_item_func)
+
+    def run_step(self, step, func, output_queue=None):
+        start_statements = Benchmark.db_statements
+        start = time.time()
+        ret = None
+        try:
+            ret = func()
+        except Exception:
+            self.stats.errors += 1
+            print("%s %s failed: %s" % (self.stats.name, step, traceback.format_exc()))
+        self.stats.step_times[step].append(time.time() - start)
+        self.stats.db_statements += Benchmark.db_statements - start_statements
+        if output_queue is not None and ret:
+            for item in ret:
+                output_queue.put(item)
+        return ret
+
+    def run(self):
+        items = self.run_step('get', self.get_func, self.task_queue)
+        if not items:
+            return 0
+        self.stats.items += len(items)
+        self.run_step('process', self.process_func, self.output_queue)
+        self.run_step('finish', self.finish_func)
+        return len(items)
+
+
+class Benchmark(object):
+    db_statements = 0
+
+    def __init__(self, num_requests=10, num_works=1, num_files=10, bulk_size=100, plugin_latency=0):
+        self.num_requests = num_requests
+        self.num_works = num_works
+        self.num_files = num_files
+        self.bulk_size = bulk_size
+        self.plugin_latency = plugin_latency
+        self.stages = []
+        self.request_ids = []
+
+    @staticmethod
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        Benchmark.db_statements += 1
+
+    def get_workflow(self, i):
+        workflow = Workflow()
+        for j in range(self.num_works):
+            name = 'benchmark.%s.%s.%s' % (uuid.uuid4().hex[:8], i, j)
+            work = BenchmarkWork(num_files=self.num_files,
+                                 executable='echo',
+                                 primary_input_collection={'scope': 'benchmark', 'name': name + '.input'},
+                                 output_collections=[{'scope': 'benchmark', 'name': name + '.output'}])
+            workflow.add_work(work, initial=True)
+        return workflow
+
+    def seed(self):
+        for i in range(self.num_requests):
+            workflow = self.get_workflow(i)
+            request_id = core_requests.add_request(scope='benchmark',
+                                                   name='benchmark.request.%s' % i,
+                                                   requester='benchmark',
+                                                   request_type=RequestType.StageIn,
+                                                   transform_tag='benchmark',
+                                                   status=RequestStatus.New,
+                                                   request_metadata={'workload_id': int(time.time()),
+                                                                     'workflow': workflow})
+            self.request_ids.append(request_id)
+
+    def setup_agents(self):
+        kwargs = {'poll_time_period': 0, 'retrieve_bulk_size': self.bulk_size, 'finish_bulk_size': self.bulk_size}
+        plugins = {'collection_metadata_reader': FakeCollectionMetadataReader(num_files=self.num_files, latency=self.plugin_latency),
+                   'contents_lister': FakeContentsLister(num_files=self.num_files, latency=self.plugin_latency),
+                   'contents_register': FakeContentsRegister(latency=self.plugin_latency)}
+
+        clerk = Clerk(**kwargs)
+        marshaller = Marshaller(**kwargs)
+        transformer = Transformer(**kwargs)
+        carrier = Carrier(**kwargs)
+        transporter = Transporter(**kwargs)
+        for agent in [clerk, marshaller, transformer, carrier, transporter]:
+            agent.plugins = plugins
+
+        self.stages = [Stage('clerk.new', clerk, clerk.get_new_requests, clerk.new_task_queue, 'process_new_request',
+                             clerk.process_new_requests, clerk.new_output_queue, clerk.finish_new_requests),
+                       Stage('marshaller.new', marshaller, marshaller.get_new_workprogresses, marshaller.new_task_queue,
+                             'process_new_workprogress', marshaller.process_new_workprogresses,
+                             marshaller.new_output_queue, marshaller.finish_new_workprogresses),
+                       Stage('transformer.new', transformer, transformer.get_new_transforms, transformer.new_task_queue,
+                             'process_new_transform', transformer.process_new_transforms,
+                             transformer.new_output_queue, transformer.finish_new_transforms),
+                       Stage('transporter.input', transporter, transporter.get_new_input_collections, transporter.new_input_queue,
+                             'process_input_collection', transporter.process_input_collections,
+                             transporter.processed_input_queue, transporter.finish_processing_input_collections),
+                       Stage('transformer.running', transformer, transformer.get_running_transforms, transformer.running_task_queue,
+                             'process_running_transform', transformer.process_running_transforms,
+                             transformer.running_output_queue, transformer.finish_running_transforms),
+                       Stage('carrier.new', carrier, carrier.get_new_processings, carrier.new_task_queue,
+                             'process_new_processing', carrier.process_new_processings,
+                             carrier.new_output_queue, carrier.finish_new_processings),
+                       Stage('carrier.running', carrier, carrier.get_running_processings, carrier.running_task_queue,
+                             'process_running_processing', carrier.process_running_processings,
+                             carrier.running_output_queue, carrier.finish_running_processings),
+                       Stage('transporter.output', transporter, transporter.get_new_output_collections, transporter.new_output_queue,
+                             'process_output_collection', transporter.process_output_collections,
+                             transporter.processed_output_queue, transporter.finish_processing_output_collections),
+                       Stage('marshaller.running', marshaller, marshaller.get_running_workprogresses, marshaller.running_task_queue,
+                             'process_running_workprogress', marshaller.process_running_workprogresses,
+                             marshaller.running_output_queue, marshaller.finish_running_workprogresses),
+                       Stage('clerk.running', clerk, clerk.get_running_requests, clerk.running_task_queue, 'process_running_request',
+                             clerk.process_running_requests, clerk.running_output_queue, clerk.finish_running_requests)]
+
+    def get_request_statuses(self):
+        statuses = {}
+        for request_id in self.request_ids:
+            for req in core_requests.get_requests(request_id=request_id):
+                status = req['status'].name
+                statuses[status] = statuses.get(status, 0) + 1
+        return statuses
+
+    def run(self, rounds=10, build_database=False):
+        engine = db_session.get_engine(echo=False)
+        if build_database:
+            db_utils.build_database(echo=False)
+        event.listen(engine, 'before_cursor_execute', Benchmark.count_statement)
+        error_counter = ErrorCounter()
+        logging.getLogger().addHandler(error_counter)
+
+        try:
+            start = time.time()
+            self.seed()
+            seed_time = time.time() - start
+            seed_statements = Benchmark.db_statements
+
+            self.setup_agents()
+            start = time.time()
+            for i in range(rounds):
+                num_items = 0
+                for stage in self.stages:
+                    num_items += stage.run()
+                if not num_items:
+                    break
+            wall_time = time.time() - start
+        finally:
+            event.remove(engine, 'before_cursor_execute', Benchmark.count_statement)
+            logging.getLogger().removeHandler(error_counter)
+
+        result = {'time': datetime.datetime.utcnow().isoformat(),
+                  'parameters': {'requests': self.num_requests, 'works': self.num_works, 'files': self.num_files,
+                                 'bulk_size': self.bulk_size, 'plugin_latency': self.plugin_latency},
+                  'rounds': i + 1,
+                  'seed_time': seed_time,
+                  'seed_db_statements': seed_statements,
+                  'wall_time': wall_time,
+                  'db_statements': Benchmark.db_statements - seed_statements,
+                  'request_throughput': self.num_requests / wall_time if wall_time else 0,
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                  'request_statuses': self.get_request_statuses(),
+                  'error_logs': error_counter.counts,
+                  'stages': dict((stage.stats.name, stage.stats.to_dict(wall_time)) for stage in self.stages)}
+        return result
+
+
+def print_result(result):
+    print("parameters: %s" % result['parameters'])
+    print("seed: %.3f seconds, %s db statements" % (result['seed_time'], result['seed_db_statements']))
+    header = ('stage', 'items', 'errors', 'db_stmts', 'items/s', 'get(s)', 'process(s)', 'finish(s)', 'p50(ms)', 'p95(ms)', 'p99(ms)')
+    print("%-20s %8s %7s %9s %10s %10s %10s %10s %10s %10s %10s" % header)
+    for name, stats in result['stages'].items():
+        print("%-20s %8s %7s %9s %10.1f %10.3f %10.3f %10.3f %10.2f %10.2f %10.2f" %
+              (name, stats['items'], stats['errors'], stats['db_statements'], stats['throughput'],
+               stats['get_time'], stats['process_time'], stats['finish_time'],
+               stats['item_p50_ms'], stats['item_p95_ms'], stats['item_p99_ms']))
+    print("rounds: %s, wall time: %.3f seconds, requests/s: %.2f, db statements: %s, peak rss: %.1f MB" %
+          (result['rounds'], result['wall_time'], result['request_throughput'], result['db_statements'], result['peak_rss_mb']))
+    print("request statuses: %s" % result['request_statuses'])
+    print("error logs: %s" % result['error_logs'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the agent pipeline with fake plugins")
+    parser.add_argument('--requests', type=int, default=10, help="Number of requests to seed")
+    parser.add_argument('--works', type=int, default=1, help="Number of works per request")
+    parser.add_argument('--files', type=int, default=10, help="Number of files per input collection")
+    parser.add_argument('--bulk-size', type=int, default=100, help="retrieve_bulk_size and finish_bulk_size of the agents")
+    parser.add_argument('--plugin-latency', type=float, default=0, help="Seconds every fake DDM call sleeps")
+    parser.add_argument('--rounds', type=int, default=20, help="Max number of rounds over all stages")
+    parser.add_argument('--build-database', action='store_true', default=False, help="Create the tables first")
+    parser.add_argument('--output', default=None, help="Write the result as json to this file")
+    parser.add_argument('--log-level', default='WARNING', help="Log level of the agents")
+    parser.add_argument('--sql-profile', type=int, default=0, help="Print the top N statements and callers of the SQL profiler")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+
+    benchmark = Benchmark(num_requests=args.requests, num_works=args.works, num_files=args.files,
+                          bulk_size=args.bulk_size, plugin_latency=args.plugin_latency)
+    if args.sql_profile:
+        sql_profiler = db_profiler.enable(db_session.get_engine(echo=False))
+    result = benchmark.run(rounds=args.rounds, build_database=args.build_database)
+    print_result(result)
+    if args.sql_profile:
+        print(sql_profiler.report(top=args.sql_profile))
+        db_profiler.disable()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
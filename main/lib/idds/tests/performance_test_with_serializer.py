@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+
+"""
+performance test to serialize workflows.
+
+Compares the DictClass format (json_dumps/json_loads) with the serializer (json and msgpack)
+when round-tripping a workflow with many works which have large collections and processings.
+"""
+
+import argparse
+import time
+
+from idds.common import serializer
+from idds.common.constants import CollectionStatus, ProcessingStatus
+from idds.common.utils import json_dumps, json_loads
+from idds.workflow.work import Work
+from idds.workflow.workflow import Workflow
+
+
+def get_workflow(num_works=300, num_items=50):
+    workflow = Workflow()
+    for i in range(num_works):
+        work = Work(executable='echo', arguments='--in=IN_DATASET --out=OUT_DATASET',
+                    work_id=i,
+                    primary_input_collection={'scope': 'data17', 'name': 'data17.test.raw.%s' % i},
+                    output_collections=[{'scope': 'data17', 'name': 'data17.test.out.%s' % i}])
+        for j in range(num_items):
+            name = 'data17.test.sub.%s.%s' % (i, j)
+            work.collections['data17:%s' % name] = {'scope': 'data17',
+                                                    'name': name,
+                                                    'coll_id': i * num_items + j,
+                                                    'status': CollectionStatus.Open.value,
+                                                    'coll_metadata': {'total_files': 100, 'processed_files': j}}
+            work.processings[str(j)] = {'processing_id': i * num_items + j,
+                                        'status': ProcessingStatus.Running.value,
+                                        'processing_metadata': {'rule_id': 'ab%030d' % j, 'files': ['f%s' % k for k in range(10)]}}
+        workflow.add_work(work, initial=(i == 0))
+    return workflow
+
+
+def run(name, dumps, loads, num_works, num_items, times):
+    dump_time, load_time, size = 0, 0, 0
+    for i in range(times):
+        # DictClass.to_dict changes the objects, so every round uses a new workflow.
+        metadata = {'workflow': get_workflow(num_works, num_items)}
+        start = time.time()
+        data = dumps(metadata)
+        dump_time += time.time() - start
+        size = len(data)
+
+        start = time.time()
+        loads(data)
+        load_time += time.time() - start
+    print("%-16s dumps: %8.4f seconds, loads: %8.4f seconds, size: %s bytes" % (name, dump_time / times, load_time / times, size))
+    return dump_time + load_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of workflow serialization")
+    parser.add_argument('--works', type=int, default=300, help="Number of works in the workflow")
+    parser.add_argument('--items', type=int, default=50, help="Number of collections and processings per work")
+    parser.add_argument('--times', type=int, default=5, help="Number of rounds")
+    args = parser.parse_args()
+
+    legacy = run('dict_class', json_dumps, json_loads, args.works, args.items, args.times)
+    fast = run('serializer', serializer.dumps, serializer.loads, args.works, args.items, args.times)
+    print("serializer speedup: %.1f" % (legacy / fast))
+    if serializer.has_msgpack():
+        fast = run('serializer(bin)', lambda obj: serializer.dumps(obj, binary=True), serializer.loads,
+                   args.works, args.items, args.times)
+        print("serializer(bin) speedup: %.1f" % (legacy / fast))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+
+"""
+Test Messages.
+"""
+
+import random
+import time
+
+import unittest2 as unittest
+from nose.tools import assert_equal
+
+from idds.common.utils import check_database, has_config, setup_logging
+from idds.common.constants import MessageType, MessageStatus, MessageSource
+from idds.orm.messages import (add_message, coalesce_file_message, retrieve_messages,
+                               update_messages, delete_messages, claim_messages,
+                               release_messages)
+
+setup_logging(__name__)
+
+
+def get_file_message_properties(transform_id, num_files, start=0):
+    files = [{'scope': 'test_scope', 'name': 'test_file_%s' % i, 'path': None, 'status': 'Available'}
+             for i in range(start, start + num_files)]
+    return {'msg_type': MessageType.StageInFile,
+            'status': MessageStatus.New,
+            'source': MessageSource.Transformer,
+            'transform_id': transform_id,
+            'num_contents': num_files,
+            'msg_content': {'msg_type': 'file_stagein',
+                            'workload_id': None,
+                            'files': files}}
+
+
+def get_transform_messages(transform_id):
+    messages = retrieve_messages(bulk_size=None, msg_type=MessageType.StageInFile)
+    messages = [msg for msg in messages if msg['transform_id'] == transform_id]
+    return sorted(messages, key=lambda msg: msg['msg_id'])
+
+
+class TestMessages(unittest.TestCase):
+
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_coalesce_file_message_orm(self):
+        """ Messages (ORM): Test appending files to a pending file message """
+        # messages are not bound to transforms in the database
+        trans_id = random.randint(10 ** 8, 2 ** 31 - 1)
+
+        # the files are appended to the pending message
+        add_message(bulk_size=5, coalesce_window=600, **get_file_message_properties(trans_id, 2))
+        add_message(bulk_size=5, coalesce_window=600, **get_file_message_properties(trans_id, 2, start=2))
+        messages = get_transform_messages(trans_id)
+        assert_equal(len(messages), 1)
+        assert_equal(messages[0]['num_contents'], 4)
+        assert_equal([f['name'] for f in messages[0]['msg_content']['files']],
+                     ['test_file_%s' % i for i in range(4)])
+
+        # only bulk_size files are appended, the others are in a new message
+        add_message(bulk_size=5, coalesce_window=600, **get_file_message_properties(trans_id, 3, start=4))
+        messages = get_transform_messages(trans_id)
+        assert_equal(len(messages), 2)
+        assert_equal(messages[0]['num_contents'], 5)
+        assert_equal(len(messages[0]['msg_content']['files']), 5)
+        assert_equal(messages[1]['num_contents'], 2)
+        assert_equal([f['name'] for f in messages[1]['msg_content']['files']], ['test_file_5', 'test_file_6'])
+
+        # the messages claimed by the conductor are not changed
+        props = get_file_message_properties(trans_id, 1, start=7)
+        update_messages([{'msg_id': msg['msg_id'], 'status': MessageStatus.Fetched} for msg in messages])
+        num_appended = coalesce_file_message(msg_type=props['msg_type'], source=props['source'], transform_id=trans_id,
+                                             msg_content=props['msg_content'], files=props['msg_content']['files'],
+                                             bulk_size=5, coalesce_window=600)
+        assert_equal(num_appended, 0)
+        add_message(bulk_size=5, coalesce_window=600, **get_file_message_properties(trans_id, 1, start=8))
+        new_messages = get_transform_messages(trans_id)
+        assert_equal(len(new_messages), len(messages) + 1)
+        for msg, new_msg in zip(messages, new_messages):
+            assert_equal(new_msg['num_contents'], msg['num_contents'])
+            assert_equal(new_msg['msg_content'], msg['msg_content'])
+        assert_equal(new_messages[-1]['num_contents'], 1)
+
+        delete_messages(new_messages)
+
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_claim_release_messages_orm(self):
+        """ Messages (ORM): Test claiming, updating and releasing messages """
+        trans_id = random.randint(10 ** 8, 2 ** 31 - 1)
+        # msg_type and source which are not used by the agents, so only these messages are claimed
+        msg_filter = {'msg_type': MessageType.UnknownFile, 'source': MessageSource.Conductor}
+        delete_messages(claim_messages(bulk_size=None, **msg_filter))
+
+        for i in range(3):
+            props = get_file_message_properties(trans_id, 1, start=i)
+            props.update(msg_filter)
+            add_message(**props)
+
+        # the messages are claimed only once
+        messages = claim_messages(bulk_size=10, **msg_filter)
+        assert_equal(len(messages), 3)
+        assert_equal([msg['transform_id'] for msg in messages], [trans_id] * 3)
+        assert_equal([msg['status'] for msg in messages], [MessageStatus.Fetched] * 3)
+        assert_equal(claim_messages(bulk_size=10, **msg_filter), [])
+
+        # the messages are updated to different statuses together
+        messages = sorted(messages, key=lambda msg: msg['msg_id'])
+        update_messages([{'msg_id': messages[0]['msg_id'], 'status': MessageStatus.Delivered},
+                         {'msg_id': messages[1]['msg_id'], 'status': MessageStatus.New},
+                         {'msg_id': messages[2]['msg_id'], 'status': MessageStatus.New}])
+        statuses = dict((msg['msg_id'], msg['status']) for msg in retrieve_messages(bulk_size=None, **msg_filter))
+        assert_equal([statuses[msg['msg_id']] for msg in messages],
+                     [MessageStatus.Delivered, MessageStatus.New, MessageStatus.New])
+
+        # the messages set back to New are claimed again
+        claimed_messages = claim_messages(bulk_size=10, **msg_filter)
+        assert_equal(sorted([msg['msg_id'] for msg in claimed_messages]),
+                     [messages[1]['msg_id'], messages[2]['msg_id']])
+
+        # the messages are only released after time_period
+        release_messages(time_period=3600)
+        statuses = dict((msg['msg_id'], msg['status']) for msg in retrieve_messages(bulk_size=None, **msg_filter))
+        assert_equal([statuses[msg['msg_id']] for msg in messages],
+                     [MessageStatus.Delivered, MessageStatus.Fetched, MessageStatus.Fetched])
+
+        time.sleep(1)
+        release_messages(time_period=0)
+        statuses = dict((msg['msg_id'], msg['status']) for msg in retrieve_messages(bulk_size=None, **msg_filter))
+        assert_equal([statuses[msg['msg_id']] for msg in messages],
+                     [MessageStatus.Delivered, MessageStatus.New, MessageStatus.New])
+
+        delete_messages(messages)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+
+"""
+Test metrics.
+"""
+
+import os
+import tempfile
+
+import unittest2 as unittest
+# from nose.tools import assert_equal
+from idds.common.utils import setup_logging
+
+from idds.common import metrics
+from idds.agents.common.timertask import TimerTask
+
+
+setup_logging(__name__)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.get_registry().clear()
+
+    def test_disabled(self):
+        """ Metrics: nothing is recorded when disabled """
+        metrics.disable()
+        metrics.inc_counter('test_counter')
+        metrics.observe('test_histogram', 1)
+        metrics.set_gauge('test_gauge', 1)
+        assert metrics.get_registry().get_metrics() == []
+        assert metrics.get_registry().to_prometheus_text() == ''
+
+    def test_prometheus_text(self):
+        """ Metrics: counters, gauges and histograms in the Prometheus text format """
+        metrics.enable()
+        metrics.inc_counter('test_counter', labels={'agent': 'Clerk'}, documentation='a counter')
+        metrics.inc_counter('test_counter', value=2, labels={'agent': 'Clerk'})
+        metrics.set_gauge('test_gauge', 5)
+        histogram = metrics.get_registry().histogram('test_histogram', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        text = metrics.get_registry().to_prometheus_text()
+        assert '# TYPE test_counter counter' in text
+        assert 'test_counter{agent="Clerk"} 3.0' in text
+        assert 'test_gauge 5.0' in text
+        assert 'test_histogram_bucket{le="0.1"} 1' in text
+        assert 'test_histogram_bucket{le="1.0"} 2' in text
+        assert 'test_histogram_bucket{le="+Inf"} 3' in text
+        assert 'test_histogram_count 3' in text
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.get_registry().dump(path)
+            with open(path) as f:
+                assert f.read() == text
+        finally:
+            os.remove(path)
+
+    def test_timer_task(self):
+        """ Metrics: executions of timer tasks """
+        metrics.enable()
+
+        def failed_task():
+            raise Exception("failed")
+
+        TimerTask(lambda: None).execute()
+        TimerTask(failed_task).execute()
+        counter = metrics.get_registry().counter('idds_task_executions_total')
+        assert counter.get({'agent': '', 'task': '<lambda>', 'status': 'success'}) == 1
+        assert counter.get({'agent': '', 'task': 'failed_task', 'status': 'failed'}) == 1
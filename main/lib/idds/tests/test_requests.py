@@ -17,11 +17,12 @@ import unittest2 as unittest
 from nose.tools import assert_equal
 
 from idds.client.client import Client
-from idds.common.constants import RequestStatus
+from idds.common.constants import RequestStatus, RequestLocking
 from idds.common.utils import (check_database, has_config, setup_logging,
-                               check_rest_host, get_rest_host, check_user_proxy)
+                               check_rest_host, get_rest_host, check_user_proxy, LazyJSON)
 from idds.orm.requests import (add_request, get_request, update_request,
-                               delete_requests)
+                               delete_requests, claim_requests_by_status_type,
+                               get_requests_by_status_type)
 from idds.tests.common import get_request_properties
 
 setup_logging(__name__)
@@ -60,6 +61,58 @@ class TestRequest(unittest.TestCase):
         req = get_request(request_id=request_id)
         assert_equal(req, None)
 
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_claim_requests_orm(self):
+        """ Request (ORM): Test claiming requests """
+        properties = get_request_properties()
+        properties['status'] = RequestStatus.ToCancel
+
+        request_id = add_request(**properties)
+        request_id1 = add_request(**properties)
+
+        reqs = claim_requests_by_status_type(RequestStatus.ToCancel)
+        req_ids = [req['request_id'] for req in reqs]
+        assert_equal(request_id in req_ids, True)
+        assert_equal(request_id1 in req_ids, True)
+
+        request = get_request(request_id=request_id)
+        assert_equal(request['locking'], RequestLocking.Locking)
+
+        reqs = claim_requests_by_status_type(RequestStatus.ToCancel)
+        req_ids = [req['request_id'] for req in reqs]
+        assert_equal(request_id in req_ids, False)
+        assert_equal(request_id1 in req_ids, False)
+
+        delete_requests(request_id=request_id)
+        delete_requests(request_id=request_id1)
+
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_lazy_request_metadata_orm(self):
+        """ Request (ORM): Test lazy decoding and deferring of request metadata """
+        properties = get_request_properties()
+        properties['status'] = RequestStatus.ToCancel
+
+        request_id = add_request(**properties)
+
+        request = get_request(request_id=request_id)
+        assert_equal(isinstance(request['request_metadata'], LazyJSON), True)
+        assert_equal(request['request_metadata'].is_decoded, False)
+        assert_equal(request['request_metadata'], properties['request_metadata'])
+        assert_equal(request['request_metadata'].is_decoded, True)
+
+        update_request(request_id, {'request_metadata': request['request_metadata']})
+        request = get_request(request_id=request_id)
+        assert_equal(request['request_metadata'], properties['request_metadata'])
+
+        reqs = get_requests_by_status_type(RequestStatus.ToCancel, with_metadata=False)
+        reqs = [req for req in reqs if req['request_id'] == request_id]
+        assert_equal(len(reqs), 1)
+        assert_equal('request_metadata' in reqs[0], False)
+
+        delete_requests(request_id=request_id)
+
     @unittest.skipIf(not has_config(), "No config file")
     @unittest.skipIf(not check_user_proxy(), "No user proxy to access REST")
     @unittest.skipIf(not check_rest_host(), "REST host is not defined")
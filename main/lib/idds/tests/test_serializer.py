@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0OA
+#
+# Authors:
+# - Wen Guan, <wen.guan@cern.ch>, 2020
+
+
+"""
+Test serializer.
+"""
+
+import json
+
+import unittest2 as unittest
+from nose.tools import assert_equal
+
+from idds.common.constants import WorkStatus
+from idds.common.serializer import dumps, loads, ATTRIBUTES_KEY
+from idds.common.utils import setup_logging
+from idds.workflow.work import Work
+
+setup_logging(__name__)
+
+
+class TestSerializer(unittest.TestCase):
+
+    def test_round_trip(self):
+        """ Serializer: Test dumps and loads of a Work """
+        work = Work(executable='test_exec', arguments='test_args')
+        work.status = WorkStatus.Transforming
+
+        new_work = loads(dumps({'work': work}))['work']
+        assert_equal(new_work.__class__, Work)
+        assert_equal(new_work.executable, 'test_exec')
+        assert_equal(new_work.arguments, 'test_args')
+        assert_equal(new_work.status, WorkStatus.Transforming)
+        assert_equal(new_work.internal_id, work.internal_id)
+
+    def test_load_object_without_new_attributes(self):
+        """ Serializer: Test loading a Work stored before some attributes were added """
+        work = Work(executable='test_exec')
+        work.active_processings.append('test_processing')
+
+        # the work is stored without active_processings and processings
+        data = json.loads(dumps(work))
+        del data[ATTRIBUTES_KEY]['active_processings']
+        del data[ATTRIBUTES_KEY]['processings']
+
+        new_work = loads(json.dumps(data))
+        assert_equal(new_work.executable, 'test_exec')
+        assert_equal(new_work.active_processings, [])
+        assert_equal(new_work.processings, {})
+
+        # the defaults are not shared between the loaded objects
+        new_work.active_processings.append('test_processing')
+        assert_equal(loads(json.dumps(data)).active_processings, [])
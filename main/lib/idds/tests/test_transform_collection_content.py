@@ -16,7 +16,7 @@ Test Request.
 import copy
 
 import unittest2 as unittest
-from nose.tools import assert_equal, assert_in
+from nose.tools import assert_equal, assert_in, assert_not_in
 
 from idds.common.constants import (TransformStatus, CollectionStatus, ContentStatus, ContentType)
 from idds.common.utils import check_database, has_config, setup_logging
@@ -26,10 +26,13 @@ from idds.orm.transforms import (add_transform, delete_transform,
 from idds.orm.collections import (add_collection, get_collection_id,
                                   get_collection, update_collection,
                                   delete_collection, get_collections,
-                                  get_collection_ids_by_transform_id)
+                                  get_collection_ids_by_transform_id,
+                                  get_collection_counters)
 from idds.orm.contents import (add_content, get_content, update_content,
                                delete_content, get_contents,
-                               get_match_contents, update_contents)
+                               get_match_contents, update_contents,
+                               get_existing_content_keys, add_contents,
+                               get_content_status_statistics)
 from idds.tests.common import (get_request_properties, get_transform_properties,
                                get_collection_properties, get_content_properties)
 
@@ -217,3 +220,91 @@ class TestTransformCollectionContent(unittest.TestCase):
         content = get_content(content_id=origin_content_id1)
         assert_equal(content['status'], ContentStatus.Processing)
         assert_equal(content['path'], 'test_path2')
+
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_existing_content_keys_orm(self):
+        """ Contents (ORM): Test getting the keys of the existing contents """
+
+        trans_properties = get_transform_properties()
+        coll_properties = get_collection_properties()
+        content_properties = get_content_properties()
+
+        trans_id = add_transform(**trans_properties)
+        coll_properties['transform_id'] = trans_id
+        coll_id = add_collection(**coll_properties)
+
+        content_properties.update({'transform_id': trans_id, 'coll_id': coll_id, 'map_id': 1})
+        add_content(**content_properties)
+        content_properties1 = copy.deepcopy(content_properties)
+        content_properties1.update({'min_id': 101, 'max_id': 200, 'map_id': 2})
+        add_content(**content_properties1)
+        content_properties2 = copy.deepcopy(content_properties)
+        content_properties2.update({'name': content_properties['name'] + '_1', 'map_id': 3})
+        add_content(**content_properties2)
+
+        existing = [content_properties1, content_properties2]
+        missing = [dict(content_properties, min_id=0, max_id=200),
+                   dict(content_properties, name=content_properties['name'] + '_2')]
+        for bulk_size in [1000, 1]:
+            keys = get_existing_content_keys(coll_id, existing + missing, bulk_size=bulk_size)
+            for content in existing:
+                assert_in((content['scope'], content['name'], content['min_id'], content['max_id']), keys)
+            for content in missing:
+                assert_not_in((content['scope'], content['name'], content['min_id'], content['max_id']), keys)
+
+        for content in get_contents(coll_id=coll_id):
+            delete_content(content_id=content['content_id'])
+        delete_collection(coll_id=coll_id)
+
+    @unittest.skipIf(not has_config(), "No config file")
+    @unittest.skipIf(not check_database(), "Database is not defined")
+    def test_collection_counters_orm(self):
+        """ Collection counters (ORM): Test the counters follow the contents """
+
+        trans_properties = get_transform_properties()
+        coll_properties = get_collection_properties()
+        content_properties = get_content_properties()
+
+        trans_id = add_transform(**trans_properties)
+        coll_properties['transform_id'] = trans_id
+        coll_id = add_collection(**coll_properties)
+
+        def check_counters():
+            counters = get_collection_counters(coll_id)
+            counters = dict((status, num) for status, num in counters.items() if num)
+            assert_equal(counters, get_content_status_statistics(coll_id=coll_id))
+
+        content_properties.update({'transform_id': trans_id, 'coll_id': coll_id, 'map_id': 1})
+        content_id = add_content(**content_properties)
+        contents = []
+        for i in range(5):
+            content = copy.deepcopy(content_properties)
+            content['name'] = content['name'] + '_%s' % i
+            content['map_id'] = i + 2
+            contents.append(content)
+        add_contents(contents)
+        check_counters()
+
+        update_content(content_id=content_id, parameters={'status': ContentStatus.Processing})
+        check_counters()
+
+        content_ids = [content['content_id'] for content in get_contents(coll_id=coll_id)
+                       if content['content_id'] != content_id]
+        update_contents([{'content_id': content_ids[0], 'status': ContentStatus.Available},
+                         {'content_id': content_ids[1], 'status': ContentStatus.Available},
+                         {'content_id': content_ids[2], 'status': ContentStatus.Failed},
+                         {'content_id': content_ids[2], 'status': ContentStatus.Available},
+                         {'content_id': content_ids[3], 'path': 'test_path'}])
+        check_counters()
+        assert_equal(get_content_status_statistics(coll_id=coll_id),
+                     {ContentStatus.New: 2, ContentStatus.Processing: 1, ContentStatus.Available: 3})
+
+        delete_content(content_id=content_id)
+        delete_content(content_id=content_ids[0])
+        check_counters()
+
+        for content_id in content_ids[1:]:
+            delete_content(content_id=content_id)
+        check_counters()
+        delete_collection(coll_id=coll_id)
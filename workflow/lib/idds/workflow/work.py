@@ -209,6 +209,8 @@ class Work(Base):
         self.collections[coll['coll_metadata']['internal_id']] = coll
 
     def set_primary_input_collection(self, coll):
+        if not coll:
+            return
         self.add_collection_to_collections(coll)
         self.primary_input_collection = coll['coll_metadata']['internal_id']
 
@@ -329,6 +331,7 @@ class Work(Base):
         proc = {'processing_metadata': {'internal_id': str(uuid.uuid1())}}
         self.add_processing_to_processings(proc)
         self.active_processings.append(proc['processing_metadata']['internal_id'])
+        return proc
 
     def get_processing(self, input_output_maps):
         if self.active_processings:
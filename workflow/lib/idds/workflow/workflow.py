@@ -207,6 +207,8 @@ class Workflow(Base):
 
         for work in [self.works[k] for k in self.current_works]:
             if work.is_terminated():
+                if work.is_finished():
+                    self.num_finished_works += 1
                 if work not in self.work_conds:
                     # has no next work
                     self.terminated_works.append(work.get_internal_id())